@@ -38,6 +38,46 @@ class ChatbotClient:
             else:
                 response.raise_for_status()
     
+    async def submit_job(self, message: str) -> str:
+        """Queue a message as a background job and return its job id"""
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                f"{self.base_url}/v1/jobs",
+                json={
+                    "message": message,
+                    "session_id": self.session_id
+                },
+                timeout=10.0
+            )
+            response.raise_for_status()
+            return response.json()["job_id"]
+    
+    async def wait_for_job(self, job_id: str, timeout: float = 300.0, poll_wait: float = 25.0) -> Dict:
+        """Long-poll a job until it finishes; returns the chat response"""
+        deadline = time.time() + timeout
+        async with httpx.AsyncClient() as client:
+            while True:
+                response = await client.get(
+                    f"{self.base_url}/v1/jobs/{job_id}",
+                    params={"wait": min(poll_wait, max(deadline - time.time(), 0))},
+                    timeout=poll_wait + 10.0
+                )
+                response.raise_for_status()
+                job = response.json()
+                
+                if job["status"] == "done":
+                    self.session_id = job["result"]["session_id"]  # Store session ID
+                    return job["result"]
+                if job["status"] == "failed":
+                    raise RuntimeError(f"Job {job_id} failed: {job['error']}")
+                if time.time() >= deadline:
+                    raise TimeoutError(f"Job {job_id} still {job['status']} after {timeout:.0f}s")
+    
+    async def send_message_as_job(self, message: str, timeout: float = 300.0) -> Dict:
+        """Like send_message, without holding a connection open for the whole turn"""
+        job_id = await self.submit_job(message)
+        return await self.wait_for_job(job_id, timeout=timeout)
+    
     async def download_artifact(self, file_type: str, filename: str = None) -> bytes:
         """Download an artifact from the chatbot"""
         if not self.session_id:
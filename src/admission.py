@@ -0,0 +1,122 @@
+"""
+Admission control for chat turns.
+
+Without it a burst starts every request at once; the OpenAI pool, the SQLite
+connections and the executor threads are oversubscribed and every turn slows
+down. `AdmissionController` lets at most ADMISSION_MAX_IN_FLIGHT turns run.
+Up to ADMISSION_MAX_QUEUE more wait in arrival order, each for at most
+ADMISSION_QUEUE_TIMEOUT seconds. Beyond that, requests are shed:
+
+- queue full: `Overloaded` with status 429
+- waited too long: `Overloaded` with status 503
+
+Both carry a `retry_after` estimate from the recent turn duration and the
+queue depth. Callers that are already bounded elsewhere (the job workers)
+are admitted with `patient=True`; they wait for a slot without the timeout
+or the queue limit, and are counted apart (`patient_queued`) so queued jobs
+never make `/v1/chat` shed.
+
+    async with admission.admit():
+        response = await run_chat_turn(request)
+
+`stats()` exports in-flight and queued counts for /v1/metrics and autoscalers.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+from config import ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT
+from locks import acquire_within
+from observability import runtime_stats
+
+STATS_GROUP = "admission"
+TURN_SECONDS_PRIOR = 5.0  # turn duration assumed before any turn has finished
+_ALPHA = 0.2  # weight of the newest turn in the duration average
+
+
+class Overloaded(RuntimeError):
+    """The request was shed; retry after `retry_after` seconds"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """At most `max_in_flight` turns running and `max_queue` waiting"""
+
+    def __init__(
+        self,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0  # interactive requests waiting; bounded by max_queue
+        self.patient_queued = 0  # job turns waiting
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._turn_seconds = TURN_SECONDS_PRIOR
+
+    def retry_after(self) -> int:
+        """Seconds until a new request probably gets a slot: queued batches times the average turn"""
+        batches = math.ceil((self.queued + self.patient_queued + 1) / self.max_in_flight)
+        return min(max(math.ceil(batches * self._turn_seconds), 1), 120)
+
+    @asynccontextmanager
+    async def admit(self, patient: bool = False) -> AsyncIterator[None]:
+        if not patient and self.queued >= self.max_queue and self.in_flight >= self.max_in_flight:
+            runtime_stats.incr(STATS_GROUP, "rejected")
+            raise Overloaded(
+                f"{self.in_flight} turns running and {self.queued} waiting", 429, self.retry_after()
+            )
+
+        counter = "patient_queued" if patient else "queued"
+        setattr(self, counter, getattr(self, counter) + 1)
+        start = time.monotonic()
+        try:
+            admitted = await acquire_within(self._slots, None if patient else self.queue_timeout)
+        finally:
+            setattr(self, counter, getattr(self, counter) - 1)
+        if not admitted:
+            runtime_stats.incr(STATS_GROUP, "timed_out")
+            raise Overloaded(
+                f"No capacity after waiting {self.queue_timeout:g}s", 503, self.retry_after()
+            )
+
+        waited = time.monotonic() - start
+        runtime_stats.incr(STATS_GROUP, "admitted")
+        runtime_stats.histogram(STATS_GROUP, "queue_wait", waited)
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            self._turn_seconds += _ALPHA * (time.monotonic() - started - self._turn_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "patient_queued": self.patient_queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "utilisation": round(self.in_flight / self.max_in_flight, 3),
+            "avg_turn_seconds": round(self._turn_seconds, 3),
+            "retry_after": self.retry_after(),
+            "queue_wait": runtime_stats.histograms(STATS_GROUP).get("queue_wait", {}),
+            "counters": runtime_stats.get(STATS_GROUP),
+        }
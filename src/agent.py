@@ -9,10 +9,13 @@ import json
 import logging
 import os
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Deque, Dict, List, Optional, Tuple
 
 import pandas as pd
 import sqlite3
@@ -20,20 +23,42 @@ from dotenv import load_dotenv
 from openai import OpenAI
 from pydantic import BaseModel
 
-from prompts import default_prompts
+from prompts import prompt_sets, fixed_replies
 from config import (
     assistant_id,
-    OPENAI_MODEL_CHAT,
-    OPENAI_MODEL_STRUCT,
     MAX_SQL_RETRIES,
-    HEAD_ROWS,
     CHAT_DOCS_DIR,
+    STAGE_TIMEOUT,
+    HISTORY_MAX_MESSAGES,
+    CONTEXT_UPDATE_WORKERS,
+    LOCAL_INTENT_CLASSIFIER,
+    PROMPT_MODE,
+    TRANSLATION_MEMORY,
+    LOCAL_DATAFRAME_OPS,
+    DECOMPOSITION,
+    DECOMPOSITION_MAX_PARTS,
     client,   
     )
 from structuredOutputs import (
     messageClassification,
     actionsRequired,
+    operationPlan,
+    questionDecomposition,
 )
+from code_extraction import code_from_run_steps, code_from_fenced_blocks
+from chart_data import PreparedChartData, data_sample, prepare_chart_data
+from image_variants import variant_pool
+from observability import runtime_stats
+from pipeline import Pipeline, Stage
+from conversation_state import ConversationState
+from intent_classifier import intent_classifier
+from translation_memory import translation_memory
+from response_templates import bad_flow_reply, result_reply
+from result_digest import digest, profile_column
+from dataframe_ops import PlanError, apply_plan, describe_plan, looks_like_transform
+from db_pool import SQLiteConnectionPool
+from decomposition import looks_multi_part, merge_frames
+from model_routing import model_routes
 
 # ───────────────────────────── CONFIG ───────────────────────────── #
 
@@ -47,6 +72,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger("agent")
 
+# Process-wide pool shared by every session, so agents leave no threads behind
+context_executor = ThreadPoolExecutor(max_workers=CONTEXT_UPDATE_WORKERS, thread_name_prefix="context")
+
 
 # ───────────────────────────── DATA CLASSES ─────────────────────── #
 
@@ -70,18 +98,37 @@ class LLM:
 
     # --- generic helpers -------------------------------------------------- #
 
-    def chat(self, messages: List[dict], model: str = OPENAI_MODEL_CHAT) -> str:
-        resp = self._client.chat.completions.create(model=model, messages=messages)
+    def chat(
+        self, messages: List[dict], model: str | None = None, stage: str | None = None
+    ) -> str:
+        route = model_routes.route(stage)
+        model = model or route.model
+        start = time.time()
+        resp = self._client.chat.completions.create(
+            model=model, messages=messages, timeout=route.timeout, **self._limits(route)
+        )
+        model_routes.record(stage, model, time.time() - start)
         return resp.choices[0].message.content.strip()
 
     def struct(
-        self, messages: List[dict], out_model: type[BaseModel]
+        self, messages: List[dict], out_model: type[BaseModel], stage: str | None = None
     ) -> BaseModel:
+        route = model_routes.route(stage, structured=True)
+        start = time.time()
         resp = self._client.beta.chat.completions.parse(
-            model=OPENAI_MODEL_STRUCT, messages=messages, response_format=out_model
+            model=route.model,
+            messages=messages,
+            response_format=out_model,
+            timeout=route.timeout,
+            **self._limits(route),
         )
+        model_routes.record(stage, route.model, time.time() - start)
         return resp.choices[0].message.parsed
 
+    @staticmethod
+    def _limits(route) -> Dict[str, int]:
+        return {"max_completion_tokens": route.max_tokens} if route.max_tokens else {}
+
 
 class FileManager:
     """All filesystem operations live here."""
@@ -106,6 +153,7 @@ class FileManager:
         path.write_bytes(data)
         self.counter["image"] += 1
         logger.info("Saved image to %s", path)
+        variant_pool.submit(path)  # thumbnail / webp generated in the background
         return path
 
     def save_code(self, code: str) -> Path:
@@ -118,21 +166,37 @@ class FileManager:
 
 # ───────────────────────────── AGENT CLASS ──────────────────────── #
 
+def _is_good(classification: messageClassification) -> bool:
+    return classification.is_on_topic and classification.is_context_sufficient
+
+
 class AgentChat:
     """Main façade orchestrating a single user session."""
 
     # ---------- construction ---------- #
 
-    def __init__(self, conn: sqlite3.Connection) -> None:
+    def __init__(self, conn: sqlite3.Connection, mode: str = PROMPT_MODE) -> None:
+        if mode not in prompt_sets:
+            raise ValueError(f"Unknown prompt mode '{mode}'")
         self.llm = LLM()
         self.conn = conn
+        self.db_pool = SQLiteConnectionPool.for_connection(conn)
         self.assistant_id = assistant_id
-        self.prompts = default_prompts
-        self.history: List[dict] = []
-        self.context: str = "There is no relevant context for this conversation."
+        self.mode = mode
+        self.prompts = prompt_sets[mode]
+        self.replies = fixed_replies[mode]
+        self.history: Deque[dict] = deque(maxlen=HISTORY_MAX_MESSAGES)
+        self.state = ConversationState()
         self.artefacts = Artefacts()
         self.base_path: Path = self._init_chat_dir()
         self.fs = FileManager(self.base_path)
+        translation_memory.add_names_from_db(conn)
+        self.context_future: Optional[Future] = None
+        self.pipeline = self._build_pipeline()
+
+    @property
+    def context(self) -> str:
+        return self.state.render()
 
     # ---------- public entry-point ---------- #
 
@@ -144,82 +208,145 @@ class AgentChat:
         logger.info("New user message received")
         logger.info("User message: %s", user_message)
 
-        # 1) Translate incoming Spanish → English
-        user_en = self._translate(user_message, src="spanish", tgt="english")
-        logger.info("Translated user message: %s", user_en)
+        run = self.pipeline.run_sync({"user_message": user_message})
+        state = run.state
+        logger.info("Stage timings: %s", run.timings())
 
-        # 2) Normalise into a clean request
-        request = self._to_request(user_en)
-        logger.info("Normalised request: %s", request)
+        if "reason" not in state:
+            # Update conversation state
+            self.history.append({"role": "assistant", "content": state["reply"]})
+            self.state.update(state["request"], self.artefacts, state["artefact_keys"])
+            if self.state.needs_summary(self._unsummarised_turns()):
+                self._schedule_context_update()
 
-        # 3) Classify request
-        classification: messageClassification = self._classify(request)
-        logger.info(
-            "Classification: on_topic=%s, context_sufficient=%s",
-            classification.is_on_topic,
-            classification.is_context_sufficient,
-        )
+        # Without translation stages the reply is already in Spanish
+        return state.get("response_es", state["reply"])
 
-        # 4.1) Bad flow
-        if not (classification.is_on_topic and classification.is_context_sufficient):
-            reason = (
-                "not_on_topic"
-                if not classification.is_on_topic
-                else "context_not_sufficient"
+    # ---------- pipeline ---------- #
+
+    def _build_pipeline(self) -> Pipeline:
+        """
+        Same graph as ImprovedAgentChat; the sync helpers run in worker
+        threads so classification / actions overlap, and the previous turn's
+        context update is awaited only by the stage that reads the context.
+        The "spanish" mode has no translation stages.
+        """
+        direct = self.mode == "spanish"
+        message_key = "user_message" if direct else "user_en"
+
+        stages = [] if direct else [
+            Stage("translate_in", partial(self._translate, src="spanish", tgt="english"),
+                  inputs=("user_message",), outputs=("user_en",), timeout=STAGE_TIMEOUT),
+        ]
+        stages += [
+            Stage("context", self._await_context,
+                  outputs=("context", "context_wait"), timeout=STAGE_TIMEOUT),
+            Stage("to_request", self._to_request,
+                  inputs=(message_key,), outputs=("request",), after=("context",),
+                  timeout=STAGE_TIMEOUT),
+            Stage("classify", self._classify,
+                  inputs=("request",), outputs=("classification",), timeout=STAGE_TIMEOUT),
+            Stage("get_actions", self._get_actions,
+                  inputs=("request",), outputs=("actions",), timeout=STAGE_TIMEOUT),
+            Stage("bad_flow", self._bad_flow_stage,
+                  inputs=("request", "classification"), outputs=("reply", "reason", "reply_lang"),
+                  when=lambda st: not _is_good(st["classification"]), timeout=STAGE_TIMEOUT),
+            Stage("good_flow", self._good_flow_stage,
+                  inputs=("request", "actions"), outputs=("reply", "artefact_keys", "reply_lang"),
+                  after=("classification",), when=lambda st: _is_good(st["classification"]),
+                  timeout=STAGE_TIMEOUT),
+        ]
+        if not direct:
+            # Template replies are already in Spanish
+            stages.append(
+                Stage("translate_out", partial(self._translate, src="english", tgt="spanish"),
+                      inputs=("reply",), outputs=("response_es",), after=("reply_lang",),
+                      when=lambda st: st["reply_lang"] != "spanish", timeout=STAGE_TIMEOUT)
             )
-            logger.info("Bad flow: %s", reason)
-            
-            reply_en = self._bad_flow(request, reason)
-            return self._translate(reply_en, src="english", tgt="spanish")
+        return Pipeline(stages)
+
+    # ---------- BAD FLOW ---------- #
 
-        # 4.2) Good flow
-        reply_en, interaction_summary = self._good_flow(request)
+    def _bad_flow_stage(
+        self, request: str, classification: messageClassification
+    ) -> Tuple[str, str, str]:
+        reason = (
+            "not_on_topic"
+            if not classification.is_on_topic
+            else "context_not_sufficient"
+        )
+        logger.info("Bad flow: %s", reason)
+        start = time.time()
+        reply = bad_flow_reply(reason) or self._bad_flow(request, reason)
+        self._record_branch(reason, reply, time.time() - start)
+        return reply, reason, self._reply_lang(reply)
 
-        # Update conversation state
-        self.history.append({"role": "assistant", "content": reply_en})
-        self._update_context(interaction_summary)
+    def _reply_lang(self, reply: str) -> str:
+        # template replies are Spanish; LLM replies follow the prompt mode
+        return getattr(reply, "lang", "spanish" if self.mode == "spanish" else "english")
 
-        # Final translation back to ES
-        return self._translate(reply_en, src="english", tgt="spanish")
+    def _record_branch(self, branch: str, reply: str, seconds: float) -> None:
+        source = getattr(reply, "source", "default")
+        runtime_stats.observe("branch_latency", f"{branch}.{source}", seconds)
+        logger.info("Branch %s (%s) took %.2fs", branch, source, seconds)
 
     # ---------- GOOD FLOW ---------- #
 
-    def _good_flow(self, request: str) -> Tuple[str, str]:
+    def _good_flow_stage(
+        self, request: str, actions: actionsRequired
+    ) -> Tuple[str, List[str], str]:
+        reply, keys = self._good_flow(request, actions)
+        return reply, keys, self._reply_lang(reply)
+
+    def _good_flow(
+        self, request: str, actions: actionsRequired | None = None
+    ) -> Tuple[str, List[str]]:
         """Dispatches to the right branch according to LLM-derived actions."""
         self.history.append({"role": "user", "content": request})
 
-        actions: actionsRequired = self._get_actions(request)
+        if actions is None:
+            actions = self._get_actions(request)
         logger.info(
             "Actions required: new_sql_query=%s, new_image=%s",
             actions.is_new_sql_query_needed,
             actions.is_new_image_needed,
         )
 
+        start = time.time()
         if not actions.is_new_sql_query_needed and not actions.is_new_image_needed:
-            return self._answer_only_branch(request)
-
-        if actions.is_new_image_needed and not actions.is_new_sql_query_needed:
-            return self._image_only_branch(request)
+            branch, result = "answer_only", self._answer_only_branch(request)
+        elif actions.is_new_image_needed and not actions.is_new_sql_query_needed and self.artefacts.data is not None:
+            branch, result = "image_only", self._image_only_branch(request)
+        else:
+            # follow-ups over the previous result skip the SQL round trip
+            branch, result = "dataframe_ops", self._dataframe_ops_branch(
+                request, also_image=actions.is_new_image_needed
+            )
+            if result is None:
+                branch, result = "data_refresh", self._data_refresh_branch(
+                    request, also_image=actions.is_new_image_needed
+                )
 
-        return self._data_refresh_branch(request, also_image=actions.is_new_image_needed)
+        self._record_branch(branch, result[0], time.time() - start)
+        return result
 
     # -- Branch helpers --
 
-    def _answer_only_branch(self, request: str) -> Tuple[str, str]:
+    def _answer_only_branch(self, request: str) -> Tuple[str, List[str]]:
         logger.info("Branch A – answer only (reuse artefacts)")
         final_answer = self._create_final_answer(
-            request, self.artefacts.data, self.artefacts.answer
+            request,
+            self.artefacts.data,
+            self.artefacts.answer,
+            source=self.artefacts.data_file,
         )
-        summary = self._record_artefacts({"answer": final_answer}, request, final_answer)
-        return final_answer, summary
+        return final_answer, self._record_artefacts({"answer": final_answer})
 
-    def _image_only_branch(self, request: str) -> Tuple[str, str]:
+    def _image_only_branch(self, request: str) -> Tuple[str, List[str]]:
         logger.info("Branch B – image only (reuse data)")
 
         img_bytes, code, img_path, code_path = self._run_python_image(
-            request,
-            self.artefacts.data.head(HEAD_ROWS).to_string(index=False),
-            self.artefacts.data_file,
+            request, self.artefacts.data, self.artefacts.data_file
         )
 
         art = {
@@ -228,19 +355,21 @@ class AgentChat:
             "image": img_bytes,
             "code": code,
         }
-        final_answer = "The image has been updated successfully."
-        summary = self._record_artefacts(art, request, final_answer)
-        return final_answer, summary
+        final_answer = self.replies["image_updated"]
+        return final_answer, self._record_artefacts(art)
 
     def _data_refresh_branch(
         self, request: str, *, also_image: bool
-    ) -> Tuple[str, str]:
+    ) -> Tuple[str, List[str]]:
         logger.info("Branch C – fresh SQL (image: %s)", also_image)
 
-        sql_query, df, data_path, ok = self._supervised_sql(request)
+        result = None
+        if DECOMPOSITION and looks_multi_part(request):
+            result = self._decomposed_sql(request)
+        sql_query, df, data_path, ok = result or self._supervised_sql(request)
         if not ok:
-            msg = "Sorry, I couldn't retrieve the requested data. Please try again."
-            return msg, "Data retrieval failed."
+            msg = self.replies["sql_failed"]
+            return msg, []
 
         art_dict = {
             "sql_query": sql_query,
@@ -250,9 +379,7 @@ class AgentChat:
 
         if also_image:
             img_bytes, code, img_path, code_path = self._run_python_image(
-                request,
-                df.head(HEAD_ROWS).to_string(index=False),
-                data_path,
+                request, df, data_path
             )
             art_dict.update(
                 {
@@ -263,58 +390,169 @@ class AgentChat:
                 }
             )
 
-        final_answer = self._create_final_answer(request, df)
-        summary = self._record_artefacts(art_dict, request, final_answer)
-        return final_answer, summary
-
-    # ---------- core LLM helpers ---------- #
-
-    def _translate(self, text: str, *, src: str, tgt: str) -> str:
-        msgs = self.prompts["translation"].copy()
+        final_answer = self._create_final_answer(
+            request, df, allow_template=True, source=data_path
+        )
+        return final_answer, self._record_artefacts(art_dict)
+
+    def _dataframe_ops_branch(
+        self, request: str, also_image: bool
+    ) -> Tuple[str, List[str]] | None:
+        """Transforms the previous result locally; None when new data is needed."""
+        current = self.artefacts.data
+        if not LOCAL_DATAFRAME_OPS or current is None or current.empty or not looks_like_transform(request):
+            return None
+
+        profile = "\n".join(profile_column(current[c]) for c in current.columns)
+        msgs = self.prompts["dataframe_ops"].copy()
         msgs.append(
             {
                 "role": "user",
-                "content": f"Translate the following text from {src} to {tgt}:\n{text}",
+                "content": (
+                    f"The user request is: {request}\n"
+                    f"The current data ({len(current)} rows) comes from: "
+                    f"{self.artefacts.sql_query}\n"
+                    f"Columns:\n{profile}\n"
+                    f"First rows:\n{data_sample(current)}"
+                ),
             }
         )
-        return self.llm.chat(msgs)
+        try:
+            plan = self.llm.struct(msgs, operationPlan, stage="dataframe_ops")
+            df = apply_plan(current, plan)
+        except PlanError as e:
+            runtime_stats.incr("dataframe_ops", "sql")
+            logger.info("Dataframe ops not applicable: %s", e)
+            return None
+        except Exception as e:
+            # the plan is optional; an API error or timeout just means SQL
+            runtime_stats.incr("dataframe_ops", "failed")
+            logger.warning("Dataframe ops failed, using SQL: %s", e)
+            return None
+        if df.empty:
+            # an empty local result is more likely a bad plan than an answer
+            runtime_stats.incr("dataframe_ops", "empty")
+            return None
+
+        runtime_stats.incr("dataframe_ops", "local")
+        logger.info("Branch C' – local dataframe ops: %s", describe_plan(plan))
+        data_path = self.fs.save_dataframe(df)
+        art_dict = {"data": df, "data_file": data_path}
+
+        if also_image:
+            img_bytes, code, img_path, code_path = self._run_python_image(
+                request, df, data_path
+            )
+            art_dict.update(
+                {
+                    "image_file": img_path,
+                    "code_file": code_path,
+                    "image": img_bytes,
+                    "code": code,
+                }
+            )
+
+        final_answer = self._create_final_answer(
+            request, df, allow_template=True, source=data_path
+        )
+        return final_answer, self._record_artefacts(art_dict)
+
+    # ---------- core LLM helpers ---------- #
+
+    def _translate(self, text: str, *, src: str, tgt: str) -> str:
+        if not TRANSLATION_MEMORY:
+            return self._translate_llm(text, src=src, tgt=tgt)
+
+        cached = translation_memory.lookup(text, src, tgt)
+        if cached is not None:
+            logger.info("Translation memory hit (%s -> %s)", src, tgt)
+            return cached
+
+        start = time.time()
+        translation = self._translate_llm(
+            text, src=src, tgt=tgt, hint=translation_memory.glossary_hint(text, src, tgt)
+        )
+        translation_memory.store(text, src, tgt, translation, time.time() - start)
+        return translation
+
+    def _translate_llm(self, text: str, *, src: str, tgt: str, hint: str = "") -> str:
+        msgs = self.prompts["translation"].copy()
+        content = f"Translate the following text from {src} to {tgt}:\n{text}"
+        if hint:
+            content += f"\n{hint}"
+        msgs.append({"role": "user", "content": content})
+        return self.llm.chat(msgs, stage="translation")
 
-    def _to_request(self, user_en: str) -> str:
+    def _to_request(self, user_msg: str) -> str:
         msgs = self.prompts["message_to_request"].copy()
         msgs.append(
             {
                 "role": "user",
                 "content": (
                     f"The conversation context is: {self.context}\n"
-                    f"The user message is: {user_en}.\n"
+                    f"The user message is: {user_msg}.\n"
                     "Explain what the user wants in a clear, straightforward way."
                 ),
             }
         )
-        return self.llm.chat(msgs)
+        return self.llm.chat(msgs, stage="message_to_request")
 
     def _classify(self, request: str) -> messageClassification:
-        msgs = self.prompts["classification"].copy()
-        msgs.append({"role": "user", "content": request})
-        return self.llm.struct(msgs, messageClassification)
+        return self._structured_intent("classification", request, messageClassification)
 
     def _get_actions(self, request: str) -> actionsRequired:
-        msgs = self.prompts["actions"].copy()
+        return self._structured_intent("actions", request, actionsRequired)
+
+    def _structured_intent(self, kind: str, request: str, out_model: type[BaseModel]) -> BaseModel:
+        """Local intent classifier when confident, the structured LLM call otherwise"""
+        msgs = self.prompts[kind].copy()
         msgs.append({"role": "user", "content": request})
-        return self.llm.struct(msgs, actionsRequired)
+        if not LOCAL_INTENT_CLASSIFIER:
+            return self.llm.struct(msgs, out_model, stage=kind)
+
+        has_data = self.artefacts.data is not None
+        local, guessed = intent_classifier.guess(kind, request, has_data)
+        if local is not None:
+            logger.info("Intent '%s' answered locally: %s", kind, local)
+            return local
+
+        result = self.llm.struct(msgs, out_model, stage=kind)
+        intent_classifier.record(kind, request, result, guessed, has_data)
+        return result
 
     def _bad_flow(self, request: str, reason_key: str) -> str:
         msgs = self.prompts[reason_key].copy()
         msgs.append({"role": "user", "content": request})
-        return self.llm.chat(msgs)
+        return self.llm.chat(msgs, stage=reason_key)
 
     def _create_final_answer(
-        self, request: str, df: pd.DataFrame, prev_answer: str | None = None
+        self,
+        request: str,
+        df: pd.DataFrame,
+        prev_answer: str | None = None,
+        allow_template: bool = False,
+        source: Path | None = None,
     ) -> str:
+        # fresh empty / scalar / tiny results are answered from a template
+        if allow_template and prev_answer is None:
+            local = result_reply(df)
+            if local is not None:
+                return local
+
+        # large results go in as profiles + a sample; the full table stays on disk
+        result = digest(df, source=source)
+        runtime_stats.incr("result_digest", "full" if result.full else "digest")
+        logger.info(
+            "Result digest: %d rows, %d sampled, ~%d tokens",
+            result.rows,
+            result.sample_rows,
+            result.tokens,
+        )
+
         msgs = self.prompts["final_answer"].copy()
         user_msg = (
             f"The user request is: {request}\n"
-            f"The data from the query is:\n{df.to_string(index=False)}.\n"
+            f"The data from the query is:\n{result.text}.\n"
         )
         logger.debug("messages: %s", user_msg)
         if prev_answer:
@@ -323,54 +561,73 @@ class AgentChat:
             "Create a final answer for the user based on the request and the data."
         )
         msgs.append({"role": "user", "content": user_msg})
-        return self.llm.chat(msgs)
+        return self.llm.chat(msgs, stage="final_answer")
 
     # ---------- context / history ---------- #
 
-    def _record_artefacts(
-        self, new_items: Dict[str, object], request: str, answer: str
-    ) -> str:
-        # merge new items into dataclass
+    def _record_artefacts(self, new_items: Dict[str, object]) -> List[str]:
+        # merge new items into dataclass; the keys feed the conversation state
         for k, v in new_items.items():
             setattr(self.artefacts, k, v)
-
-        summary = self._summarise_interaction(request, answer, new_items.keys())
-        logger.info("Interaction summarised")
-        return summary
-
-    def _summarise_interaction(
-        self, user_msg: str, assistant_msg: str, artefact_keys
-    ) -> str:
-        art = ", ".join(k for k in artefact_keys if k != "answer") or "none"
-        msgs = self.prompts["summarize_interaction"].copy()
-        msgs.append(
-            {
-                "role": "user",
-                "content": (
-                    f"The user message is: {user_msg}\n"
-                    f"The assistant message is: {assistant_msg}.\n"
-                    f"Artefacts created: {art}. Summarise the interaction."
-                ),
-            }
-        )
-        return self.llm.chat(msgs)
-
-    def _update_context(self, new_summary: str) -> None:
+        return list(new_items.keys())
+
+    def _schedule_context_update(self) -> Future:
+        """Summarise the recent turns after the reply is returned"""
+        previous = self.context_future
+
+        def job() -> None:
+            try:
+                if previous is not None:
+                    previous.result()  # keep this session's updates in turn order
+                self._summarise_context()
+            except Exception as e:
+                runtime_stats.incr("context_update", "failed")
+                logger.warning("Context update failed: %s", e)
+
+        self.context_future = context_executor.submit(job)
+        runtime_stats.incr("context_update", "scheduled")
+        return self.context_future
+
+    def _await_context(self) -> Tuple[str, float]:
+        """Return the context, waiting for the previous update only if still running"""
+        future, waited = self.context_future, 0.0
+        if future is None:
+            return self.context, waited
+
+        if future.done():
+            runtime_stats.incr("context_update", "ready")
+        else:
+            wait_start = time.time()
+            future.result()
+            waited = time.time() - wait_start
+            runtime_stats.incr("context_update", "waited")
+            runtime_stats.incr("context_update", "wait_ms", int(waited * 1000))
+            logger.info("Waited %.2fs for context update", waited)
+
+        self.context_future = None
+        return self.context, waited
+
+    def _unsummarised_turns(self) -> str:
+        n = self.state.turns_since_summary
+        recent = list(self.history)[-2 * n:] if n else []
+        return "\n".join(f"{m['role']}: {m['content']}" for m in recent)
+
+    def _summarise_context(self) -> None:
+        turns = self.state.turns_since_summary
         msgs = self.prompts["update_context"].copy()
         msgs.append(
             {
                 "role": "user",
                 "content": (
-                    f"Previous context: {self.context}\n"
-                    f"New interaction summary: {new_summary}.\n"
+                    f"Previous context: {self.state.summary or 'none'}\n"
+                    f"Recent interactions:\n{self._unsummarised_turns()}\n"
                     "Update the context accordingly."
                 ),
             }
         )
-        logger.info("Previous Context: %s", self.context)
-        self.context = self.llm.chat(msgs)
-        logger.info("New Context: %s", self.context)
-        logger.info("Context updated.")
+        summary = self.llm.chat(msgs, stage="update_context")
+        self.state.apply_summary(summary, turns)
+        logger.info("Context summarised over %d turns: %s", turns, summary)
 
     # ---------- SQL path ---------- #
 
@@ -392,6 +649,61 @@ class AgentChat:
         logger.error("SQL failed after %d attempts", MAX_SQL_RETRIES)
         return "", pd.DataFrame(), None, False
 
+    def _decomposed_sql(
+        self, request: str
+    ) -> Tuple[str, pd.DataFrame, Optional[Path], bool] | None:
+        """Sub-questions queried concurrently and merged; None to use a single query."""
+        msgs = self.prompts["decomposition"].copy()
+        msgs.append({"role": "user", "content": f"The request is: {request}"})
+        try:
+            plan = self.llm.struct(msgs, questionDecomposition, stage="decomposition")
+        except Exception as e:
+            # splitting is optional; the single query still answers the request
+            runtime_stats.incr("decomposition", "failed")
+            logger.warning("Decomposition failed, using a single query: %s", e)
+            return None
+        questions = (
+            list(plan.sub_questions)[:DECOMPOSITION_MAX_PARTS]
+            if plan.is_multi_part is True
+            else []
+        )
+        if len(questions) < 2:
+            runtime_stats.incr("decomposition", "single")
+            return None
+
+        with ThreadPoolExecutor(max_workers=len(questions)) as pool:
+            results = list(pool.map(self._sub_query, questions))
+        for _, df, seconds in results:
+            logger.info("Sub-query: %d rows in %.2fs", len(df), seconds)
+
+        # a missing part would silently drop half the comparison
+        merged = None
+        if all(not df.empty for _, df, _ in results):
+            merged = merge_frames([df for _, df, _ in results], plan.join_keys)
+        if merged is None:
+            runtime_stats.incr("decomposition", "unmerged")
+            logger.warning("Sub-query results could not be merged")
+            return None
+
+        runtime_stats.incr("decomposition", "merged")
+        sql_query = ";\n".join(sql for sql, _, _ in results)
+        return sql_query, merged, self.fs.save_dataframe(merged), True
+
+    def _sub_query(self, question: str) -> Tuple[str, pd.DataFrame, float]:
+        start = time.time()
+        sql_query, df = "", pd.DataFrame()
+        for attempt in range(1, MAX_SQL_RETRIES + 1):
+            logger.info("Sub-query attempt %d/%d: %s", attempt, MAX_SQL_RETRIES, question)
+            try:
+                sql_query, df = self._single_sql_round(question, sql_query)
+            except Exception as e:
+                # an empty part makes the caller fall back to a single query
+                logger.warning("Sub-query attempt %d failed: %s", attempt, e)
+                continue
+            if not df.empty:
+                break
+        return sql_query, df, time.time() - start
+
     def _single_sql_round(self, request: str, previous_query: str):
         # 1) question →
         msgs = self.prompts["message_to_simple_question"].copy()
@@ -404,7 +716,7 @@ class AgentChat:
                 ),
             }
         )
-        simple_q = self.llm.chat(msgs)
+        simple_q = self.llm.chat(msgs, stage="message_to_simple_question")
         logger.info("Simple question: %s", simple_q)
 
         # 2) simple q → SQL
@@ -415,12 +727,12 @@ class AgentChat:
             else f"{simple_q}\nConsider that the previous query failed: {previous_query}"
         )
         msgs.append({"role": "user", "content": content})
-        sql_query = self.llm.chat(msgs)
+        sql_query = self.llm.chat(msgs, stage="sql_query")
         logger.info("SQL query: %s", sql_query)
 
         # 3) run SQL
         try:
-            df = pd.read_sql_query(sql_query, self.conn)
+            df = self.db_pool.read_sql(sql_query)
         except Exception as exc:  # noqa: BLE001
             logger.warning("SQL execution error: %s", exc)
             df = pd.DataFrame()
@@ -431,24 +743,33 @@ class AgentChat:
 
     # (identical to original logic but reorganised for clarity)
     def _run_python_image(
-        self, request: str, data_sample: str, data_filename: Path
+        self, request: str, df: pd.DataFrame, data_filename: Path
     ) -> Tuple[bytes, str, Path, Path]:
-        # upload CSV
-        file_id = self._upload_file_openai(data_filename)
-        logger.info("Uploaded file to OpenAI (%s)", file_id)
-
         # LLM: turn request into plotting instructions
-        instr = self._request_to_image_instr(request, data_sample)
+        instr = self._request_to_image_instr(request, data_sample(df))
         logger.info("Image instructions: %s", instr)
 
+        # project / downcast the data and upload the compact copy
+        prepared = prepare_chart_data(df, data_filename, instr, request)
+        file_id = self._upload_file_openai(prepared)
+        logger.info("Uploaded file to OpenAI (%s)", file_id)
+
         # ask assistant to run code / create image
-        msgs = self._create_image(instr, file_id)
-        img_bytes, code, img_path, code_path = self._extract_code_and_image(msgs)
+        msgs, steps = self._create_image(f"{instr}\n{prepared.description}", file_id)
+        img_bytes, code, img_path, code_path = self._extract_code_and_image(msgs, steps)
         return img_bytes, code, img_path, code_path
 
-    def _upload_file_openai(self, csv_path: Path) -> str:
-        file_obj = self.llm._client.files.create(
-            file=open(csv_path, "rb"), purpose="assistants"
+    def _upload_file_openai(self, prepared: PreparedChartData) -> str:
+        start = time.time()
+        with open(prepared.path, "rb") as fh:
+            file_obj = self.llm._client.files.create(file=fh, purpose="assistants")
+        logger.info(
+            "Upload: %s columns=%s, %d -> %d bytes in %.2fs",
+            prepared.format,
+            prepared.columns,
+            prepared.original_bytes,
+            prepared.upload_bytes,
+            time.time() - start,
         )
         return file_obj.id
 
@@ -463,7 +784,7 @@ class AgentChat:
                 ),
             }
         )
-        return self.llm.chat(msgs)
+        return self.llm.chat(msgs, stage="message_to_image_instruction")
 
     def _create_image(self, instructions: str, file_id: str):
         thread = self.llm._client.beta.threads.create(
@@ -484,7 +805,12 @@ class AgentChat:
             assistant_id=self.assistant_id,
             instructions=instructions,
         )
-        return self._wait_for_run(run, thread.id)
+        msgs = self._wait_for_run(run, thread.id)
+        # the run steps hold the exact code executed by the code interpreter
+        steps = self.llm._client.beta.threads.runs.steps.list(
+            thread_id=thread.id, run_id=run.id, order="asc"
+        ).data
+        return msgs, steps
 
     def _wait_for_run(self, run, thread_id: str):
         while True:
@@ -499,7 +825,7 @@ class AgentChat:
                 # wait for 5 seconds before checking again
             time.sleep(10)
 
-    def _extract_code_and_image(self, messages: List[dict]):
+    def _extract_code_and_image(self, messages: List[dict], steps: List = ()):
         image_msg = messages[0]
         code_msg = messages[1]
 
@@ -510,15 +836,27 @@ class AgentChat:
 
         # isolate python code
         raw_code = code_msg.content[0].text.value
-        code = self._filter_code(raw_code)
+        code = self._extract_code(steps, raw_code)
         code_path = self.fs.save_code(code)
 
         return img_bytes, code, img_path, code_path
 
+    def _extract_code(self, steps, raw_text: str) -> str:
+        """Run steps first, then fenced blocks; the LLM only when both fail."""
+        code, path = code_from_run_steps(steps), "run_steps"
+        if code is None:
+            code, path = code_from_fenced_blocks(raw_text), "fenced_block"
+        if code is None:
+            code, path = self._filter_code(raw_text), "llm"
+
+        runtime_stats.incr("code_extraction", path)
+        logger.info("Code extracted via %s", path)
+        return code
+
     def _filter_code(self, text: str) -> str:
         msgs = self.prompts["message_to_code_extraction"].copy()
         msgs.append({"role": "user", "content": f"Extract the code from:\n{text}"})
-        return self.llm.chat(msgs)
+        return self.llm.chat(msgs, stage="message_to_code_extraction")
 
     # ---------- private helpers ---------- #
 
@@ -10,6 +10,7 @@ from openai import OpenAI
 
 # ✨ BACKEND ─ import the class you refactored earlier
 from agent import AgentChat   # adjust the path / name if different
+from image_variants import variant_path
 
 
 # ───────────────────────────── Helpers ──────────────────────────────
@@ -18,6 +19,12 @@ def init_agent(conn) -> AgentChat:
     return AgentChat(conn = conn)
 
 
+@st.cache_data(show_spinner=False)
+def read_bytes(path: str) -> bytes:
+    """Artefact files are never rewritten, so reruns can reuse the bytes."""
+    return Path(path).read_bytes()
+
+
 # ───────────────────────── sidebar renderer (new) ─────────────────────────
 def render_sidebar(artifacts):
     """Show the latest artefacts in the sidebar with smaller fonts."""
@@ -45,13 +52,15 @@ def render_sidebar(artifacts):
     # ── 2 ▸ IMAGE ────────────────────────────────────────────────────
     if artifacts.image_file:
         st.sidebar.markdown('<div class="sb-title">🖼️ Image</div>', unsafe_allow_html=True)
-        st.sidebar.image(str(artifacts.image_file))
-        with open(artifacts.image_file, "rb") as fh:
-            st.sidebar.download_button(
-                "Download image", fh.read(),
-                file_name=artifacts.image_file.name, mime="image/png",
-                key=f"dl_image_{artifacts.image_file.name}",
-            )
+        # small thumbnail in the sidebar; full-size only on download
+        thumb = variant_path(artifacts.image_file, "thumb")
+        preview = thumb if thumb.exists() else artifacts.image_file
+        st.sidebar.image(read_bytes(str(preview)))
+        st.sidebar.download_button(
+            "Download image", read_bytes(str(artifacts.image_file)),
+            file_name=artifacts.image_file.name, mime="image/png",
+            key=f"dl_image_{artifacts.image_file.name}",
+        )
 
     # ── 3 ▸ DATA ─────────────────────────────────────────────────────
     if artifacts.data_file:
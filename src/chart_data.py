@@ -0,0 +1,176 @@
+"""
+Preparation of the data handed to the chart generator.
+
+Only the columns referenced by the chart instructions are kept (all of them
+when a reference cannot be resolved), and the result is written in a compact
+format next to the original `data_N.csv` before it is uploaded. For Parquet,
+numeric and low-cardinality text columns are also downcast where that loses
+nothing; CSV text (plain or zipped) is the same size whatever the dtypes.
+"""
+
+from __future__ import annotations
+
+import io
+import re
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List
+
+import pandas as pd
+
+from config import CHART_UPLOAD_FORMAT, HEAD_ROWS
+
+# Text columns with at most this share of distinct values become categoricals
+CATEGORY_RATIO = 0.5
+
+
+@dataclass
+class PreparedChartData:
+    """Compact copy of a DataFrame ready to be uploaded for charting"""
+    path: Path
+    columns: List[str]
+    format: str
+    original_bytes: int
+    upload_bytes: int
+
+    @property
+    def description(self) -> str:
+        """How the attached file should be read by the code interpreter"""
+        if self.format == "zip":
+            return f"The attached file is a zip archive containing {self.path.stem}.csv."
+        if self.format == "parquet":
+            return "The attached file is a Parquet file; read it with pandas.read_parquet."
+        return "The attached file is a CSV file."
+
+
+def infer_chart_columns(columns: Iterable[str], *texts: str) -> List[str]:
+    """Columns mentioned (verbatim or with spaces for underscores) in the given texts"""
+    haystack = " ".join(t for t in texts if t).lower()
+    found = []
+    for col in columns:
+        name = str(col).lower()
+        variants = {name, name.replace("_", " ")}
+        if any(re.search(rf"(?<![\w]){re.escape(v)}(?![\w])", haystack) for v in variants):
+            found.append(col)
+    return found
+
+
+# snake_case / camelCase tokens and `quoted` names are treated as column references
+_IDENTIFIER = re.compile(r"`([^`]+)`|\b([A-Za-z]+(?:_[A-Za-z0-9]+)+|[a-z]+[A-Z][A-Za-z0-9]*)\b")
+
+
+def _name_words(name: str) -> set:
+    """Words of a column name: `downtime_hours` -> {downtime, hours}, `UnitId` -> {unit, id}"""
+    spaced = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(name))
+    return {w.lower().rstrip("s") for w in re.split(r"[^A-Za-z0-9]+", spaced) if len(w) >= 3}
+
+
+def chart_columns(columns: Iterable[str], *texts: str) -> List[str]:
+    """
+    Columns to upload for a chart described by `texts`: those named verbatim
+    or sharing a word with the text ("downtime" keeps `downtime_hours`). Every
+    column is kept when nothing matches, or when the text names an identifier
+    that is not a column, since the chart code may need more than was matched.
+    """
+    columns = list(columns)
+    haystack = " ".join(t for t in texts if t)
+    actual = {str(c).lower() for c in columns}
+    mentioned = {(quoted or bare).lower() for quoted, bare in _IDENTIFIER.findall(haystack)}
+    if mentioned - actual:
+        return columns
+
+    words = {w.rstrip("s") for w in re.findall(r"[a-z0-9]+", haystack.lower()) if len(w) >= 3}
+    exact = set(infer_chart_columns(columns, haystack))
+    found = [c for c in columns if c in exact or _name_words(c) & words]
+    return found or columns
+
+
+def instructions_fit_columns(
+    instructions: str, columns: Iterable[str], predicted: Iterable[str] = ()
+) -> bool:
+    """
+    Whether chart instructions written before the data existed can be used for
+    a frame with `columns`: every column-like identifier they mention, and
+    every predicted column they rely on, must exist in the real frame.
+    """
+    actual = {str(c).lower() for c in columns}
+    mentioned = {(quoted or bare).lower() for quoted, bare in _IDENTIFIER.findall(instructions or "")}
+    mentioned |= {str(c).lower() for c in infer_chart_columns(predicted, instructions)}
+    return mentioned <= actual
+
+
+def downcast_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Smallest numeric dtypes and categoricals for repetitive text columns"""
+    out = df.copy()
+    for col in out.columns:
+        series = out[col]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            out[col] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series):
+            narrow = pd.to_numeric(series, downcast="float")
+            # Only when every value survives the round trip
+            if narrow.astype(series.dtype).equals(series):
+                out[col] = narrow
+        elif pd.api.types.is_object_dtype(series) and len(series) > 0:
+            if series.nunique(dropna=True) <= CATEGORY_RATIO * len(series):
+                out[col] = series.astype("category")
+    return out
+
+
+def data_sample(df: pd.DataFrame, rows: int = HEAD_ROWS) -> str:
+    """Compact CSV sample of the first rows, used in the chart-instruction prompt"""
+    return df.head(rows).to_csv(index=False)
+
+
+def _parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def prepare_chart_data(
+    df: pd.DataFrame,
+    source: Path,
+    *texts: str,
+    fmt: str = CHART_UPLOAD_FORMAT,
+) -> PreparedChartData:
+    """
+    Project `df` onto the columns referenced in `texts` (see `chart_columns`)
+    and write it next to `source` in `fmt` ("zip", "parquet" or "csv"),
+    falling back to zip when pyarrow is missing. Only Parquet is downcast.
+    """
+    columns = chart_columns(df.columns, *texts)
+    frame = df[columns]
+
+    if fmt == "parquet" and not _parquet_available():
+        fmt = "zip"
+
+    if fmt == "parquet":
+        frame = downcast_frame(frame)
+        path = source.with_suffix(".chart.parquet")
+        frame.to_parquet(path, index=False)
+    else:
+        csv_text = frame.to_csv(index=False)
+        if fmt == "zip":
+            path = source.with_suffix(".chart.zip")
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(f"{path.stem}.csv", csv_text)
+            path.write_bytes(buffer.getvalue())
+        else:
+            path = source.with_suffix(".chart.csv")
+            path.write_text(csv_text)
+
+    original = source.stat().st_size if source.exists() else 0
+    return PreparedChartData(
+        path=path,
+        columns=[str(c) for c in columns],
+        format=fmt,
+        original_bytes=original,
+        upload_bytes=path.stat().st_size,
+    )
@@ -0,0 +1,44 @@
+"""
+Local extraction of the Python code behind a generated chart.
+
+The code-interpreter run steps already hold the exact code that was executed,
+so they are read first; fenced code blocks in the assistant message are the
+fallback. Callers only need the LLM extraction prompt when both return None.
+"""
+
+import ast
+import re
+from typing import Iterable, Optional
+
+FENCED_BLOCK = re.compile(r"```[ \t]*(?:python|py)?[ \t]*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+def _is_python(code: str) -> bool:
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return False
+    return True
+
+
+def code_from_run_steps(steps: Iterable) -> Optional[str]:
+    """Concatenate the code_interpreter inputs of a run, in execution order"""
+    chunks = []
+    for step in steps or []:
+        details = getattr(step, "step_details", None)
+        if getattr(details, "type", None) != "tool_calls":
+            continue
+        for call in details.tool_calls:
+            if getattr(call, "type", None) != "code_interpreter":
+                continue
+            code = (call.code_interpreter.input or "").strip()
+            if code:
+                chunks.append(code)
+    return "\n\n".join(chunks) or None
+
+
+def code_from_fenced_blocks(text: str) -> Optional[str]:
+    """Concatenate the fenced blocks of a message that parse as Python"""
+    blocks = [block.strip() for block in FENCED_BLOCK.findall(text or "")]
+    valid = [block for block in blocks if block and _is_python(block)]
+    return "\n\n".join(valid) or None
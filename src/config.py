@@ -1,16 +1,116 @@
+import os
 from pathlib import Path
 import sqlite3
 from dotenv import load_dotenv
 from openai import OpenAI
 
+load_dotenv()
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    """Boolean switch from the environment: 1 / true / yes turn it on, anything else off"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes")
+
+
 assistant_id = 'asst_feuOGXexFv0jk8EVDs4kR50E'
 
-OPENAI_MODEL_CHAT = "gpt-4o-mini"
-OPENAI_MODEL_STRUCT = "o3-mini"
-MAX_SQL_RETRIES = 3
-HEAD_ROWS = 5
+OPENAI_MODEL_CHAT = os.getenv("OPENAI_MODEL_CHAT", "gpt-4o-mini")
+OPENAI_MODEL_STRUCT = os.getenv("OPENAI_MODEL_STRUCT", "o3-mini")
+OPENAI_MODEL_CHAT_FAST = os.getenv("OPENAI_MODEL_CHAT_FAST", "gpt-4o-mini")  # used by the "fast" latency profile
+OPENAI_MODEL_STRUCT_FAST = os.getenv("OPENAI_MODEL_STRUCT_FAST", "gpt-4o-mini")
+MAX_SQL_RETRIES = int(os.getenv("MAX_SQL_RETRIES", "3"))
+HEAD_ROWS = int(os.getenv("HEAD_ROWS", "5"))
 CHAT_DOCS_DIR = Path("chat_docs")
+MAX_CONCURRENT_IMAGES = int(os.getenv("MAX_CONCURRENT_IMAGES", "2"))
+IMAGE_WAIT_TIMEOUT = 60.0
+CHART_UPLOAD_FORMAT = "zip"  # zip | parquet | csv
+IMAGE_THUMBNAIL_SIZE = 320
+IMAGE_VARIANT_WORKERS = 2
+WEBP_QUALITY = 80
+SPECULATIVE_CHART_INSTRUCTIONS = _env_flag("SPECULATIVE_CHART_INSTRUCTIONS", True)
+STAGE_TIMEOUT = 180.0  # seconds, per pipeline stage
+HISTORY_MAX_MESSAGES = 20
+CONTEXT_SUMMARY_EVERY = 5  # turns between LLM context summaries
+CONTEXT_TOKEN_BUDGET = 600  # unsummarised turns allowed before an early summary
+CONTEXT_UPDATE_WORKERS = 4  # threads summarising context for the synchronous agent, shared by every session
+LOCAL_INTENT_CLASSIFIER = _env_flag("LOCAL_INTENT_CLASSIFIER", True)
+INTENT_MODEL_PATH = Path("models/intent_nb.npz")
+INTENT_LOG_PATH = CHAT_DOCS_DIR / "intent_log.jsonl"
+INTENT_CONFIDENCE = 0.9
+INTENT_MIN_SAMPLES = 50  # per label, before the model is trusted
+INTENT_SHADOW_RATE = 0.05  # share of local answers re-checked by the LLM
+TRANSLATION_MEMORY = _env_flag("TRANSLATION_MEMORY", True)
+TRANSLATION_MEMORY_PATH = CHAT_DOCS_DIR / "translation_memory.db"
+TRANSLATION_MEMORY_MAX_CHARS = 120  # longer texts rarely recur and are not stored
+RESULT_DIGEST_TOKENS = 1500  # budget for the query result in the final-answer prompt
+RESULT_DIGEST_FULL_ROWS = 50  # smaller results are sent whole when they fit the budget
+RESULT_DIGEST_TOP_K = 5
+LOCAL_DATAFRAME_OPS = _env_flag("LOCAL_DATAFRAME_OPS", True)  # follow-ups over the previous result run locally instead of SQL
+SQL_POOL_SIZE = 4  # read-only connections per database
+DECOMPOSITION = _env_flag("DECOMPOSITION", True)  # split multi-part requests into concurrent sub-queries
+DECOMPOSITION_MAX_PARTS = 4
 
-load_dotenv()
+# "translate": translate around the English prompts; "spanish": answer in Spanish directly
+PROMPT_MODE = os.getenv("PROMPT_MODE", "translate")
+
+# Local Spanish replies instead of LLM calls: any of "bad_flow", "scalar", "table" (comma separated)
+RESPONSE_TEMPLATES = {t.strip() for t in os.getenv("RESPONSE_TEMPLATES", "bad_flow,scalar,table").split(",") if t.strip()}
+TEMPLATE_MAX_ROWS = 5
+TEMPLATE_MAX_COLS = 3
+
+# Default latency profile: "fast", "balanced" or "thorough" (no budget)
+LATENCY_PROFILE = os.getenv("LATENCY_PROFILE", "thorough")
+
+# Per-stage model routes: JSON file, overridden by MODEL_ROUTE_<STAGE>_<FIELD> variables
+MODEL_ROUTES_FILE = os.getenv("MODEL_ROUTES_FILE")
+# Models from cheapest to most expensive, for SLO-based recommendations
+MODEL_COST_ORDER = [m.strip() for m in os.getenv("MODEL_COST_ORDER", "gpt-4o-mini,o3-mini,gpt-4o").split(",") if m.strip()]
+
+# API session store: idle or least recently used sessions are spilled to disk and rehydrated on access
+SESSION_MAX = 100  # sessions kept in memory
+SESSION_MAX_BYTES = 512 * 1024 ** 2  # estimated memory of the sessions kept in memory
+SESSION_IDLE_TTL = 1800.0  # seconds without a request before a session is spilled
+SESSION_SPILL_DIR = CHAT_DOCS_DIR / "sessions"
+SESSION_SPILL_TTL = 24 * 3600.0  # stored sessions older than this are deleted
+SESSION_SWEEP_INTERVAL = 60.0
+# "file": spill files private to the process; "sqlite": one store shared by every worker on the host
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "file")
+SESSION_DB_PATH = Path(os.getenv("SESSION_DB_PATH", str(CHAT_DOCS_DIR / "sessions.db")))
+SESSION_LEASE_TTL = 600.0  # seconds a turn may hold its session before the lease expires
+SESSION_LOCK_TIMEOUT = 30.0  # seconds to wait for a session held by another request or worker
+# Concurrent turns of one session: "queue" runs them in arrival order, "reject" answers 409 while one is running
+SESSION_BUSY_POLICY = os.getenv("SESSION_BUSY_POLICY", "queue")
+# Result frame in session snapshots: "auto" (arrow if pyarrow is installed, else pickle), "arrow", "pickle", "file"
+SNAPSHOT_FRAME_CODEC = "auto"
+
+# Background jobs (/v1/jobs): queued turns run by a fixed pool of workers, results kept for a while
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # turns run concurrently from /v1/jobs
+JOB_MAX_QUEUED = 100  # jobs waiting for a worker before POST /v1/jobs answers 503
+JOB_RESULT_TTL = 600.0  # seconds a finished job's result can still be fetched
+JOB_MAX_WAIT = 25.0  # longest long-poll, below the proxy's read timeout (nginx: 60 s)
+
+# Admission control: turns running at once per worker, and how many may wait for a slot (and for how long)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))  # beyond this: 429
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))  # waited longer: 503
+
+# Process-wide OpenAI HTTP pool (FastAPI service)
+OPENAI_MAX_CONNECTIONS = 50
+OPENAI_MAX_KEEPALIVE = 20
+OPENAI_KEEPALIVE_EXPIRY = 120.0  # seconds an idle connection is kept
+OPENAI_HTTP2 = True  # used when the h2 package is installed
+OPENAI_POOL_WARM = 2  # connections opened at startup
+
+# Hedged LLM calls: a duplicate request after the stage's observed p95, first response wins
+LLM_HEDGING = _env_flag("LLM_HEDGING", False)
+HEDGE_MIN_DELAY_MS = 250  # never hedge sooner than this
+# Circuit breaker per model: open at this failure rate over the last calls, probe again after the cooldown
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_CALLS = 8
+CIRCUIT_FAILURE_RATE = 0.5
+CIRCUIT_COOLDOWN = 30.0  # seconds
 
 client = OpenAI()
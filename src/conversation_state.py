@@ -0,0 +1,137 @@
+"""
+Structured conversation state shared by both agents.
+
+The state is updated deterministically from the turn's `Artefacts` (last SQL,
+result columns, WHERE filters, entities, artefact files) and rendered compactly
+into prompts. An LLM summary of the recent turns is folded in only every
+CONTEXT_SUMMARY_EVERY turns or when the unsummarised turns exceed
+CONTEXT_TOKEN_BUDGET.
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import CONTEXT_SUMMARY_EVERY, CONTEXT_TOKEN_BUDGET
+
+EMPTY_CONTEXT = "There is no relevant context for this conversation."
+MAX_ENTITIES = 10
+MAX_SQL_CHARS = 400
+
+# Unit identifiers follow the "T_XX" convention of maintenance_cycle.UnitId
+_UNIT_ID = re.compile(r"\bT_\d+\b", re.IGNORECASE)
+_WHERE = re.compile(
+    r"\bWHERE\b(.*?)(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bHAVING\b|\bLIMIT\b|\bUNION\b|\)|;|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+_AND = re.compile(r"\s+AND\s+", re.IGNORECASE)
+_LITERAL = re.compile(r"'([^']{1,60})'")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1 if text else 0
+
+
+def sql_filters(sql: str) -> List[str]:
+    """Conditions of every WHERE clause in `sql`, split on top-level ANDs"""
+    filters: List[str] = []
+    for clause in _WHERE.findall(sql or ""):
+        parts = _AND.split(" ".join(clause.split()))
+        merged: List[str] = []
+        for part in parts:
+            # "x BETWEEN a AND b" is one condition
+            if merged and re.search(r"\bBETWEEN\s+\S+$", merged[-1], re.IGNORECASE):
+                merged[-1] = f"{merged[-1]} AND {part}"
+            else:
+                merged.append(part)
+        filters.extend(p for p in merged if p)
+    return filters
+
+
+def extract_entities(*texts: str) -> List[str]:
+    """Unit ids and quoted literals (system / component names, dates, ...) in order of appearance"""
+    found: List[str] = []
+    for text in texts:
+        if not text:
+            continue
+        found.extend(m.upper() for m in _UNIT_ID.findall(text))
+        found.extend(_LITERAL.findall(text))
+    return list(dict.fromkeys(found))
+
+
+@dataclass
+class ConversationState:
+    """What the assistant needs to remember between turns"""
+    last_request: Optional[str] = None
+    last_sql: Optional[str] = None
+    columns: List[str] = field(default_factory=list)
+    row_count: Optional[int] = None
+    filters: List[str] = field(default_factory=list)
+    entities: List[str] = field(default_factory=list)
+    artifacts: Dict[str, str] = field(default_factory=dict)
+    summary: str = ""
+    turns: int = 0
+    turns_since_summary: int = 0
+
+    def update(self, request: str, artefacts: Any, artefact_keys: Iterable[str] = ()) -> None:
+        """Fold a finished turn into the state; no LLM involved"""
+        keys = set(artefact_keys)
+        self.last_request = request
+        self.turns += 1
+        self.turns_since_summary += 1
+
+        if "sql_query" in keys and artefacts.sql_query:
+            self.last_sql = artefacts.sql_query
+            self.filters = sql_filters(artefacts.sql_query)
+        if artefacts.data is not None:
+            self.columns = [str(c) for c in artefacts.data.columns]
+            self.row_count = len(artefacts.data)
+
+        new = extract_entities(request, self.last_sql if "sql_query" in keys else "")
+        # Most recent first, bounded
+        self.entities = list(dict.fromkeys(new + self.entities))[:MAX_ENTITIES]
+
+        self.artifacts = {
+            kind: getattr(artefacts, attr).name
+            for kind, attr in (("data", "data_file"), ("image", "image_file"), ("code", "code_file"))
+            if getattr(artefacts, attr, None) is not None
+        }
+        if "image (pending)" in keys:
+            self.artifacts["image"] = "pending"
+
+    def needs_summary(self, pending_text: str = "", every: int = CONTEXT_SUMMARY_EVERY,
+                      token_budget: int = CONTEXT_TOKEN_BUDGET) -> bool:
+        """True every `every` turns, or earlier once the unsummarised turns exceed the budget"""
+        if self.turns_since_summary == 0:
+            return False
+        return self.turns_since_summary >= every or estimate_tokens(pending_text) > token_budget
+
+    def apply_summary(self, summary: str, turns_covered: int) -> None:
+        self.summary = summary
+        self.turns_since_summary = max(self.turns_since_summary - turns_covered, 0)
+
+    def render(self) -> str:
+        """Compact, prompt-ready view of the state"""
+        lines = []
+        if self.summary:
+            lines.append(f"Summary: {self.summary}")
+        if self.last_request:
+            lines.append(f"Last request: {self.last_request}")
+        if self.last_sql:
+            sql = " ".join(self.last_sql.split())
+            if len(sql) > MAX_SQL_CHARS:
+                sql = sql[:MAX_SQL_CHARS] + " ..."
+            lines.append(f"Last SQL: {sql}")
+        if self.columns:
+            rows = f" ({self.row_count} rows)" if self.row_count is not None else ""
+            lines.append(f"Result columns: {', '.join(self.columns)}{rows}")
+        if self.filters:
+            lines.append(f"Filters: {'; '.join(self.filters)}")
+        if self.entities:
+            lines.append(f"Entities: {', '.join(self.entities)}")
+        if self.artifacts:
+            lines.append("Artifacts: " + ", ".join(f"{k}={v}" for k, v in self.artifacts.items()))
+        return "\n".join(lines) or EMPTY_CONTEXT
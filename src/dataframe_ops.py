@@ -0,0 +1,186 @@
+"""
+Local engine for follow-ups that only transform the previous result.
+
+"sort by downtime", "only Motor" or "top 5" do not need a new SQL round trip:
+the LLM emits a small `operationPlan` (filter / sort / top_k / group / pivot /
+select) over `artefacts.data`, which is validated and executed here with
+vectorised pandas operations. Plans that reference missing columns or use an
+unknown operation raise `PlanError`, and the caller falls back to SQL.
+
+A cheap keyword gate keeps the planning call off requests that do not
+reshape a result, so most follow-ups that need new data go straight to SQL.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Iterable, List, Optional
+
+import pandas as pd
+
+OPERATIONS = ("filter", "sort", "top_k", "group", "pivot", "select")
+OPERATORS = ("==", "!=", ">", ">=", "<", "<=", "in", "contains")
+AGGREGATIONS = ("sum", "mean", "median", "count", "min", "max")
+MAX_OPERATIONS = 6
+MAX_TOP_K = 1000
+
+# Ordering, ranking, filtering, grouping and picking columns of a result
+_TRANSFORM = re.compile(
+    r"\b(sort\w*|order\w*|orden\w*|rank\w*|top|first|primer\w*|last|[uú]ltim\w*|highest|lowest|"
+    r"largest|smallest|mayor\w*|menor\w*|most|least|only|just|solo|sólo|[uú]nicamente|"
+    r"filter\w*|filtr\w*|exclud\w*|exclu\w*|except\w*|group\w*|agrup\w*|pivot\w*|"
+    r"column\w*|columna\w*|ascending|descending|ascendente|descendente)\b",
+    re.IGNORECASE,
+)
+
+
+class PlanError(ValueError):
+    """The plan cannot be executed on the current data"""
+
+
+def _require_columns(df: pd.DataFrame, columns: Iterable[Optional[str]]) -> None:
+    missing = [c for c in columns if c not in df.columns]
+    if missing:
+        raise PlanError(f"Unknown columns: {missing}")
+
+
+def _coerce(value: str, series: pd.Series) -> Any:
+    """Filter value converted to the column's type"""
+    if pd.api.types.is_bool_dtype(series):
+        return str(value).strip().lower() in ("true", "1", "yes", "si", "sí")
+    if pd.api.types.is_numeric_dtype(series):
+        number = pd.to_numeric(value, errors="coerce")
+        if pd.isna(number):
+            raise PlanError(f"{value!r} is not a number for column {series.name}")
+        return number
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.to_datetime(value)
+    return str(value).strip()
+
+
+def _filter(df: pd.DataFrame, op) -> pd.DataFrame:
+    _require_columns(df, [op.column])
+    if op.operator not in OPERATORS or op.value is None:
+        raise PlanError(f"Invalid filter: {op.operator} {op.value!r}")
+    series = df[op.column]
+    text = not (pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series))
+
+    if op.operator == "contains":
+        mask = series.astype(str).str.contains(str(op.value), case=False, regex=False, na=False)
+    elif op.operator == "in":
+        values = [_coerce(v, series) for v in str(op.value).split(",") if v.strip()]
+        if text:
+            mask = series.astype(str).str.casefold().isin([str(v).casefold() for v in values])
+        else:
+            mask = series.isin(values)
+    else:
+        value = _coerce(op.value, series)
+        if text:
+            # Names are matched case-insensitively ("motor" selects "Motor")
+            series, value = series.astype(str).str.casefold(), str(value).casefold()
+        compare = {
+            "==": series.__eq__, "!=": series.__ne__, ">": series.__gt__,
+            ">=": series.__ge__, "<": series.__lt__, "<=": series.__le__,
+        }[op.operator]
+        mask = compare(value)
+    return df[mask.to_numpy()]
+
+
+def _sort(df: pd.DataFrame, op) -> pd.DataFrame:
+    _require_columns(df, [op.column])
+    return df.sort_values(op.column, ascending=bool(op.ascending), kind="stable")
+
+
+def _top_k(df: pd.DataFrame, op) -> pd.DataFrame:
+    _require_columns(df, [op.column])
+    if not op.n or not 0 < op.n <= MAX_TOP_K:
+        raise PlanError(f"Invalid top_k size: {op.n}")
+    if pd.api.types.is_numeric_dtype(df[op.column]):
+        pick = df.nsmallest if op.ascending else df.nlargest
+        return pick(op.n, op.column, keep="first")
+    return _sort(df, op).head(op.n)
+
+
+def _agg(op) -> str:
+    if op.agg not in AGGREGATIONS:
+        raise PlanError(f"Unknown aggregation: {op.agg}")
+    return op.agg
+
+
+def _group(df: pd.DataFrame, op) -> pd.DataFrame:
+    by = list(op.by or [])
+    if not by:
+        raise PlanError("group needs key columns")
+    agg = _agg(op)
+    if agg == "count" and not op.column:
+        return df.groupby(by, sort=False, dropna=False).size().reset_index(name="count")
+    _require_columns(df, by + [op.column])
+    return df.groupby(by, as_index=False, sort=False, dropna=False)[op.column].agg(agg)
+
+
+def _pivot(df: pd.DataFrame, op) -> pd.DataFrame:
+    by = list(op.by or [])
+    _require_columns(df, by + [op.pivot_column, op.column])
+    if not by:
+        raise PlanError("pivot needs row keys")
+    table = pd.pivot_table(df, index=by, columns=op.pivot_column, values=op.column, aggfunc=_agg(op))
+    table.columns = [str(c) for c in table.columns]
+    return table.reset_index()
+
+
+def _select(df: pd.DataFrame, op) -> pd.DataFrame:
+    columns = list(op.by or [])
+    if not columns:
+        raise PlanError("select needs columns")
+    _require_columns(df, columns)
+    return df[columns]
+
+
+_HANDLERS = {
+    "filter": _filter,
+    "sort": _sort,
+    "top_k": _top_k,
+    "group": _group,
+    "pivot": _pivot,
+    "select": _select,
+}
+
+
+def looks_like_transform(request: str) -> bool:
+    """Whether the request is worth an operation-plan call"""
+    return bool(_TRANSFORM.search(request or ""))
+
+
+def validate_plan(plan) -> List:
+    """Structural checks; column checks happen as each step runs"""
+    if plan is None or plan.uses_current_data_only is not True:
+        raise PlanError("The request needs data outside the current result")
+    operations = list(plan.operations or [])
+    if not operations or len(operations) > MAX_OPERATIONS:
+        raise PlanError(f"Plans have 1 to {MAX_OPERATIONS} operations, got {len(operations)}")
+    unknown = [op.op for op in operations if op.op not in OPERATIONS]
+    if unknown:
+        raise PlanError(f"Unknown operations: {unknown}")
+    return operations
+
+
+def apply_plan(df: pd.DataFrame, plan) -> pd.DataFrame:
+    """Run a validated plan on `df`; the input frame is not modified"""
+    out = df
+    for op in validate_plan(plan):
+        try:
+            out = _HANDLERS[op.op](out, op)
+        except PlanError:
+            raise
+        except (KeyError, TypeError, ValueError) as e:
+            raise PlanError(f"{op.op} failed: {e}") from e
+    return out.reset_index(drop=True)
+
+
+def describe_plan(plan) -> str:
+    """Readable one-liner of the plan, for logs"""
+    steps = []
+    for op in plan.operations:
+        fields = {k: v for k, v in op.model_dump().items() if k != "op" and v not in (None, [], "")}
+        steps.append(f"{op.op}({', '.join(f'{k}={v!r}' for k, v in fields.items())})")
+    return " -> ".join(steps)
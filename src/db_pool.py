@@ -0,0 +1,119 @@
+"""
+Read-only SQLite connection pool for query execution.
+
+The maintenance database is only read by the agents, so queries run on pooled
+read-only connections to the same file instead of sharing the application's
+connection across worker threads. Independent sub-queries of a decomposed
+request can then execute concurrently. In-memory databases cannot be reopened;
+their pool wraps the original connection and serialises access to it.
+"""
+
+from __future__ import annotations
+
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import pandas as pd
+
+from config import SQL_POOL_SIZE
+
+
+def database_file(conn: sqlite3.Connection) -> Optional[str]:
+    """Path of the connection's main database, None for in-memory ones"""
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return path or None
+    return None
+
+
+class SQLiteConnectionPool:
+    """Fixed-size pool of read-only connections to one database file"""
+
+    def __init__(self, path: Optional[str], size: int = SQL_POOL_SIZE, fallback: Optional[sqlite3.Connection] = None):
+        self.path = path
+        self.size = size if path else 1
+        self._idle: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._queries = 0
+        for _ in range(self.size):
+            self._idle.put(self._connect() if path else fallback)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+    @classmethod
+    def for_connection(cls, conn: sqlite3.Connection, size: int = SQL_POOL_SIZE) -> "SQLiteConnectionPool":
+        """Process-wide pool for the database behind `conn`"""
+        path = database_file(conn)
+        key = path or f"memory:{id(conn)}"
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = cls(path, size, fallback=conn)
+        return pool
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        start = time.time()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._idle.get()
+            with self._lock:
+                self._waits += 1
+                self._wait_seconds += time.time() - start
+        with self._lock:
+            self._in_use += 1
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                self._queries += 1
+            self._idle.put(conn)
+
+    def read_sql(self, sql: str) -> pd.DataFrame:
+        with self.connection() as conn:
+            return pd.read_sql_query(sql, conn)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "queries": self._queries,
+                "waits": self._waits,
+                "wait_seconds": round(self._wait_seconds, 3),
+            }
+
+    def close(self) -> None:
+        if not self.path:
+            return  # the wrapped connection belongs to the caller
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools: Dict[str, SQLiteConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def pool_stats() -> Dict[str, Dict[str, object]]:
+    with _pools_lock:
+        return {key: pool.stats() for key, pool in _pools.items()}
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
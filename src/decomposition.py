@@ -0,0 +1,64 @@
+"""
+Decomposition of multi-part data requests.
+
+"Compare downtime and job counts between Motor and Transmision per month"
+usually ends up as one large join that fails and is retried. Instead, the
+request is split into independent sub-questions (one LLM call), their SQL is
+generated and executed concurrently, and the resulting frames are merged
+locally on their shared key columns.
+
+A cheap keyword gate keeps the decomposition call off ordinary requests.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import List, Optional, Sequence
+
+import pandas as pd
+
+# Comparisons and several measures in one request
+_MULTI_PART = re.compile(
+    r"\b(compar\w*|versus|vs\.?|between|entre|both|ambos|ambas|as well as|along with|junto con|respectively)\b"
+    r"|\b(and|y)\b.*\b(per|por|by|each|cada)\b",
+    re.IGNORECASE,
+)
+
+
+def looks_multi_part(request: str) -> bool:
+    """Whether the request is worth a decomposition call"""
+    return bool(_MULTI_PART.search(request or ""))
+
+
+def shared_keys(frames: Sequence[pd.DataFrame], preferred: Sequence[str] = ()) -> List[str]:
+    """Columns to merge on: the preferred keys present in every frame, else the common non-numeric columns"""
+    common = set.intersection(*(set(map(str, df.columns)) for df in frames))
+    keys = [k for k in preferred if k in common]
+    if keys:
+        return keys
+    first = frames[0]
+    return [
+        str(c) for c in first.columns
+        if str(c) in common and not pd.api.types.is_numeric_dtype(first[c])
+    ]
+
+
+def merge_frames(frames: Sequence[pd.DataFrame], preferred: Sequence[str] = ()) -> Optional[pd.DataFrame]:
+    """Outer-merge the sub-query results on their shared keys; None when they have none"""
+    frames = [df for df in frames if df is not None and not df.empty]
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    keys = shared_keys(frames, preferred)
+    if not keys:
+        return None
+
+    merged = frames[0]
+    for n, right in enumerate(frames[1:], start=2):
+        try:
+            # Same-named measures from different sub-queries are told apart by position
+            merged = merged.merge(right, on=keys, how="outer", suffixes=("", f"_{n}"))
+        except (ValueError, TypeError):
+            return None  # incompatible key types
+    return merged.sort_values(keys, kind="stable").reset_index(drop=True)
@@ -0,0 +1,132 @@
+"""
+Evaluation harness: translate-around vs direct Spanish prompt mode.
+
+Every question set is played as one conversation per mode (fresh agent, same
+database), recording latency and per-stage timings. An LLM judge then scores
+both answers to each question, blind and in random order.
+
+Usage:
+    python src/eval_modes.py --db data/maintenance.db [--questions questions.jsonl] [--out report.json]
+
+A questions file holds one JSON object per line: {"question": "..."}.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import statistics
+from pathlib import Path
+from typing import Dict, List
+
+from improved_agent import AsyncLLM, ImprovedAgentChat
+from prompts import answer_judge_messages
+from structuredOutputs import answerJudgement
+
+MODES = ("translate", "spanish")
+
+DEFAULT_QUESTIONS = [
+    "¿Cuántos ciclos de mantenimiento se han realizado por equipo?",
+    "¿Qué equipo tuvo más ciclos de mantenimiento no programados?",
+    "Hazme un gráfico de eso",
+    "¿Cuál es el tiempo promedio de detención por ciclo para el T_01?",
+    "¿Qué sistemas tuvieron cambios críticos?",
+    "¿Y cuántos trabajos se hicieron en esos sistemas?",
+    "¿Quién ganó el último mundial de fútbol?",
+]
+
+
+def load_questions(path: Path) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["question"] for line in f if line.strip()]
+
+
+async def run_mode(conn: sqlite3.Connection, mode: str, questions: List[str]) -> List[Dict]:
+    """Play the questions as one conversation in `mode`"""
+    agent = ImprovedAgentChat(conn, mode=mode)
+    results = []
+    for question in questions:
+        response, metrics = await agent.execute(question)
+        results.append({
+            "question": question,
+            "response": response,
+            "total_time": metrics.get("total_time"),
+            "flow": metrics.get("flow"),
+            "stages": metrics.get("stages", {}),
+        })
+    return results
+
+
+async def judge(llm: AsyncLLM, question: str, answers: Dict[str, str], rng: random.Random) -> Dict:
+    """Blind pairwise judgement; returns a score per mode and the preferred mode"""
+    order = list(MODES)
+    rng.shuffle(order)
+    msgs = answer_judge_messages.copy()
+    msgs.append({
+        "role": "user",
+        "content": (
+            f"Question: {question}\n"
+            f"Answer A: {answers[order[0]]}\n"
+            f"Answer B: {answers[order[1]]}"
+        ),
+    })
+    verdict: answerJudgement = await llm.struct(msgs, answerJudgement, stage="answer_judge")
+    preferred = {"A": order[0], "B": order[1]}.get(verdict.preferred.strip().upper(), "tie")
+    return {
+        "scores": {order[0]: verdict.score_a, order[1]: verdict.score_b},
+        "preferred": preferred,
+        "rationale": verdict.rationale,
+    }
+
+
+def summarise(runs: Dict[str, List[Dict]], judgements: List[Dict]) -> Dict:
+    summary = {}
+    for mode, results in runs.items():
+        times = sorted(r["total_time"] for r in results if r["total_time"] is not None)
+        scores = [j["scores"][mode] for j in judgements]
+        summary[mode] = {
+            "mean_time": round(statistics.mean(times), 3) if times else None,
+            "median_time": round(statistics.median(times), 3) if times else None,
+            "p90_time": round(times[int(0.9 * (len(times) - 1))], 3) if times else None,
+            "mean_score": round(statistics.mean(scores), 3) if scores else None,
+            "preferred": sum(j["preferred"] == mode for j in judgements),
+        }
+    summary["ties"] = sum(j["preferred"] == "tie" for j in judgements)
+    return summary
+
+
+async def evaluate(db: Path, questions: List[str], seed: int = 0) -> Dict:
+    conn = sqlite3.connect(str(db), check_same_thread=False)
+    try:
+        runs = {mode: await run_mode(conn, mode, questions) for mode in MODES}
+    finally:
+        conn.close()
+
+    llm, rng = AsyncLLM(), random.Random(seed)
+    judgements = []
+    for i, question in enumerate(questions):
+        answers = {mode: runs[mode][i]["response"] for mode in MODES}
+        judgements.append({"question": question, **await judge(llm, question, answers, rng)})
+
+    return {"summary": summarise(runs, judgements), "judgements": judgements, "runs": runs}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the translate-around and direct Spanish modes")
+    parser.add_argument("--db", type=Path, default=Path("data/maintenance.db"))
+    parser.add_argument("--questions", type=Path, help="JSONL file with one {'question': ...} per line")
+    parser.add_argument("--out", type=Path, default=Path("eval_modes_report.json"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions) if args.questions else DEFAULT_QUESTIONS
+    report = asyncio.run(evaluate(args.db, questions, args.seed))
+    args.out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(json.dumps(report["summary"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,25 +9,39 @@ Features:
 """
 
 import asyncio
+import json
 import logging
 import sqlite3
 import time
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Literal, Optional, Union
 from uuid import uuid4
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, status
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field, ConfigDict
 from contextlib import asynccontextmanager
 
-from improved_agent import ImprovedAgentChat
-from config import CHAT_DOCS_DIR
+from improved_agent import ImprovedAgentChat, image_pool
+from observability import runtime_stats
+from intent_classifier import intent_classifier
+from translation_memory import translation_memory
+from db_pool import close_pools, pool_stats
+from latency_budget import stage_estimates
+from model_routing import model_routes
+from llm_resilience import breaker_stats, hedge_stats
+from openai_pool import client_stats, close_client, open_client, warm_up
+from session_store import SessionStore
+from jobs import Job, JobManager, JobQueueFull
+from admission import AdmissionController, Overloaded
+from session_backend import SessionBusy, backend_from_config
+from image_variants import VARIANT_SUFFIXES, MEDIA_TYPES, load_manifest, strong_etag, variant_path
+from config import CHAT_DOCS_DIR, IMAGE_WAIT_TIMEOUT, JOB_MAX_WAIT
 
 # ─────────────────────────── CONFIGURATION ─────────────────────────── #
 
@@ -47,6 +61,15 @@ class ChatRequest(BaseModel):
     """Request model for chat interactions"""
     message: str = Field(..., min_length=1, max_length=1000, description="User message in Spanish")
     session_id: Optional[str] = Field(None, description="Optional session ID for context continuity")
+    mode: Optional[Literal["translate", "spanish"]] = Field(
+        None, description="Prompt mode for this turn; defaults to the deployment's PROMPT_MODE"
+    )
+    profile: Optional[Literal["fast", "balanced", "thorough"]] = Field(
+        None, description="Latency profile; defaults to LATENCY_PROFILE, or to the cheapest one fitting latency_budget_ms"
+    )
+    latency_budget_ms: Optional[int] = Field(
+        None, ge=500, le=600000, description="Time the client is willing to wait; optional work is dropped to meet it"
+    )
     
     model_config = ConfigDict(
         json_schema_extra={
@@ -77,12 +100,22 @@ class ChatResponse(BaseModel):
                 },
                 "artifacts": {
                     "data_file": "/path/to/data.csv",
-                    "image_file": "/path/to/chart.png"
+                    "image_status": "pending"
                 }
             }
         }
     )
 
+class JobResponse(BaseModel):
+    """State of a queued chat turn"""
+    job_id: str = Field(..., description="Id to poll with GET /v1/jobs/{job_id}")
+    status: Literal["queued", "running", "done", "failed"] = Field(..., description="Job state")
+    session_id: Optional[str] = Field(None, description="Session of the turn; set once known")
+    result: Optional[ChatResponse] = Field(None, description="The chat response, once done")
+    error: Optional[Union[str, Dict]] = Field(None, description="Failure detail, when failed")
+    status_code: Optional[int] = Field(None, description="HTTP status /v1/chat would have answered, when failed")
+    timing: Dict[str, Optional[float]] = Field(..., description="Seconds queued and running")
+
 class HealthResponse(BaseModel):
     """Health check response model"""
     status: str = Field(..., description="Service status")
@@ -121,10 +154,17 @@ async def lifespan(app: FastAPI):
     # Startup
     global db_connection
     logger.info("Starting chatbot API service...")
+    warm_task = sweeper = None
     
     try:
         db_connection = get_database_connection()
         logger.info("Database connection established")
+        translation_memory.add_names_from_db(db_connection)
+
+        # One OpenAI client for every session; connections are warmed without delaying startup
+        warm_task = asyncio.create_task(warm_up(open_client()))
+        sweeper = asyncio.create_task(session_store.run_sweeper())
+        job_manager.start()
         
         # Ensure chat docs directory exists
         CHAT_DOCS_DIR.mkdir(exist_ok=True)
@@ -137,6 +177,15 @@ async def lifespan(app: FastAPI):
         raise
     finally:
         # Shutdown
+        for task in (warm_task, sweeper):
+            if task is not None:
+                task.cancel()
+        await job_manager.stop()
+        await image_pool.shutdown()
+        await session_store.spill_all()
+        session_store.backend.close()
+        await close_client()
+        close_pools()
         if db_connection:
             db_connection.close()
             logger.info("Database connection closed")
@@ -165,6 +214,7 @@ app = FastAPI(
     ## Usage
     
     1. Send a POST request to `/v1/chat` with your message
+       (or to `/v1/jobs` for long turns, then long-poll `/v1/jobs/{job_id}`)
     2. Receive an intelligent response with optional artifacts
     3. Download generated files using the artifacts endpoints
     """,
@@ -197,29 +247,25 @@ async def get_agent() -> ImprovedAgentChat:
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Database connection not available"
         )
-    return ImprovedAgentChat(db_connection)
+    return ImprovedAgentChat(db_connection, client=open_client())
 
 # ─────────────────────────── SESSION MANAGEMENT ─────────────────────────── #
 
-# In-memory session store (in production, use Redis or similar)
-sessions: Dict[str, ImprovedAgentChat] = {}
+# Turns running at once across /v1/chat and the job workers; the rest wait or are shed
+admission = AdmissionController()
 
-async def get_or_create_session(session_id: Optional[str] = None) -> tuple[str, ImprovedAgentChat]:
-    """Get existing session or create new one"""
-    if session_id and session_id in sessions:
-        return session_id, sessions[session_id]
-    
-    # Create new session
-    new_session_id = str(uuid4())
-    sessions[new_session_id] = await get_agent()
-    
-    # Cleanup old sessions (keep last 100)
-    if len(sessions) > 100:
-        oldest_sessions = list(sessions.keys())[:-100]
-        for old_id in oldest_sessions:
-            del sessions[old_id]
-    
-    return new_session_id, sessions[new_session_id]
+# Bounded in-memory sessions; idle and least recently used ones go to the session backend
+session_store = SessionStore(get_agent, backend=backend_from_config())
+
+async def get_session(session_id: str) -> ImprovedAgentChat:
+    """Existing session (rehydrated if it was spilled) or 404"""
+    agent = await session_store.get(session_id)
+    if agent is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session {session_id} not found"
+        )
+    return agent
 
 # ─────────────────────────── API ROUTES ─────────────────────────── #
 
@@ -248,6 +294,39 @@ async def health_check():
         }
     )
 
+@app.get("/v1/metrics", tags=["Health"])
+async def service_metrics():
+    """Process-wide runtime metrics (code extraction paths, image pool usage, ...)"""
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
+        "active_sessions": len(session_store),
+        "admission": admission.stats(),
+        "session_store": session_store.stats(),
+        "jobs": job_manager.stats(),
+        "image_pool": image_pool.stats(),
+        "intent_classifier": intent_classifier.stats(),
+        "translation_memory": translation_memory.stats(),
+        "sql_pools": pool_stats(),
+        "openai_pool": client_stats(),
+        "latency_estimates": stage_estimates.snapshot(),
+        "llm_latency": runtime_stats.histograms("llm_latency"),
+        "model_routing": model_routes.recommend(),
+        "llm_hedging": hedge_stats(),
+        "llm_circuits": breaker_stats(),
+        "counters": runtime_stats.snapshot(),
+    }
+
+@app.get("/v1/metrics/load", tags=["Health"])
+async def load_metrics():
+    """Cheap load gauges for autoscalers: turns in flight, turns and jobs waiting"""
+    return {
+        "in_flight": admission.in_flight,
+        "queued": admission.queued + admission.patient_queued,
+        "max_in_flight": admission.max_in_flight,
+        "utilisation": round(admission.in_flight / admission.max_in_flight, 3),
+        "jobs_queued": job_manager.queued(),
+    }
+
 @app.get("/", tags=["Root"])
 async def root():
     """Root endpoint with basic API information"""
@@ -268,29 +347,50 @@ async def chat(
     
     - **message**: Your question or request in Spanish
     - **session_id**: Optional session ID to maintain conversation context
+    - **mode**: Optional prompt mode ("translate" or "spanish") for this turn
     
     Returns a response with the answer, session information, and performance metrics.
+    Turns that may outlast the proxy's timeout are better sent to `/v1/jobs`.
+    Under load the turn waits for a slot; when the service is saturated it
+    answers 429 (queue full) or 503 (waited too long) with `Retry-After`.
     """
+    try:
+        async with admission.admit():
+            return await run_chat_turn(request)
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+async def run_chat_turn(request: ChatRequest) -> ChatResponse:
+    """One chat turn, for `/v1/chat` and for the job workers"""
     start_time = time.time()
     session_id = None
     
     try:
-        # Get or create session
-        session_id, agent = await get_or_create_session(request.session_id)
-        
-        logger.info(f"Processing chat request for session {session_id[:8]}...")
-        
-        # Process the request
-        response, metrics = await agent.execute(request.message)
-        
-        # Prepare artifacts info
-        artifacts = {}
-        if agent.artefacts.data_file:
-            artifacts["data_file"] = str(agent.artefacts.data_file)
-        if agent.artefacts.image_file:
-            artifacts["image_file"] = str(agent.artefacts.image_file)
-        if agent.artefacts.code_file:
-            artifacts["code_file"] = str(agent.artefacts.code_file)
+        # Get or create session; the turn has it to itself until the block ends,
+        # concurrent requests for the same session wait (or get a 409)
+        async with session_store.use(request.session_id) as (session_id, agent):
+            logger.info(f"Processing chat request for session {session_id[:8]}...")
+
+            # Process the request
+            response, metrics = await agent.execute(
+                request.message, mode=request.mode,
+                profile=request.profile, latency_budget_ms=request.latency_budget_ms,
+            )
+
+            # Prepare artifacts info before the next queued turn replaces them
+            artifacts = {}
+            if agent.artefacts.data_file:
+                artifacts["data_file"] = str(agent.artefacts.data_file)
+            if agent.artefacts.image_file:
+                artifacts["image_file"] = str(agent.artefacts.image_file)
+            if agent.artefacts.code_file:
+                artifacts["code_file"] = str(agent.artefacts.code_file)
+            if agent.artefacts.image_status != "none":
+                artifacts["image_status"] = agent.artefacts.image_status
         
         # Add session tracking to metrics
         metrics.update({
@@ -307,12 +407,14 @@ async def chat(
             artifacts=artifacts if artifacts else None
         )
         
+    except SessionBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     except Exception as e:
         logger.error(f"Chat request failed for session {session_id}: {e}")
         
-        # Clean up failed session
-        if session_id and session_id in sessions:
-            del sessions[session_id]
+        # Drop the half-updated session; its next request reloads the last saved version
+        if session_id:
+            session_store.discard(session_id)
         
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -324,16 +426,62 @@ async def chat(
             ).dict()
         )
 
-@app.get("/v1/sessions/{session_id}/artifacts", tags=["Artifacts"])
-async def list_session_artifacts(session_id: str):
-    """List all artifacts for a specific session"""
-    if session_id not in sessions:
+async def run_job_turn(request: ChatRequest) -> ChatResponse:
+    """Job turns share the admission slots; they are already bounded, so they wait without a timeout"""
+    async with admission.admit(patient=True):
+        return await run_chat_turn(request)
+
+# Queued turns from /v1/jobs, run by a fixed pool of workers
+job_manager = JobManager(run_job_turn)
+
+@app.post("/v1/jobs", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED, tags=["Chat"])
+async def submit_job(request: ChatRequest, response: Response) -> JobResponse:
+    """
+    Queue a chat turn and return at once with its job id
+
+    Poll `GET /v1/jobs/{job_id}?wait=N` for the result. Answers 503 with
+    `Retry-After` while the job queue is full.
+    """
+    try:
+        job = job_manager.submit(request)
+    except JobQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "5"},
+        )
+    response.headers["Location"] = f"/v1/jobs/{job.id}"
+    return _job_payload(job)
+
+@app.get("/v1/jobs/{job_id}", response_model=JobResponse, tags=["Chat"])
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=JOB_MAX_WAIT, description="Seconds to wait for the job to finish (long-poll)")
+) -> JobResponse:
+    """Status of a job, and its result once done; finished jobs are kept for JOB_RESULT_TTL"""
+    job = await job_manager.wait(job_id, wait)
+    if job is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found"
+            detail=f"Job {job_id} not found or expired"
         )
-    
-    agent = sessions[session_id]
+    return _job_payload(job)
+
+def _job_payload(job: Job) -> JobResponse:
+    return JobResponse(
+        job_id=job.id,
+        status=job.status,
+        session_id=job.result.session_id if job.result is not None else job.request.session_id,
+        result=job.result,
+        error=job.error,
+        status_code=job.status_code,
+        timing=job.timing(),
+    )
+
+@app.get("/v1/sessions/{session_id}/artifacts", tags=["Artifacts"])
+async def list_session_artifacts(session_id: str):
+    """List all artifacts for a specific session"""
+    agent = await get_session(session_id)
     artifacts = {}
     
     if agent.artefacts.data_file and agent.artefacts.data_file.exists():
@@ -347,7 +495,8 @@ async def list_session_artifacts(session_id: str):
         artifacts["image"] = {
             "file": str(agent.artefacts.image_file),
             "size": agent.artefacts.image_file.stat().st_size,
-            "type": "png"
+            "type": "png",
+            "variants": load_manifest(agent.artefacts.image_file) or {}
         }
     
     if agent.artefacts.code_file and agent.artefacts.code_file.exists():
@@ -359,22 +508,98 @@ async def list_session_artifacts(session_id: str):
     
     return {"session_id": session_id, "artifacts": artifacts}
 
+def _image_status_payload(session_id: str, agent: ImprovedAgentChat) -> Dict:
+    """Current state of the session's background chart"""
+    return {
+        "session_id": session_id,
+        "status": agent.artefacts.image_status,
+        "image_file": str(agent.artefacts.image_file) if agent.artefacts.image_file else None,
+        "image_time": agent.artefacts.metrics.image_time,
+        "error": agent.artefacts.image_error,
+        "upload": {
+            "columns": agent.artefacts.metrics.upload_columns,
+            "original_bytes": agent.artefacts.metrics.upload_original_bytes,
+            "upload_bytes": agent.artefacts.metrics.upload_bytes,
+            "upload_time": agent.artefacts.metrics.upload_time,
+        },
+    }
+
+async def _wait_for_image(session_id: str, agent: ImprovedAgentChat, timeout: float) -> ImprovedAgentChat:
+    """
+    Wait up to `timeout` seconds for the session's pending chart and return
+    the session as last seen. A chart rendered by another worker only shows
+    in the stored version, so the session is fetched again after every poll.
+    """
+    deadline = time.time() + timeout
+    while agent.artefacts.image_status == "pending" and time.time() < deadline:
+        await agent.wait_for_image(deadline - time.time())
+        agent = await session_store.get(session_id) or agent
+    return agent
+
+@app.get("/v1/sessions/{session_id}/artifacts/image/status", tags=["Artifacts"])
+async def image_status(session_id: str):
+    """Poll the status of the chart being generated for a session"""
+    return _image_status_payload(session_id, await get_session(session_id))
+
+@app.get("/v1/sessions/{session_id}/events", tags=["Artifacts"])
+async def session_events(
+    session_id: str,
+    timeout: float = Query(IMAGE_WAIT_TIMEOUT, gt=0, le=600, description="Seconds to keep the stream open")
+):
+    """
+    Server-Sent Events stream for a session
+
+    Emits a single `image` event once the pending chart is ready or failed
+    (immediately if nothing is pending), sending keep-alive comments meanwhile.
+    """
+    agent = await get_session(session_id)
+
+    async def event_stream():
+        current, deadline = agent, time.time() + timeout
+        while current.artefacts.image_status == "pending" and time.time() < deadline:
+            current = await _wait_for_image(session_id, current, min(15.0, max(deadline - time.time(), 0)))
+            if current.artefacts.image_status == "pending":
+                yield ": keep-alive\n\n"
+        payload = json.dumps(_image_status_payload(session_id, current))
+        yield f"event: image\ndata: {payload}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/v1/download/{file_type}/{session_id}", tags=["Artifacts"])
-async def download_artifact(file_type: str, session_id: str):
+async def download_artifact(
+    file_type: str,
+    session_id: str,
+    request: Request,
+    variant: str = Query("original", description="Image variant: original, thumb, optimized or webp"),
+    wait: bool = Query(False, description="Wait for a pending image before responding"),
+    timeout: float = Query(IMAGE_WAIT_TIMEOUT, gt=0, le=600, description="Maximum seconds to wait")
+):
     """
     Download artifacts generated by the chatbot
     
     - **file_type**: Type of file to download (data, image, code)
     - **session_id**: Session ID that generated the artifact
+    - **variant**: For images, which pre-generated variant to serve
+    - **wait**: For images still being generated, block up to `timeout` seconds
+
+    Responses carry a strong `ETag`; `If-None-Match` revalidation returns `304`.
     """
-    if session_id not in sessions:
+    agent = await get_session(session_id)
+
+    if file_type == "image" and agent.artefacts.image_status == "pending":
+        if wait:
+            agent = await _wait_for_image(session_id, agent, timeout)
+        if agent.artefacts.image_status == "pending":
+            return JSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content=_image_status_payload(session_id, agent)
+            )
+    if file_type == "image" and agent.artefacts.image_status == "failed":
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found"
+            detail=f"Image generation failed: {agent.artefacts.image_error}"
         )
     
-    agent = sessions[session_id]
-    
     # Map file types to agent artifacts
     file_mapping = {
         "data": agent.artefacts.data_file,
@@ -402,25 +627,51 @@ async def download_artifact(file_type: str, session_id: str):
         "image": "image/png", 
         "code": "text/x-python"
     }
-    
+    media_type = media_types[file_type]
+    etag = None
+
+    if file_type == "image":
+        if variant not in VARIANT_SUFFIXES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid variant. Must be one of: {', '.join(VARIANT_SUFFIXES)}"
+            )
+        manifest = load_manifest(file_path) or {}
+        if variant != "original" and variant not in manifest:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Image variant '{variant}' not available for this session"
+            )
+        if variant in manifest:
+            etag = manifest[variant]["etag"]
+        file_path = variant_path(file_path, variant)
+        media_type = MEDIA_TYPES[variant]
+
+    if etag is None:
+        loop = asyncio.get_event_loop()
+        etag = await loop.run_in_executor(None, strong_etag, file_path)
+
+    # The URL always points at the latest artifact, so clients must revalidate
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
     return FileResponse(
         path=file_path,
-        media_type=media_types[file_type],
-        filename=file_path.name
+        media_type=media_type,
+        filename=file_path.name,
+        headers=headers
     )
 
 @app.delete("/v1/sessions/{session_id}", tags=["Sessions"])
 async def delete_session(session_id: str):
     """Delete a specific session and clean up its artifacts"""
-    if session_id not in sessions:
+    if not await session_store.delete(session_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Session {session_id} not found"
         )
     
-    # Clean up session
-    del sessions[session_id]
-    
     # Optionally clean up session files (be careful with this in production)
     # You might want to mark for cleanup instead of immediate deletion
     
@@ -430,17 +681,15 @@ async def delete_session(session_id: str):
 async def list_active_sessions():
     """List all active sessions (for debugging/monitoring)"""
     return {
-        "active_sessions": len(sessions),
-        "sessions": [
-            {
-                "session_id": sid,
-                "created": "N/A",  # Would track this in production
-                "last_activity": "N/A"
-            }
-            for sid in sessions.keys()
-        ]
+        "active_sessions": len(session_store),
+        "sessions": session_store.describe(),
     }
 
+@app.get("/v1/sessions/stats", tags=["Sessions"])
+async def session_stats():
+    """Session store usage: sessions in memory and on disk, estimated memory, evictions"""
+    return session_store.stats()
+
 # ─────────────────────────── ERROR HANDLERS ─────────────────────────── #
 
 @app.exception_handler(HTTPException)
@@ -452,7 +701,8 @@ async def http_exception_handler(request, exc):
             "error": exc.detail,
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
             "path": str(request.url)
-        }
+        },
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(Exception)
@@ -0,0 +1,113 @@
+"""
+Post-processing of saved charts.
+
+Each chart is turned once into a set of variants stored alongside the
+original (`image_0.png` → `image_0.thumb.png`, `image_0.opt.png`,
+`image_0.webp`) plus a `image_0.variants.json` manifest with sizes and strong
+ETags, so downloads and the Streamlit sidebar never re-encode or re-hash it.
+Pillow is optional: without it only the original is listed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from config import IMAGE_THUMBNAIL_SIZE, IMAGE_VARIANT_WORKERS, WEBP_QUALITY
+
+logger = logging.getLogger("image_variants")
+
+VARIANT_SUFFIXES = {
+    "original": None,
+    "thumb": ".thumb.png",
+    "optimized": ".opt.png",
+    "webp": ".webp",
+}
+
+MEDIA_TYPES = {
+    "original": "image/png",
+    "thumb": "image/png",
+    "optimized": "image/png",
+    "webp": "image/webp",
+}
+
+
+def variant_path(original: Path, variant: str) -> Path:
+    suffix = VARIANT_SUFFIXES[variant]
+    return original if suffix is None else original.with_name(original.stem + suffix)
+
+
+def manifest_path(original: Path) -> Path:
+    return original.with_name(original.stem + ".variants.json")
+
+
+def strong_etag(path: Path) -> str:
+    """Content hash, quoted as a strong ETag"""
+    return '"' + hashlib.sha256(path.read_bytes()).hexdigest() + '"'
+
+
+def _entry(path: Path, variant: str) -> Dict:
+    return {
+        "file": path.name,
+        "size": path.stat().st_size,
+        "etag": strong_etag(path),
+        "media_type": MEDIA_TYPES[variant],
+    }
+
+
+def generate_variants(original: Path) -> Dict[str, Dict]:
+    """Write every variant of `original` and its manifest; returns the manifest"""
+    manifest = {"original": _entry(original, "original")}
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("Pillow not installed, only the original image is served")
+    else:
+        with Image.open(original) as img:
+            img.load()
+
+            thumb = img.copy()
+            thumb.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE))
+            thumb.save(variant_path(original, "thumb"), "PNG", optimize=True)
+
+            img.save(variant_path(original, "optimized"), "PNG", optimize=True)
+            img.save(variant_path(original, "webp"), "WEBP", quality=WEBP_QUALITY, method=6)
+
+        for variant in ("thumb", "optimized", "webp"):
+            manifest[variant] = _entry(variant_path(original, variant), variant)
+
+    manifest_path(original).write_text(json.dumps(manifest))
+    logger.info("Image variants generated for %s: %s", original.name, ", ".join(manifest))
+    return manifest
+
+
+def load_manifest(original: Path) -> Optional[Dict[str, Dict]]:
+    path = manifest_path(original)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+class ImageVariantPool:
+    """Worker pool generating variants off the request/UI thread"""
+
+    def __init__(self, max_workers: int = IMAGE_VARIANT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="img-variants")
+
+    def submit(self, original: Path) -> Future:
+        future = self._executor.submit(generate_variants, original)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future: Future) -> None:
+        if not future.cancelled() and future.exception():
+            logger.error("Image variant generation failed: %s", future.exception())
+
+
+# Process-wide pool shared by both agents
+variant_pool = ImageVariantPool()
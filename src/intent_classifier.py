@@ -0,0 +1,314 @@
+"""
+Local fast path for the two structured intent calls (`messageClassification`
+and `actionsRequired`).
+
+Keyword rules cover the obvious cases ("hazme un gráfico de eso") and a small
+Bernoulli naive Bayes model, trained on logged requests labelled by the LLM,
+covers the rest. A prediction is only used when every field of the output
+model reaches INTENT_CONFIDENCE; otherwise the agent defers to the LLM and
+logs its answer as new training data.
+
+Offline usage:
+    python src/intent_classifier.py train --log chat_docs/intent_log.jsonl
+    python src/intent_classifier.py eval  --log chat_docs/intent_log.jsonl [--model models/intent_nb.npz]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import re
+import unicodedata
+import zlib
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from config import (
+    INTENT_CONFIDENCE,
+    INTENT_LOG_PATH,
+    INTENT_MIN_SAMPLES,
+    INTENT_MODEL_PATH,
+    INTENT_SHADOW_RATE,
+)
+from observability import runtime_stats
+from structuredOutputs import actionsRequired, messageClassification
+
+OUTPUT_MODELS = {
+    "classification": messageClassification,
+    "actions": actionsRequired,
+}
+LABELS = [name for model in OUTPUT_MODELS.values() for name in model.model_fields]
+
+RULE_CONFIDENCE = 0.95
+WEAK_RULE_CONFIDENCE = 0.6  # below INTENT_CONFIDENCE: a hint for the model, never decisive on its own
+
+# ─────────────────────────── FEATURES ─────────────────────────── #
+
+def normalise(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokens(text: str) -> List[str]:
+    words = re.findall(r"[a-z0-9_]+", normalise(text))
+    # Unit ids are interchangeable for intent purposes
+    words = ["<unit>" if re.fullmatch(r"t_\d+", w) else w for w in words]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+# ─────────────────────────── KEYWORD RULES ─────────────────────────── #
+
+_IMAGE = re.compile(r"\b(chart|graph|plot|visuali[sz]\w*|diagram|histogram|grafic\w*|imagen|image)\b")
+# Explicit references to the previous result
+_REFERENCE = re.compile(r"\b(previous|above|earlier|last (?:result|table|data)|anterior\w*|mismos? datos)\b")
+# Pronouns also occur in fresh requests ("this month", "plot it: ..."), so they only weakly imply a redraw
+_PRONOUN = re.compile(r"\b(that|this|it|those|these|same|eso|esto|ese|esa|esos|esas|mismo\w*)\b")
+_NEW_DATA = re.compile(r"\b(t_\d+|\d{4}|how many|cuant\w*|list\w*|top|average|promedio|between|entre)\b")
+_DOMAIN = re.compile(
+    r"\b(t_\d+|maint\w*|manten\w*|unit\w*|equip\w*|job\w*|trabajo\w*|component\w*|subsystem\w*|subsistema\w*|"
+    r"system\w*|sistema\w*|cycle\w*|ciclo\w*|downtime|engine|motor|transmision|radiator|coolant)\b"
+)
+
+
+def _rules(text: str, has_data: bool) -> Tuple[Dict[str, bool], Set[str]]:
+    """Keyword labels, and those of them that only rest on a pronoun"""
+    t = normalise(text)
+    labels: Dict[str, bool] = {}
+    weak: Set[str] = set()
+    image, new_data = bool(_IMAGE.search(t)), bool(_NEW_DATA.search(t))
+    explicit = bool(_REFERENCE.search(t))
+    reference = explicit or bool(_PRONOUN.search(t))
+
+    if _DOMAIN.search(t) or (image and reference and has_data):
+        labels["is_on_topic"] = True
+    if image and reference and has_data and not new_data:
+        # "make a chart of that": redraw the data we already have
+        labels.update(is_new_image_needed=True, is_new_sql_query_needed=False, is_context_sufficient=True)
+        if not explicit:
+            weak.update(("is_new_image_needed", "is_new_sql_query_needed", "is_context_sufficient"))
+    elif image and (new_data or not has_data):
+        # Nothing to redraw yet, or new data asked for: the chart needs a query
+        labels.update(is_new_image_needed=True, is_new_sql_query_needed=True)
+    return labels, weak
+
+
+def keyword_rules(text: str, has_data: bool = False) -> Dict[str, bool]:
+    """Labels decided by keywords; anything else is left to the model"""
+    return _rules(text, has_data)[0]
+
+# ─────────────────────────── MODEL ─────────────────────────── #
+
+class NaiveBayesIntentModel:
+    """Bernoulli naive Bayes over hashed unigrams / bigrams, one binary model per label"""
+
+    def __init__(self, n_features: int = 2 ** 12, alpha: float = 1.0):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.samples: Dict[str, int] = {}
+        self._base: Dict[str, np.ndarray] = {}   # (2,) log-likelihood with no feature present
+        self._delta: Dict[str, np.ndarray] = {}  # (2, n_features) gain when a feature is present
+
+    def features(self, text: str) -> np.ndarray:
+        return np.unique([zlib.crc32(tok.encode()) % self.n_features for tok in tokens(text)]).astype(np.int64)
+
+    def fit(self, records: Iterable[Tuple[str, Dict[str, bool]]]) -> "NaiveBayesIntentModel":
+        records = list(records)
+        for label in LABELS:
+            docs = [(self.features(text), labels[label]) for text, labels in records if label in labels]
+            if not docs:
+                continue
+            counts = np.zeros((2, self.n_features))
+            class_counts = np.zeros(2)
+            for idx, value in docs:
+                counts[int(value), idx] += 1
+                class_counts[int(value)] += 1
+            p = (counts + self.alpha) / (class_counts[:, None] + 2 * self.alpha)
+            prior = np.log((class_counts + self.alpha) / (len(docs) + 2 * self.alpha))
+            self._base[label] = prior + np.log1p(-p).sum(axis=1)
+            self._delta[label] = np.log(p) - np.log1p(-p)
+            self.samples[label] = len(docs)
+        return self
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        """P(label is True) for every trained label"""
+        idx = self.features(text)
+        out = {}
+        for label, base in self._base.items():
+            scores = base + self._delta[label][:, idx].sum(axis=1)
+            scores -= scores.max()
+            odds = np.exp(scores)
+            out[label] = float(odds[1] / odds.sum())
+        return out
+
+    def save(self, path: Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrays = {f"base__{k}": v for k, v in self._base.items()}
+        arrays.update({f"delta__{k}": v for k, v in self._delta.items()})
+        meta = json.dumps({"n_features": self.n_features, "alpha": self.alpha, "samples": self.samples})
+        with open(path, "wb") as f:
+            np.savez_compressed(f, meta=np.array(meta), **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> "NaiveBayesIntentModel":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            model = cls(meta["n_features"], meta["alpha"])
+            model.samples = meta["samples"]
+            for label in model.samples:
+                model._base[label] = data[f"base__{label}"]
+                model._delta[label] = data[f"delta__{label}"]
+        return model
+
+# ─────────────────────────── CLASSIFIER ─────────────────────────── #
+
+class LocalIntentClassifier:
+    """Rules + model in front of the LLM, with a training log and agreement tracking"""
+
+    def __init__(
+        self,
+        model: Optional[NaiveBayesIntentModel] = None,
+        threshold: float = INTENT_CONFIDENCE,
+        log_path: Optional[Path] = INTENT_LOG_PATH,
+        shadow_rate: float = INTENT_SHADOW_RATE,
+    ):
+        self.model = model
+        self.threshold = threshold
+        self.log_path = log_path
+        self.shadow_rate = shadow_rate
+        self._lock = Lock()
+
+    @classmethod
+    def from_path(cls, path: Path = INTENT_MODEL_PATH, **kwargs) -> "LocalIntentClassifier":
+        model = NaiveBayesIntentModel.load(path) if Path(path).exists() else None
+        return cls(model, **kwargs)
+
+    def scores(self, text: str, has_data: bool = False) -> Dict[str, Tuple[bool, float]]:
+        """(value, confidence) per label; rules win over the model"""
+        out: Dict[str, Tuple[bool, float]] = {}
+        if self.model is not None:
+            for label, p in self.model.predict_proba(text).items():
+                if self.model.samples.get(label, 0) >= INTENT_MIN_SAMPLES:
+                    out[label] = (p >= 0.5, max(p, 1 - p))
+        labels, weak = _rules(text, has_data)
+        for label, value in labels.items():
+            if label not in weak:
+                out[label] = (value, RULE_CONFIDENCE)
+            elif label not in out or out[label][0] == value:
+                # A pronoun-only rule may back the model up, but not decide alone
+                out[label] = (value, max(WEAK_RULE_CONFIDENCE, out.get(label, (value, 0.0))[1]))
+        return out
+
+    def guess(self, kind: str, text: str, has_data: bool = False) -> Tuple[Optional[BaseModel], Dict[str, bool]]:
+        """Confident prediction for `kind` (None defers to the LLM) plus every label guessed"""
+        fields = OUTPUT_MODELS[kind].model_fields
+        scores = self.scores(text, has_data)
+        guessed = {k: v for k, (v, _) in scores.items() if k in fields}
+        confident = all(k in scores and scores[k][1] >= self.threshold for k in fields)
+        runtime_stats.incr("intent_classifier", f"{kind}_local" if confident else f"{kind}_llm")
+        return (OUTPUT_MODELS[kind](**guessed) if confident else None), guessed
+
+    def should_shadow(self) -> bool:
+        return random.random() < self.shadow_rate
+
+    def record(
+        self, kind: str, text: str, result: BaseModel, local: Dict[str, bool],
+        has_data: bool = False, shadow: bool = False,
+    ) -> None:
+        """Log the LLM labels for training and count agreement with the local guess"""
+        labels = {k: bool(getattr(result, k)) for k in OUTPUT_MODELS[kind].model_fields}
+        prefix = "shadow_" if shadow else ""
+        for label, value in local.items():
+            runtime_stats.incr("intent_classifier", f"{prefix}agree" if labels.get(label) == value else f"{prefix}disagree")
+
+        if self.log_path is None:
+            return
+        line = json.dumps({"text": text, "kind": kind, "has_data": has_data, "labels": labels}, ensure_ascii=False)
+        with self._lock:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def stats(self) -> Dict[str, object]:
+        counters = runtime_stats.get("intent_classifier")
+        local = sum(v for k, v in counters.items() if k.endswith("_local"))
+        total = local + sum(v for k, v in counters.items() if k.endswith("_llm"))
+
+        def rate(prefix: str) -> Optional[float]:
+            agree, disagree = counters.get(f"{prefix}agree", 0), counters.get(f"{prefix}disagree", 0)
+            return round(agree / (agree + disagree), 4) if agree + disagree else None
+
+        return {
+            "model_loaded": self.model is not None,
+            "local_rate": round(local / total, 4) if total else None,
+            "agreement_rate": rate(""),
+            "shadow_agreement_rate": rate("shadow_"),
+        }
+
+
+intent_classifier = LocalIntentClassifier.from_path()
+
+# ─────────────────────────── OFFLINE TRAIN / EVAL ─────────────────────────── #
+
+def load_log(path: Path) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(classifier: LocalIntentClassifier, records: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """Per-label accuracy overall and on the confident subset (coverage = share answered locally)"""
+    report = {}
+    for label in LABELS:
+        rows = [
+            (classifier.scores(r["text"], r.get("has_data", False)).get(label), r["labels"][label])
+            for r in records if label in r["labels"]
+        ]
+        if not rows:
+            continue
+        predicted = [(s, truth) for s, truth in rows if s is not None]
+        confident = [(s, truth) for s, truth in predicted if s[1] >= classifier.threshold]
+        report[label] = {
+            "n": len(rows),
+            "accuracy": round(sum(s[0] == t for s, t in predicted) / len(predicted), 4) if predicted else 0.0,
+            "coverage": round(len(confident) / len(rows), 4),
+            "confident_accuracy": round(sum(s[0] == t for s, t in confident) / len(confident), 4) if confident else 0.0,
+        }
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Train / evaluate the local intent classifier")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train = sub.add_parser("train")
+    train.add_argument("--log", type=Path, default=INTENT_LOG_PATH)
+    train.add_argument("--out", type=Path, default=INTENT_MODEL_PATH)
+    ev = sub.add_parser("eval")
+    ev.add_argument("--log", type=Path, default=INTENT_LOG_PATH)
+    ev.add_argument("--model", type=Path, help="evaluate a saved model on the whole log (default: 80/20 holdout)")
+    ev.add_argument("--threshold", type=float, default=INTENT_CONFIDENCE)
+    args = parser.parse_args(argv)
+
+    records = load_log(args.log)
+    if args.command == "train":
+        model = NaiveBayesIntentModel().fit((r["text"], r["labels"]) for r in records)
+        model.save(args.out)
+        print(f"Trained on {len(records)} records -> {args.out} ({model.samples})")
+        return
+
+    if args.model:
+        model, test = NaiveBayesIntentModel.load(args.model), records
+    else:
+        random.Random(0).shuffle(records)
+        split = int(len(records) * 0.8)
+        train_set = ((r["text"], r["labels"]) for r in records[:split])
+        model, test = NaiveBayesIntentModel().fit(train_set), records[split:]
+    classifier = LocalIntentClassifier(model, threshold=args.threshold, log_path=None)
+    print(json.dumps(evaluate(classifier, test), indent=2))
+
+
+if __name__ == "__main__":
+    main()
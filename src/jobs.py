@@ -0,0 +1,182 @@
+"""
+Background jobs for long chat turns.
+
+A turn that queries data and draws a chart can outlast a reverse proxy's read
+timeout (nginx defaults to 60 s), and a client waiting on `/v1/chat` holds a
+connection for the whole turn. `POST /v1/jobs` instead queues the turn and
+answers at once with a job id; a fixed pool of JOB_WORKERS tasks runs the
+queued turns, and `GET /v1/jobs/{id}?wait=N` long-polls for the result.
+
+    job = job_manager.submit(request)
+    job = await job_manager.wait(job.id, timeout=20)
+
+The queue holds at most JOB_MAX_QUEUED jobs (`JobQueueFull` beyond that).
+Finished jobs are kept for JOB_RESULT_TTL seconds and then forgotten.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from config import JOB_MAX_QUEUED, JOB_RESULT_TTL, JOB_WORKERS
+from observability import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+STATS_GROUP = "jobs"
+
+
+class JobQueueFull(RuntimeError):
+    """No room for another queued job"""
+
+
+@dataclass
+class Job:
+    request: Any
+    id: str = field(default_factory=lambda: str(uuid4()))
+    status: str = "queued"  # queued | running | done | failed
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Any = None
+    error: Any = None
+    status_code: Optional[int] = None  # of the failure, when the handler raised one
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def timing(self) -> Dict[str, Optional[float]]:
+        end = self.finished_at or time.time()
+        return {
+            "queued_time": round((self.started_at or end) - self.created_at, 3),
+            "run_time": round(end - self.started_at, 3) if self.started_at else None,
+        }
+
+
+class JobManager:
+    """Bounded queue of turns, `workers` tasks running them, results kept for `result_ttl`"""
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int = JOB_WORKERS,
+        max_queued: int = JOB_MAX_QUEUED,
+        result_ttl: float = JOB_RESULT_TTL,
+    ):
+        self._handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def start(self) -> None:
+        """Start the workers; called from the service lifespan (or lazily on first submit)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Cancel the workers; jobs still queued or running are marked failed"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks, self._queue = [], None
+        for job in self._jobs.values():
+            if not job.finished:
+                self._finish(job, error="Service shutting down", status_code=503)
+
+    # ── jobs ──
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, request: Any) -> Job:
+        self.purge()
+        self.start()
+        if self.queued() >= self.max_queued:
+            runtime_stats.incr(STATS_GROUP, "rejected")
+            raise JobQueueFull(f"{self.queued()} jobs are already waiting")
+        job = Job(request)
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        runtime_stats.incr(STATS_GROUP, "submitted")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.purge()
+        return self._jobs.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """The job once finished, or as it is after `timeout` seconds; None when unknown"""
+        job = self.get(job_id)
+        if job is not None and not job.finished and timeout > 0:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """Forget finished jobs older than the result TTL"""
+        now = now or time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if expired:
+            runtime_stats.incr(STATS_GROUP, "expired", len(expired))
+        return len(expired)
+
+    # ── workers ──
+
+    def _finish(self, job: Job, result: Any = None, error: Any = None, status_code: Optional[int] = None) -> None:
+        job.finished_at = time.time()
+        job.status = "failed" if error is not None else "done"
+        job.result, job.error, job.status_code = result, error, status_code
+        job.done.set()
+        runtime_stats.incr(STATS_GROUP, job.status)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status, job.started_at = "running", time.time()
+            runtime_stats.observe(STATS_GROUP, "queue_wait", job.started_at - job.created_at)
+            try:
+                result = await self._handler(job.request)
+            except asyncio.CancelledError:
+                self._finish(job, error="Cancelled", status_code=503)
+                raise
+            except Exception as e:
+                logger.warning("Job %s failed: %s", job.id, e)
+                self._finish(job, error=getattr(e, "detail", None) or str(e), status_code=getattr(e, "status_code", None))
+            else:
+                self._finish(job, result=result)
+            finally:
+                runtime_stats.observe(STATS_GROUP, "run", time.time() - job.started_at)
+
+    def stats(self) -> Dict[str, Any]:
+        statuses = [job.status for job in self._jobs.values()]
+        return {
+            "workers": self.workers,
+            "queued": self.queued(),
+            "running": statuses.count("running"),
+            "retained": sum(1 for s in statuses if s in ("done", "failed")),
+            "max_queued": self.max_queued,
+            "result_ttl": self.result_ttl,
+            "counters": runtime_stats.get(STATS_GROUP),
+        }
@@ -0,0 +1,166 @@
+"""
+Latency-budget request profiles.
+
+A request runs under a `Profile` (fast / balanced / thorough) and, optionally,
+a latency budget. Both are carried as a `Deadline` in a context variable, so
+every stage of the pipeline and every LLM call sees them without extra
+arguments. Stages ask the deadline before optional or expensive work:
+
+    dl = current_deadline()
+    if dl.allows("image", dl.profile.images):
+        ...
+
+`allows` returns False when the profile disables the work or when the
+remaining budget cannot cover its estimated duration, and records what was
+degraded for the turn's metrics. Estimates start from defaults and follow the
+observed durations (EWMA).
+"""
+
+from __future__ import annotations
+
+import math
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Dict, List, Optional
+
+from config import LATENCY_PROFILE, MAX_SQL_RETRIES
+from observability import runtime_stats
+
+
+@dataclass(frozen=True)
+class Profile:
+    """What a request is willing to wait for"""
+    name: str
+    budget_ms: Optional[int]  # default budget; None is unbounded
+    images: bool
+    context_summary: bool  # wait for / schedule LLM context summaries
+    sql_retries: int
+    llm_retries: int
+    fast_models: bool
+
+
+PROFILES: Dict[str, Profile] = {
+    "fast": Profile("fast", 5000, images=False, context_summary=False,
+                    sql_retries=1, llm_retries=1, fast_models=True),
+    "balanced": Profile("balanced", 20000, images=True, context_summary=True,
+                        sql_retries=min(2, MAX_SQL_RETRIES), llm_retries=2, fast_models=False),
+    "thorough": Profile("thorough", None, images=True, context_summary=True,
+                        sql_retries=MAX_SQL_RETRIES, llm_retries=3, fast_models=False),
+}
+
+
+class StageEstimates:
+    """Expected duration per kind of work, in seconds"""
+
+    DEFAULTS = {
+        "llm_chat": 1.5,
+        "llm_struct": 3.0,
+        "sql_round": 4.0,
+        "final_answer": 2.5,
+        "context_wait": 1.0,
+        "image": 0.0,  # runs in the background
+        "summary": 0.0,  # runs after the reply
+    }
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._values = dict(self.DEFAULTS)
+        self._lock = Lock()
+
+    def get(self, name: str) -> float:
+        return self._values.get(name, 0.0)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            previous = self._values.get(name)
+            self._values[name] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {k: round(v, 3) for k, v in self._values.items()}
+
+
+stage_estimates = StageEstimates()
+
+
+@dataclass
+class Deadline:
+    """Profile plus the absolute time by which the turn should answer"""
+    profile: Profile
+    budget: Optional[float] = None  # seconds
+    start: float = field(default_factory=time.monotonic)
+    degraded: List[str] = field(default_factory=list)
+
+    @property
+    def budget_ms(self) -> Optional[int]:
+        return None if self.budget is None else int(self.budget * 1000)
+
+    def remaining(self) -> float:
+        if self.budget is None:
+            return math.inf
+        return self.budget - (time.monotonic() - self.start)
+
+    def covers(self, stage: str) -> bool:
+        return self.remaining() >= stage_estimates.get(stage)
+
+    def degrade(self, what: str) -> None:
+        if what not in self.degraded:
+            self.degraded.append(what)
+            runtime_stats.incr("degraded", what)
+
+    def allows(self, stage: str, enabled: bool = True, label: Optional[str] = None) -> bool:
+        """Whether to run `stage`; records `label` (default: the stage) as degraded otherwise"""
+        if enabled and self.covers(stage):
+            return True
+        self.degrade(label or stage)
+        return False
+
+    def summary(self) -> Dict[str, object]:
+        remaining = self.remaining()
+        return {
+            "profile": self.profile.name,
+            "latency_budget_ms": self.budget_ms,
+            "budget_remaining_ms": None if math.isinf(remaining) else int(remaining * 1000),
+            "degraded": list(self.degraded),
+        }
+
+
+def profile_for_budget(budget_ms: int) -> Profile:
+    """Cheapest profile whose default budget fits `budget_ms`"""
+    for profile in PROFILES.values():
+        if profile.budget_ms is not None and budget_ms <= profile.budget_ms:
+            return profile
+    return PROFILES["thorough"]
+
+
+def make_deadline(profile: Optional[str] = None, latency_budget_ms: Optional[int] = None) -> Deadline:
+    """Deadline for a request; an explicit budget without a profile picks the profile"""
+    if profile is not None and profile not in PROFILES:
+        raise ValueError(f"Unknown latency profile '{profile}'")
+    if profile is None:
+        chosen = profile_for_budget(latency_budget_ms) if latency_budget_ms else PROFILES[LATENCY_PROFILE]
+    else:
+        chosen = PROFILES[profile]
+    budget_ms = latency_budget_ms if latency_budget_ms is not None else chosen.budget_ms
+    return Deadline(chosen, None if budget_ms is None else budget_ms / 1000)
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Deadline:
+    """Deadline of the running turn; outside a turn, the default profile without a budget"""
+    deadline = _current.get()
+    if deadline is None:
+        deadline = Deadline(PROFILES[LATENCY_PROFILE])
+    return deadline
+
+
+def set_deadline(deadline: Optional[Deadline]):
+    return _current.set(deadline)
+
+
+def reset_deadline(token) -> None:
+    _current.reset(token)
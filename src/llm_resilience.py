@@ -0,0 +1,201 @@
+"""
+Tail-latency and failure control for LLM calls.
+
+Hedging: when a call has not answered after its stage's hedge delay (the
+observed p95, see `RoutingTable.hedge_delay`), an identical request is sent
+and the first successful response wins; the other is cancelled. Every LLM
+call in the agents is a pure function of its messages, so duplicates are safe.
+The cancelled request may still be billed, so each hedge that fired adds the
+winner's token usage to `wasted_tokens` as an estimate.
+
+Circuit breaker: each model has a `CircuitBreaker` over its recent calls.
+When the failure rate crosses CIRCUIT_FAILURE_RATE the circuit opens and calls
+fail fast with `CircuitOpenError` (or move to the stage's fast model) until,
+after CIRCUIT_COOLDOWN, one probe call is let through to close it again. A
+probe that is cancelled (a superseded chart, a client disconnect, a stage
+timeout) records nothing and frees the slot for the next probe.
+
+Counters are kept under "llm_hedge" and "llm_circuit" in runtime_stats.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import deque
+from threading import Lock
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+import openai
+
+from config import CIRCUIT_COOLDOWN, CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW
+from observability import runtime_stats
+
+T = TypeVar("T")
+
+HEDGE_GROUP = "llm_hedge"
+CIRCUIT_GROUP = "llm_circuit"
+
+
+class CircuitOpenError(RuntimeError):
+    """The model's circuit is open; the call was not sent"""
+
+
+def is_failure(error: BaseException) -> bool:
+    """Errors that say something about the service, not about the request"""
+    return not isinstance(error, openai.BadRequestError)
+
+
+class CircuitBreaker:
+    """closed -> open at the failure rate -> half_open after the cooldown -> closed on a successful probe"""
+
+    def __init__(self, name: str, window: int = CIRCUIT_WINDOW, min_calls: int = CIRCUIT_MIN_CALLS,
+                 failure_rate: float = CIRCUIT_FAILURE_RATE, cooldown: float = CIRCUIT_COOLDOWN):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may be sent now; in half_open only one probe at a time"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            runtime_stats.incr(CIRCUIT_GROUP, f"{self.name}.rejected")
+            return False
+
+    @property
+    def probing(self) -> bool:
+        return self._probing
+
+    def abandon(self) -> None:
+        """The half-open probe was cancelled; let the next call probe instead"""
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                runtime_stats.incr(CIRCUIT_GROUP, f"{self.name}.probe_abandoned")
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                if not self._probing:
+                    return  # a call sent before the circuit opened
+                self._probing = False
+                if ok:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    runtime_stats.incr(CIRCUIT_GROUP, f"{self.name}.closed")
+                else:
+                    self._opened_at = time.monotonic()
+                return
+
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._opened_at = time.monotonic()
+                runtime_stats.incr(CIRCUIT_GROUP, f"{self.name}.opened")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": len(self._outcomes),
+                "failures": self._outcomes.count(False),
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+
+def breaker_for(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker(model)
+        return breaker
+
+
+def _tokens(response) -> int:
+    usage = getattr(response, "usage", None)
+    return int(getattr(usage, "total_tokens", 0) or 0)
+
+
+async def _tracked(send: Callable[[], Awaitable[T]], breaker: CircuitBreaker) -> T:
+    # In half_open the only call let through is the probe
+    probe = breaker.probing
+    try:
+        response = await send()
+    except asyncio.CancelledError:
+        if probe:
+            breaker.abandon()
+        raise
+    except Exception as e:
+        breaker.record(not is_failure(e))
+        raise
+    breaker.record(True)
+    return response
+
+
+async def hedged(send: Callable[[], Awaitable[T]], breaker: CircuitBreaker, delay: Optional[float]) -> T:
+    """Await `send()`; after `delay` seconds without an answer, race a second `send()` against it"""
+    tasks = [asyncio.ensure_future(_tracked(send, breaker))]
+    try:
+        if delay is not None:
+            runtime_stats.incr(HEDGE_GROUP, "eligible")
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and breaker.allow():
+                runtime_stats.incr(HEDGE_GROUP, "fired")
+                tasks.append(asyncio.ensure_future(_tracked(send, breaker)))
+
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                response = task.result()
+                if len(tasks) > 1:
+                    # "won": the duplicate answered first
+                    runtime_stats.incr(HEDGE_GROUP, "won" if task is tasks[1] else "lost")
+                    runtime_stats.incr(HEDGE_GROUP, "wasted_tokens", _tokens(response))
+                return response
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def hedge_stats() -> Dict[str, object]:
+    counts = runtime_stats.get(HEDGE_GROUP)
+    eligible = counts.get("eligible", 0)
+    fired = counts.get("fired", 0)
+    return {
+        **counts,
+        "hedge_rate": round(fired / eligible, 4) if eligible else 0.0,
+        "win_rate": round(counts.get("won", 0) / fired, 4) if fired else 0.0,
+    }
+
+
+def breaker_stats() -> Dict[str, Dict[str, object]]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.stats() for b in breakers}
@@ -0,0 +1,47 @@
+"""
+Timed acquisition of asyncio locks and semaphores.
+
+`asyncio.wait_for(lock.acquire(), timeout)` is not cancellation-safe on
+Python 3.11: when the timeout (or a client disconnect) cancels the wait just
+as the acquire succeeds, the lock stays held by nobody, and every later
+waiter times out. `acquire_within` runs the acquire as its own task and
+gives the permit back whenever the caller stops waiting after it was granted.
+
+    if not await acquire_within(lock, 5.0):
+        raise SessionBusy(...)
+    try:
+        ...
+    finally:
+        lock.release()
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Optional, Union
+
+Acquirable = Union[asyncio.Lock, asyncio.Semaphore]
+
+
+def _abandon(task: asyncio.Future, primitive: Acquirable) -> None:
+    """Stop waiting for `task`; a permit it already obtained is released"""
+    if not task.done():
+        # Lock / Semaphore.acquire hand a permit granted meanwhile to the next waiter
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        primitive.release()
+
+
+async def acquire_within(primitive: Acquirable, timeout: Optional[float]) -> bool:
+    """Acquire `primitive` within `timeout` seconds (None: no limit); False on timeout"""
+    task = asyncio.ensure_future(primitive.acquire())
+    try:
+        await asyncio.wait({task}, timeout=timeout)
+    except BaseException:
+        _abandon(task, primitive)
+        raise
+    if task.done():
+        task.result()
+        return True
+    _abandon(task, primitive)
+    return False
@@ -0,0 +1,201 @@
+"""
+Per-stage model routing with latency SLOs.
+
+Every LLM call names its stage: the prompt it sends (`translation`,
+`sql_query`, `message_to_code_extraction`, ...) or the structured output it
+parses (`classification`, `actions`, ...). The routing table gives each stage
+a model, a fast-profile model, a timeout, a completion-token cap, a retry
+count, a latency SLO and whether its calls may be hedged.
+
+Routes are layered:
+1. defaults from OPENAI_MODEL_CHAT / OPENAI_MODEL_STRUCT (and their _FAST variants)
+2. a JSON file named by MODEL_ROUTES_FILE: {"sql_query": {"model": "gpt-4o", "slo_ms": 4000}, ...}
+3. environment variables MODEL_ROUTE_<STAGE>_<FIELD>, e.g. MODEL_ROUTE_SQL_QUERY_TIMEOUT=20
+
+Each call is added to a latency histogram per stage and model (`llm_latency`
+in /v1/metrics). `recommend` reports, per stage with an SLO, the cheapest
+observed model whose p95 meets it. `hedge_delay` turns the same histograms
+into the wait before a hedged duplicate request.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+from config import (
+    HEDGE_MIN_DELAY_MS,
+    LLM_HEDGING,
+    MODEL_COST_ORDER,
+    MODEL_ROUTES_FILE,
+    OPENAI_MODEL_CHAT,
+    OPENAI_MODEL_CHAT_FAST,
+    OPENAI_MODEL_STRUCT,
+    OPENAI_MODEL_STRUCT_FAST,
+)
+from observability import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+ENV_PREFIX = "MODEL_ROUTE_"
+HISTOGRAM_GROUP = "llm_latency"
+MIN_SAMPLES = 20  # per stage and model, before a recommendation is made
+
+# Structured-output stages default to the struct model
+STRUCT_STAGES = {"classification", "actions", "decomposition", "answer_judge"}
+# Structured stages that default to the chat model: optional planning calls in
+# front of SQL, which must not add a reasoning model's latency to follow-ups
+CHAT_STRUCT_STAGES = {"dataframe_ops"}
+
+# Latency objectives for the user-facing critical path (p95, ms)
+DEFAULT_SLOS_MS = {
+    "translation": 1500,
+    "message_to_request": 2500,
+    "classification": 4000,
+    "actions": 4000,
+    "message_to_simple_question": 2500,
+    "sql_query": 4000,
+    "final_answer": 5000,
+    "not_on_topic": 2500,
+    "context_not_sufficient": 2500,
+}
+
+
+@dataclass(frozen=True)
+class StageRoute:
+    """How one stage calls the LLM"""
+    model: str
+    fast_model: str
+    timeout: float = 30.0
+    max_tokens: Optional[int] = None
+    retries: int = 3
+    slo_ms: Optional[int] = None
+    hedge: Optional[bool] = None  # None follows LLM_HEDGING
+
+
+def _flag(value: object) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+_CASTS = {
+    "model": str, "fast_model": str, "timeout": float, "max_tokens": int,
+    "retries": int, "slo_ms": int, "hedge": _flag,
+}
+# Longest suffix first: FAST_MODEL before MODEL
+_ENV_FIELDS = sorted(_CASTS, key=len, reverse=True)
+
+
+def _cast(values: Mapping[str, object]) -> Dict[str, object]:
+    unknown = set(values) - set(_CASTS)
+    if unknown:
+        raise ValueError(f"Unknown route fields: {sorted(unknown)}")
+    return {k: None if v in (None, "") else _CASTS[k](v) for k, v in values.items()}
+
+
+def _env_overrides(env: Mapping[str, str]) -> Dict[str, Dict[str, object]]:
+    overrides: Dict[str, Dict[str, object]] = {}
+    for key, value in env.items():
+        if not key.startswith(ENV_PREFIX):
+            continue
+        rest = key[len(ENV_PREFIX):]
+        for name in _ENV_FIELDS:
+            suffix = "_" + name.upper()
+            if rest.endswith(suffix) and len(rest) > len(suffix):
+                stage = rest[: -len(suffix)].lower()
+                overrides.setdefault(stage, {})[name] = value
+                break
+        else:
+            logger.warning("Ignoring %s: no known route field suffix", key)
+    return overrides
+
+
+class RoutingTable:
+    """Stage name -> StageRoute, with chat / struct defaults for unlisted stages"""
+
+    def __init__(self, routes: Optional[Dict[str, StageRoute]] = None,
+                 chat_default: Optional[StageRoute] = None, struct_default: Optional[StageRoute] = None):
+        self.chat_default = chat_default or StageRoute(OPENAI_MODEL_CHAT, OPENAI_MODEL_CHAT_FAST)
+        self.struct_default = struct_default or StageRoute(OPENAI_MODEL_STRUCT, OPENAI_MODEL_STRUCT_FAST)
+        self.routes: Dict[str, StageRoute] = dict(routes or {})
+
+    @classmethod
+    def load(cls, env: Mapping[str, str] = os.environ, path: Optional[str] = MODEL_ROUTES_FILE) -> "RoutingTable":
+        table = cls()
+        layers: Dict[str, Dict[str, object]] = {stage: {} for stage in CHAT_STRUCT_STAGES}
+        layers.update({stage: {"slo_ms": slo} for stage, slo in DEFAULT_SLOS_MS.items()})
+        if path:
+            for stage, values in json.loads(Path(path).read_text(encoding="utf-8")).items():
+                layers.setdefault(stage, {}).update(values)
+        for stage, values in _env_overrides(env).items():
+            layers.setdefault(stage, {}).update(values)
+
+        for stage, values in layers.items():
+            base = table.struct_default if stage in STRUCT_STAGES else table.chat_default
+            table.routes[stage] = replace(base, **_cast(values))
+        return table
+
+    def route(self, stage: Optional[str], structured: bool = False) -> StageRoute:
+        if stage in self.routes:
+            return self.routes[stage]
+        return self.struct_default if structured else self.chat_default
+
+    def record(self, stage: Optional[str], model: str, seconds: float) -> None:
+        runtime_stats.histogram(HISTOGRAM_GROUP, f"{stage or 'unrouted'}:{model}", seconds)
+
+    def recommend(self, min_samples: int = MIN_SAMPLES) -> Dict[str, Dict[str, object]]:
+        """Per stage with an SLO: configured model, observed p95 per model, cheapest model meeting the SLO"""
+        observed: Dict[str, Dict[str, Dict[str, object]]] = {}
+        for key, hist in runtime_stats.histograms(HISTOGRAM_GROUP).items():
+            stage, _, model = key.partition(":")
+            observed.setdefault(stage, {})[model] = hist
+
+        def cost(model: str) -> int:
+            return MODEL_COST_ORDER.index(model) if model in MODEL_COST_ORDER else len(MODEL_COST_ORDER)
+
+        report = {}
+        for stage, route in sorted(self.routes.items()):
+            if route.slo_ms is None:
+                continue
+            models = observed.get(stage, {})
+            meeting = [
+                m for m, h in models.items()
+                if h["count"] >= min_samples and h["p95_ms"] is not None and h["p95_ms"] <= route.slo_ms
+            ]
+            report[stage] = {
+                "model": route.model,
+                "slo_ms": route.slo_ms,
+                "p95_ms": {m: h["p95_ms"] for m, h in models.items()},
+                "samples": {m: h["count"] for m, h in models.items()},
+                "recommended": min(meeting, key=cost) if meeting else None,
+            }
+        return report
+
+    def hedge_delay(self, stage: Optional[str], model: str, min_samples: int = MIN_SAMPLES) -> Optional[float]:
+        """Seconds to wait before hedging a call; None when the stage is not hedged
+
+        The delay is the stage's observed p95 for `model`, or its SLO until
+        enough calls have been seen.
+        """
+        route = self.route(stage)
+        if not (LLM_HEDGING if route.hedge is None else route.hedge):
+            return None
+        hist = runtime_stats.histograms(HISTOGRAM_GROUP).get(f"{stage or 'unrouted'}:{model}")
+        if hist and hist["count"] >= min_samples and hist["p95_ms"] is not None:
+            delay_ms = hist["p95_ms"]
+        elif route.slo_ms is not None:
+            delay_ms = route.slo_ms
+        else:
+            return None
+        return max(delay_ms, HEDGE_MIN_DELAY_MS) / 1000
+
+    def describe(self) -> Dict[str, Dict[str, object]]:
+        return {stage: {f.name: getattr(route, f.name) for f in fields(route)} for stage, route in self.routes.items()}
+
+
+model_routes = RoutingTable.load()
@@ -0,0 +1,83 @@
+"""
+Process-wide runtime statistics shared by the agents and the API.
+Counters are grouped by topic (e.g. "code_extraction") and exported by /v1/metrics.
+Latency histograms use fixed millisecond buckets, cheap enough for every LLM call.
+"""
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from threading import Lock
+from typing import Dict, List, Optional
+
+# Upper bounds (ms); the last bucket is open-ended
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+class RuntimeStats:
+    """Thread-safe grouped counters"""
+
+    def __init__(self):
+        self._counters: Dict[str, Counter] = defaultdict(Counter)
+        self._histograms: Dict[str, Dict[str, List[int]]] = defaultdict(dict)
+        self._lock = Lock()
+
+    def incr(self, group: str, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[group][key] += amount
+
+    def observe(self, group: str, key: str, seconds: float) -> None:
+        """Count one timed event under `key` and accumulate its duration in ms"""
+        with self._lock:
+            self._counters[group][f"{key}.count"] += 1
+            self._counters[group][f"{key}.ms"] += int(seconds * 1000)
+
+    def histogram(self, group: str, key: str, seconds: float) -> None:
+        """Add one latency sample to the `key` histogram"""
+        index = bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+        with self._lock:
+            counts = self._histograms[group].setdefault(key, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            counts[index] += 1
+
+    def histograms(self, group: str) -> Dict[str, Dict[str, object]]:
+        """Bucket counts and estimated p50 / p95 (bucket upper bounds) per key"""
+        with self._lock:
+            raw = {key: list(counts) for key, counts in self._histograms.get(group, {}).items()}
+        labels = [f"<={b}" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            key: {
+                "count": sum(counts),
+                "buckets": dict(zip(labels, counts)),
+                "p50_ms": _quantile(counts, 0.5),
+                "p95_ms": _quantile(counts, 0.95),
+            }
+            for key, counts in raw.items()
+        }
+
+    def get(self, group: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters.get(group, {}))
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {group: dict(counter) for group, counter in self._counters.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+def _quantile(counts: List[int], q: float) -> Optional[int]:
+    """Upper bound of the bucket holding the q-quantile; None when empty or open-ended"""
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, counts):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return None
+
+
+runtime_stats = RuntimeStats()
@@ -0,0 +1,128 @@
+"""
+Process-wide OpenAI client for the API service.
+
+Every session used to build its own `AsyncOpenAI`, so the first calls of each
+session paid TCP/TLS setup and idle clients piled up with the sessions. The
+service now opens one client in its lifespan, on an `httpx` pool tuned for
+keep-alive (and HTTP/2 when `h2` is installed), warms a few connections in the
+background and hands the client to every agent.
+
+    client = open_client()
+    agent = ImprovedAgentChat(conn, client=client)
+
+`client_stats()` reports the pool's connections for /v1/metrics.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from config import (
+    OPENAI_HTTP2,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE,
+    OPENAI_POOL_WARM,
+)
+from observability import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[AsyncOpenAI] = None
+_http: Optional[httpx.AsyncClient] = None
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+async def _count_request(request: httpx.Request) -> None:
+    runtime_stats.incr("openai_http", "requests")
+
+
+def build_http_client(http2: bool = OPENAI_HTTP2) -> httpx.AsyncClient:
+    """httpx client with the service's pool limits; per-call timeouts come from the model routes"""
+    if http2 and not http2_available():
+        logger.warning("h2 not installed, the OpenAI pool uses HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        event_hooks={"request": [_count_request]},
+    )
+
+
+def open_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """The shared client, created on first use"""
+    global _client, _http
+    if _client is None:
+        _http = build_http_client()
+        _client = AsyncOpenAI(api_key=api_key, http_client=_http)
+    return _client
+
+
+def shared_client() -> Optional[AsyncOpenAI]:
+    return _client
+
+
+async def warm_up(client: AsyncOpenAI, connections: int = OPENAI_POOL_WARM) -> int:
+    """Open `connections` pooled connections with cheap concurrent requests; returns how many got through
+
+    Any HTTP response, an authentication error included, leaves a warm
+    connection behind.
+    """
+    probe = client.with_options(max_retries=0, timeout=10.0)
+
+    async def one() -> bool:
+        try:
+            await probe.models.list()
+        except openai.APIStatusError:
+            pass
+        except (openai.APIConnectionError, httpx.HTTPError) as e:
+            logger.warning("OpenAI pool warm-up failed: %s", e)
+            return False
+        return True
+
+    warmed = sum(await asyncio.gather(*(one() for _ in range(connections))))
+    runtime_stats.incr("openai_http", "warmed", warmed)
+    logger.info("OpenAI pool warmed: %d/%d connections", warmed, connections)
+    return warmed
+
+
+def client_stats() -> Dict[str, object]:
+    """Connections of the shared pool; empty before the client is opened"""
+    if _http is None:
+        return {}
+    # httpx does not expose its pool; read the httpcore pool behind the transport
+    pool = getattr(getattr(_http, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    return {
+        "connections": len(connections),
+        "idle": sum(1 for c in connections if c.is_idle()),
+        "http2": sum(1 for c in connections if "HTTP/2" in c.info()),
+        "max_connections": OPENAI_MAX_CONNECTIONS,
+        "requests": runtime_stats.get("openai_http").get("requests", 0),
+        "warmed": runtime_stats.get("openai_http").get("warmed", 0),
+    }
+
+
+async def close_client() -> None:
+    global _client, _http
+    if _client is not None:
+        await _client.close()  # also closes the http client it was given
+    _client = _http = None
@@ -0,0 +1,166 @@
+"""
+Small DAG-based stage scheduler for the agent pipeline.
+
+Stages declare the state keys they read (`inputs`, passed positionally),
+the keys they write (`outputs`) and keys they only need to wait for
+(`after`). The runner starts every stage whose keys are resolved, so
+independent stages run concurrently, and records per-stage status, attempts
+and timing. A key is resolved once it is in the state or every stage that
+could produce it has finished; stages missing an input, or whose `when`
+predicate is false, are skipped. Sync callables run in a worker thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class Stage:
+    """One unit of work in a pipeline"""
+    name: str
+    func: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    after: Tuple[str, ...] = ()
+    when: Optional[Callable[[Dict[str, Any]], bool]] = None
+    timeout: Optional[float] = None
+    retries: int = 0
+
+
+@dataclass
+class StageResult:
+    """Outcome of a stage within one run"""
+    name: str
+    status: str  # ok | skipped | failed
+    duration: float = 0.0
+    attempts: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class PipelineRun:
+    """Final state and per-stage results of a run"""
+    state: Dict[str, Any]
+    results: Dict[str, StageResult] = field(default_factory=dict)
+    total_time: float = 0.0
+
+    def timings(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {"status": r.status, "duration": round(r.duration, 4), "attempts": r.attempts}
+            for name, r in self.results.items()
+        }
+
+
+class PipelineError(RuntimeError):
+    """Raised when a stage fails after its retries, or the graph cannot progress"""
+
+    def __init__(self, stage: str, message: str):
+        super().__init__(f"Stage '{stage}' failed: {message}")
+        self.stage = stage
+
+
+class Pipeline:
+    """Runs a set of stages as a dependency graph"""
+
+    def __init__(self, stages: Iterable[Stage]):
+        self.stages: List[Stage] = list(stages)
+        names = [s.name for s in self.stages]
+        if len(names) != len(set(names)):
+            raise ValueError("Stage names must be unique")
+
+        self._producers: Dict[str, List[str]] = {}
+        for stage in self.stages:
+            for key in stage.outputs:
+                self._producers.setdefault(key, []).append(stage.name)
+
+    def _resolved(self, key: str, state: Dict[str, Any], finished: set) -> bool:
+        return key in state or all(p in finished for p in self._producers.get(key, []))
+
+    async def run(self, state: Dict[str, Any]) -> PipelineRun:
+        run = PipelineRun(state=state)
+        start = time.time()
+        pending = {s.name: s for s in self.stages}
+        running: Dict[asyncio.Task, Stage] = {}
+        finished: set = set()
+
+        try:
+            while pending or running:
+                progressed = False
+                for name, stage in list(pending.items()):
+                    keys = stage.inputs + stage.after
+                    if not all(self._resolved(k, state, finished) for k in keys):
+                        continue
+                    del pending[name]
+                    progressed = True
+                    if any(k not in state for k in keys) or (stage.when and not stage.when(state)):
+                        run.results[name] = StageResult(name, "skipped")
+                        finished.add(name)
+                        continue
+                    running[asyncio.create_task(self._run_stage(stage, state))] = stage
+
+                if not running:
+                    if pending and not progressed:
+                        raise PipelineError(next(iter(pending)), "inputs can never be resolved")
+                    continue
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage = running.pop(task)
+                    result, values = task.result()
+                    run.results[stage.name] = result
+                    finished.add(stage.name)
+                    if result.status == "failed":
+                        raise PipelineError(stage.name, result.error)
+                    state.update(values)
+        finally:
+            for task in running:
+                task.cancel()
+            run.total_time = time.time() - start
+
+        return run
+
+    async def _run_stage(self, stage: Stage, state: Dict[str, Any]) -> Tuple[StageResult, Dict[str, Any]]:
+        args = [state[k] for k in stage.inputs]
+        result = StageResult(stage.name, "ok")
+        start = time.time()
+
+        for attempt in range(1, stage.retries + 2):
+            result.attempts = attempt
+            try:
+                value = await asyncio.wait_for(self._call(stage.func, args), stage.timeout)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = "timed out" if isinstance(e, asyncio.TimeoutError) else str(e) or type(e).__name__
+                if attempt > stage.retries:
+                    result.status, result.error = "failed", error
+                    result.duration = time.time() - start
+                    return result, {}
+
+        result.duration = time.time() - start
+        return result, self._outputs(stage, value)
+
+    @staticmethod
+    async def _call(func: Callable[..., Any], args: List[Any]) -> Any:
+        if inspect.iscoroutinefunction(func) or asyncio.iscoroutinefunction(func):
+            return await func(*args)
+        value = await asyncio.to_thread(func, *args)
+        return await value if inspect.isawaitable(value) else value
+
+    @staticmethod
+    def _outputs(stage: Stage, value: Any) -> Dict[str, Any]:
+        if not stage.outputs:
+            return {}
+        if len(stage.outputs) == 1:
+            return {stage.outputs[0]: value}
+        return dict(zip(stage.outputs, value))
+
+    def run_sync(self, state: Dict[str, Any]) -> PipelineRun:
+        """Entry point for synchronous callers (e.g. the Streamlit agent)"""
+        return asyncio.run(self.run(state))
@@ -391,6 +391,41 @@ actions_messages = [
     {"role": "system", "content": actions_system},
 ]
 
+# Dataframe Operations - System
+dataframe_ops_system = """
+You are a data analyst working on the result of the previous SQL query, held in memory as a table.
+You will receive the user request and the columns of the current table, with their types, a profile and a few rows.
+Decide whether the request can be answered by transforming this table alone, e.g. filtering, sorting, keeping the top N rows, grouping and aggregating, or pivoting.
+If it needs any column, row or table that is not in the current data (for example a different period, unit or system than the ones filtered in, or another table of the database), set uses_current_data_only to false and return no operations.
+Otherwise set uses_current_data_only to true and return the operations, applied in order:
+- filter: column, operator (==, !=, >, >=, <, <=, in, contains) and value (comma separated for in).
+- sort: column and ascending.
+- top_k: column, n and ascending (false for the largest values).
+- group: by (the key columns), column (the values) and agg (sum, mean, median, count, min, max).
+- pivot: by (row keys), pivot_column, column (the values) and agg.
+- select: by (the columns to keep).
+Use column names exactly as given and leave the fields an operation does not use empty.
+"""
+
+# Dataframe Operations - Messages
+dataframe_ops_messages = [
+    {"role": "system", "content": dataframe_ops_system},
+]
+
+# Decomposition - System
+decomposition_system = """
+You split data requests about the maintenance database into independent sub-questions.
+Set is_multi_part to true only when the request combines several measures or compares several groups that are easier to query separately, for example downtime and job counts, or Motor versus Transmision.
+Each sub-question must be self-contained, answerable with one simple SQL query, and return the same key columns so the results can be merged side by side.
+List those key columns in join_keys with the names the queries should use (e.g. UnitId, month, system), and ask for them explicitly in every sub-question.
+Use at most 4 sub-questions. If the request is a single question, set is_multi_part to false and return no sub-questions.
+"""
+
+# Decomposition - Messages
+decomposition_messages = [
+    {"role": "system", "content": decomposition_system},
+]
+
 # Default Prompts Dictionary
 default_prompts = {
     'translation' : translate_messages, 
@@ -406,4 +441,64 @@ default_prompts = {
     'summarize_interaction': summarize_interactions_messages,
     'update_context': update_context_messages,
     'actions': actions_messages,
-}
\ No newline at end of file
+    'dataframe_ops': dataframe_ops_messages,
+    'decomposition': decomposition_messages,
+}
+
+# ─────────────────────────── DIRECT SPANISH MODE ─────────────────────────── #
+# The Spanish user message is consumed directly and the user-facing replies are
+# written in Spanish, so neither translation round trip is needed. Internal
+# steps (request, SQL, chart instructions, context) stay in English.
+
+spanish_input_rule = """
+Language:
+- The user writes in Spanish. Write your output in English, keeping identifiers (e.g. UnitId values like T_01, system or component names) exactly as written.
+"""
+
+spanish_output_rule = """
+Language:
+- Write your whole answer in natural, neutral Spanish, addressing the user directly.
+- Keep identifiers (e.g. UnitId values like T_01, column, system or component names) exactly as they appear in the data.
+"""
+
+spanish_prompts = {
+    **default_prompts,
+    'message_to_request' : [{"role": "system", "content": message_to_request_system + spanish_input_rule}],
+    'not_on_topic' : [{"role": "system", "content": not_on_topic_system + spanish_output_rule}],
+    'context_not_sufficient': [{"role": "system", "content": no_context_system + spanish_output_rule}],
+    'final_answer' : [{"role": "system", "content": message_to_final_answer + spanish_output_rule}],
+}
+
+# Prompt sets by mode ("translate": translate around the English prompts)
+prompt_sets = {
+    'translate': default_prompts,
+    'spanish': spanish_prompts,
+}
+
+# Fixed replies (no LLM involved), in the language each mode answers in
+fixed_replies = {
+    'translate': {
+        'image_pending': "The new image is being generated and will be available shortly.",
+        'image_updated': "The image has been updated successfully.",
+        'sql_failed': "Sorry, I couldn't retrieve the requested data. Please try again.",
+    },
+    'spanish': {
+        'image_pending': "La nueva imagen se está generando y estará disponible en breve.",
+        'image_updated': "La imagen se ha actualizado correctamente.",
+        'sql_failed': "Lo siento, no pude obtener los datos solicitados. Por favor, inténtalo de nuevo.",
+    },
+}
+
+# Answer Judge (evaluation harness) - System
+answer_judge_system = """
+You are a strict evaluator of a maintenance-analytics chatbot that answers in Spanish.
+You will receive the user question and two candidate answers, A and B, produced for the same question against the same database.
+Score each answer from 1 (wrong, unhelpful or not in Spanish) to 5 (correct, complete, clear and natural Spanish).
+Judge correctness and consistency first, then clarity and language quality. Do not reward length.
+Set preferred to "A", "B" or "tie".
+"""
+
+# Answer Judge - Messages
+answer_judge_messages = [
+    {"role": "system", "content": answer_judge_system},
+]
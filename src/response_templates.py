@@ -0,0 +1,99 @@
+"""
+Local Spanish replies that replace an LLM call (and its translation) for
+answers that are essentially fixed: the two bad flows and scalar / tiny query
+results. Anything richer returns None and the caller falls back to the LLM.
+
+Replies are `LocalReply` strings tagged with their language, so the pipeline
+can skip the outbound translation.
+"""
+
+from __future__ import annotations
+
+import math
+import numbers
+from typing import Optional
+
+import pandas as pd
+
+from config import RESPONSE_TEMPLATES, TEMPLATE_MAX_COLS, TEMPLATE_MAX_ROWS
+
+
+class LocalReply(str):
+    """A reply produced from a template; already in the user's language"""
+    lang = "spanish"
+    source = "template"
+
+
+BAD_FLOW_TEMPLATES = {
+    "not_on_topic": (
+        "Lo siento, esa pregunta está fuera de mi ámbito. Estoy especializado en los datos de "
+        "mantenimiento del taller: ciclos de mantenimiento, sistemas, subsistemas, componentes y "
+        "trabajos realizados. Si quieres, pregúntame algo sobre esos datos."
+    ),
+    "context_not_sufficient": (
+        "No tengo suficiente contexto para responder a esa pregunta. ¿Podrías darme más detalles, "
+        "por ejemplo el equipo (T_XX), el sistema o el periodo que te interesa?"
+    ),
+}
+
+
+def enabled(kind: str) -> bool:
+    return kind in RESPONSE_TEMPLATES
+
+
+def format_value(value) -> str:
+    """Spanish number formatting (1.234,5); other values as text"""
+    if value is None or (isinstance(value, numbers.Real) and math.isnan(value)):
+        return "sin datos"
+    if isinstance(value, bool) or type(value).__name__ == "bool_":
+        return "sí" if value else "no"
+    if isinstance(value, numbers.Integral) or (isinstance(value, numbers.Real) and float(value).is_integer()):
+        return f"{int(value):,}".replace(",", ".")
+    if isinstance(value, numbers.Real):
+        return f"{float(value):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return str(value)
+
+
+def bad_flow_reply(reason: str) -> Optional[LocalReply]:
+    if not enabled("bad_flow") or reason not in BAD_FLOW_TEMPLATES:
+        return None
+    return LocalReply(BAD_FLOW_TEMPLATES[reason])
+
+
+def result_reply(df: pd.DataFrame) -> Optional[LocalReply]:
+    """Template answer for empty, scalar or tiny results; None when the LLM should explain"""
+    if df is None:
+        return None
+    if df.empty and enabled("scalar"):
+        return LocalReply("La consulta no devolvió resultados para tu solicitud.")
+
+    rows, cols = df.shape
+    values = df.astype(object).where(df.notna(), None)
+    if rows == 1 and cols == 1 and enabled("scalar"):
+        column = str(df.columns[0])
+        return LocalReply(f"El resultado es **{format_value(values.iat[0, 0])}** (`{column}`).")
+
+    if not enabled("table") or rows > TEMPLATE_MAX_ROWS or cols > TEMPLATE_MAX_COLS:
+        return None
+    if rows == 1:
+        lines = [f"- `{c}`: {format_value(v)}" for c, v in zip(df.columns, values.iloc[0])]
+        return LocalReply("Este es el resultado:\n" + "\n".join(lines))
+
+    header = "| " + " | ".join(str(c) for c in df.columns) + " |"
+    rule = "|" + "---|" * cols
+    body = ["| " + " | ".join(format_value(v) for v in row) + " |" for row in values.itertuples(index=False)]
+    return LocalReply("Estos son los resultados:\n\n" + "\n".join([header, rule, *body]))
+
+
+def partial_reply(df: pd.DataFrame) -> LocalReply:
+    """First rows of a result, when there is no time left to explain it"""
+    rows = len(df)
+    head = df.head(TEMPLATE_MAX_ROWS).astype(object).where(df.head(TEMPLATE_MAX_ROWS).notna(), None)
+    header = "| " + " | ".join(str(c) for c in df.columns) + " |"
+    rule = "|" + "---|" * len(df.columns)
+    body = ["| " + " | ".join(format_value(v) for v in row) + " |" for row in head.itertuples(index=False)]
+    shown = f"las primeras {len(head)} de {format_value(rows)} filas" if rows > len(head) else f"{rows} filas"
+    return LocalReply(
+        f"Respuesta parcial por límite de tiempo: estas son {shown} del resultado.\n\n"
+        + "\n".join([header, rule, *body])
+    )
@@ -0,0 +1,134 @@
+"""
+Token-budgeted digest of a query result for the final-answer prompt.
+
+Small results are sent as the full table, as before. Larger ones are replaced
+by vectorised column profiles (non-null counts, min / max / mean, top
+categories, time ranges) plus a representative sample of rows that fills the
+remaining budget. The full table stays on disk as `data_N.csv`.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import RESULT_DIGEST_FULL_ROWS, RESULT_DIGEST_TOKENS, RESULT_DIGEST_TOP_K
+from conversation_state import estimate_tokens
+
+# Text columns whose name suggests a date are profiled as a time range
+_DATE_HINTS = ("date", "time", "fecha", "day", "month", "year")
+_MIN_SAMPLE_ROWS = 3
+_FLOAT_FORMAT = "%.6g"
+
+
+@dataclass
+class ResultDigest:
+    """What the LLM sees of a result"""
+    text: str
+    rows: int
+    columns: int
+    sample_rows: int
+    full: bool  # the whole table was included
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+
+def _fmt(value) -> str:
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.4g}"
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat(sep=" ").removesuffix(" 00:00:00")
+    return str(value)
+
+
+def _as_datetime(series: pd.Series) -> Optional[pd.Series]:
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if not pd.api.types.is_object_dtype(series) or not any(h in str(series.name).lower() for h in _DATE_HINTS):
+        return None
+    parsed = pd.to_datetime(series, errors="coerce")
+    # Mostly unparseable: treat as text
+    return parsed if parsed.notna().sum() >= 0.8 * series.notna().sum() else None
+
+
+def profile_column(series: pd.Series, top_k: int = RESULT_DIGEST_TOP_K) -> str:
+    """One line describing a column"""
+    non_null = int(series.notna().sum())
+    head = f"- {series.name} ({series.dtype}): {non_null} non-null"
+
+    dates = _as_datetime(series)
+    if dates is not None:
+        if not dates.notna().any():
+            return head
+        return f"{head}, from {_fmt(dates.min())} to {_fmt(dates.max())}"
+
+    if pd.api.types.is_bool_dtype(series):
+        return f"{head}, {int(series.sum())} true"
+
+    if pd.api.types.is_numeric_dtype(series):
+        if not non_null:
+            return head
+        return (
+            f"{head}, min {_fmt(series.min())}, max {_fmt(series.max())}, "
+            f"mean {_fmt(series.mean())}, sum {_fmt(series.sum())}"
+        )
+
+    counts = series.value_counts(dropna=True)
+    top = ", ".join(f"{value} ({count})" for value, count in counts.head(top_k).items())
+    return f"{head}, {len(counts)} distinct; top: {top}"
+
+
+def sample_rows(df: pd.DataFrame, n: int) -> pd.DataFrame:
+    """First rows plus evenly spaced rows across the rest, in original order"""
+    if n >= len(df):
+        return df
+    head = min(_MIN_SAMPLE_ROWS, n)
+    spread = np.linspace(head, len(df) - 1, num=n - head).astype(int) if n > head else np.array([], dtype=int)
+    positions = np.unique(np.concatenate([np.arange(head), spread]))
+    return df.iloc[positions]
+
+
+def digest(
+    df: pd.DataFrame,
+    token_budget: int = RESULT_DIGEST_TOKENS,
+    source: Optional[Path] = None,
+    full_rows: int = RESULT_DIGEST_FULL_ROWS,
+) -> ResultDigest:
+    """Full table when it is small and fits `token_budget`, otherwise profiles plus a sample"""
+    rows, cols = df.shape
+    if rows <= full_rows:
+        table = df.to_string(index=False)
+        if estimate_tokens(table) <= token_budget:
+            return ResultDigest(table, rows, cols, rows, True)
+
+    lines: List[str] = [f"{rows} rows x {cols} columns"
+                        + (f" (full table saved as {Path(source).name})" if source else "") + "."]
+    lines.append("Column profile:")
+    lines.extend(profile_column(df[c]) for c in df.columns)
+    text = "\n".join(lines)
+
+    # Size the sample from the average width of a CSV row
+    remaining = token_budget - estimate_tokens(text) - estimate_tokens(",".join(map(str, df.columns)))
+    probe = df.head(20).to_csv(index=False, header=False, float_format=_FLOAT_FORMAT)
+    per_row = max(estimate_tokens(probe) / max(min(rows, 20), 1), 1)
+    n = int(max(remaining, 0) // per_row)
+    n = min(max(n, _MIN_SAMPLE_ROWS), rows)
+
+    def render(sample: pd.DataFrame) -> str:
+        csv = sample.to_csv(index=False, float_format=_FLOAT_FORMAT)
+        return f"{text}\nRepresentative sample of {len(sample)} rows (CSV):\n{csv}"
+
+    sample = sample_rows(df, n)
+    out = render(sample)
+    # Wide rows can still overshoot: shrink until it fits or only the minimum is left
+    while len(sample) > _MIN_SAMPLE_ROWS and estimate_tokens(out) > token_budget:
+        sample = sample_rows(df, max(int(len(sample) * 0.8), _MIN_SAMPLE_ROWS))
+        out = render(sample)
+
+    return ResultDigest(out, rows, cols, len(sample), False)
@@ -0,0 +1,244 @@
+"""
+Where API sessions live outside a worker's memory.
+
+`SessionStore` keeps recently used agents in memory and hands their
+serialised state to a backend:
+
+- `FileSessionBackend` (default): one file per session in a local directory,
+  private to the process. Sessions are written when they are evicted. The
+  file stays after the session is loaded back, as the copy a failed turn
+  falls back to, until the session is evicted again (overwritten) or deleted.
+- `SQLiteSessionBackend`: one SQLite file shared by every worker on the host,
+  a local stand-in for Redis. State is written after every turn with a
+  version number (compare-and-set), and a lease row per session makes turns
+  of one session exclusive across workers. Any worker can serve any session
+  without sticky routing.
+
+Backends are synchronous; the store calls them from a thread.
+"""
+
+from __future__ import annotations
+
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Collection, Dict, Optional, Tuple
+
+from config import SESSION_BACKEND, SESSION_DB_PATH, SESSION_SPILL_DIR
+
+_SESSION_ID = re.compile(r"^[\w-]{1,64}$")  # ids become file names and keys
+
+
+class SessionConflict(RuntimeError):
+    """The stored session changed since it was loaded"""
+
+
+class SessionBusy(RuntimeError):
+    """Another request holds the session"""
+
+
+def valid_session_id(session_id: str) -> bool:
+    return bool(_SESSION_ID.match(session_id or ""))
+
+
+class SessionBackend:
+    """Storage for serialised sessions; `shared` backends are visible to every worker"""
+
+    name = "base"
+    shared = False
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        """(version, payload) of a stored session, None when unknown"""
+        raise NotImplementedError
+
+    def version(self, session_id: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def save(self, session_id: str, payload: bytes, expected_version: Optional[int] = None) -> int:
+        """Store `payload`; raises SessionConflict if the stored version is not `expected_version`"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def acquire(self, session_id: str, owner: str, ttl: float) -> bool:
+        """Take the session's lease for `ttl` seconds; False while someone else holds it"""
+        return True
+
+    def release(self, session_id: str, owner: str) -> None:
+        pass
+
+    def purge(self, older_than: float, keep: Collection[str] = ()) -> int:
+        """Delete sessions last saved before the `older_than` timestamp, except those in `keep`"""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FileSessionBackend(SessionBackend):
+    """One file per session in a local directory"""
+
+    name = "file"
+
+    def __init__(self, directory: Path = SESSION_SPILL_DIR):
+        self.directory = Path(directory)
+
+    def _path(self, session_id: str) -> Path:
+        if not valid_session_id(session_id):
+            raise ValueError(f"Invalid session id {session_id!r}")
+        return self.directory / f"{session_id}.session"
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            return 0, self._path(session_id).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def version(self, session_id: str) -> Optional[int]:
+        return 0 if self._path(session_id).exists() else None
+
+    def save(self, session_id: str, payload: bytes, expected_version: Optional[int] = None) -> int:
+        path = self._path(session_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(payload)
+        tmp.replace(path)
+        return 0
+
+    def delete(self, session_id: str) -> bool:
+        path = self._path(session_id)
+        if not path.exists():
+            return False
+        path.unlink(missing_ok=True)
+        return True
+
+    def purge(self, older_than: float, keep: Collection[str] = ()) -> int:
+        removed = 0
+        for path in self.directory.glob("*.session"):
+            if path.stem in keep:
+                continue
+            try:
+                if path.stat().st_mtime < older_than:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def count(self) -> int:
+        return sum(1 for _ in self.directory.glob("*.session")) if self.directory.exists() else 0
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Sessions and per-session leases in one SQLite file shared by the workers"""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path: Path = SESSION_DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), timeout=10.0, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, version INTEGER NOT NULL,"
+                " payload BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_leases ("
+                " session_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def load(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, payload FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return None if row is None else (row[0], bytes(row[1]))
+
+    def version(self, session_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, session_id: str, payload: bytes, expected_version: Optional[int] = None) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                current = row[0] if row else 0
+                if expected_version is not None and current != expected_version:
+                    raise SessionConflict(f"Session {session_id} is at version {current}, not {expected_version}")
+                self._conn.execute(
+                    "INSERT INTO sessions (session_id, version, payload, updated_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET"
+                    " version = excluded.version, payload = excluded.payload, updated_at = excluded.updated_at",
+                    (session_id, current + 1, payload, time.time()),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return current + 1
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM session_leases WHERE session_id = ?", (session_id,))
+        return cur.rowcount > 0
+
+    def acquire(self, session_id: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # Taken only when free, expired or already ours
+            cur = self._conn.execute(
+                "INSERT INTO session_leases (session_id, owner, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                " WHERE session_leases.owner = excluded.owner OR session_leases.expires_at < ?",
+                (session_id, owner, now + ttl, now),
+            )
+        return cur.rowcount > 0
+
+    def release(self, session_id: str, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM session_leases WHERE session_id = ? AND owner = ?", (session_id, owner))
+
+    def purge(self, older_than: float, keep: Collection[str] = ()) -> int:
+        with self._lock:
+            expired = [
+                (session_id, older_than)
+                for (session_id,) in self._conn.execute(
+                    "SELECT session_id FROM sessions WHERE updated_at < ?", (older_than,)
+                )
+                if session_id not in keep
+            ]
+            cur = self._conn.executemany("DELETE FROM sessions WHERE session_id = ? AND updated_at < ?", expired)
+            self._conn.execute("DELETE FROM session_leases WHERE expires_at < ?", (time.time(),))
+        return cur.rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def backend_from_config(kind: str = SESSION_BACKEND) -> SessionBackend:
+    backends: Dict[str, type] = {"file": FileSessionBackend, "sqlite": SQLiteSessionBackend}
+    if kind not in backends:
+        raise ValueError(f"Unknown session backend '{kind}'")
+    return backends[kind]()
@@ -0,0 +1,507 @@
+"""
+Bounded session store for the API service.
+
+Sessions used to live in a plain dict capped at 100 entries, evicted in
+insertion order, so an active conversation could be dropped mid-way. The
+store tracks each session's last access and estimated memory (result frame,
+chart bytes, conversation text). It moves sessions out of memory when:
+
+- they have been idle for SESSION_IDLE_TTL, or
+- the store holds more than SESSION_MAX sessions or SESSION_MAX_BYTES (least
+  recently used first).
+
+Evicted sessions are written to a `SessionBackend` (session_backend.py) and
+rehydrated transparently on their next request. Sessions serving a request or
+running background work (a chart, a context summary) are never evicted.
+
+Turns of one session are serialised: concurrent requests for the same id
+wait in arrival order (or are refused with `SessionBusy` when
+SESSION_BUSY_POLICY=reject), while different sessions run in parallel.
+
+With a shared backend (SESSION_BACKEND=sqlite) the store is write-through.
+Each turn holds the session's lease, reloads the session if another worker
+saved a newer version, and saves it when done, so any worker can serve any
+session.
+
+    async with session_store.use(session_id) as (session_id, agent):
+        response, metrics = await agent.execute(message)
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import pandas as pd
+
+from config import (
+    SESSION_BUSY_POLICY,
+    SESSION_IDLE_TTL,
+    SESSION_LEASE_TTL,
+    SESSION_LOCK_TIMEOUT,
+    SESSION_MAX,
+    SESSION_MAX_BYTES,
+    SESSION_SPILL_TTL,
+    SESSION_SWEEP_INTERVAL,
+)
+import snapshot
+from locks import acquire_within
+from observability import runtime_stats
+from session_backend import FileSessionBackend, SessionBackend, SessionBusy, SessionConflict, valid_session_id
+
+logger = logging.getLogger(__name__)
+
+STATS_GROUP = "sessions"
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def footprint(agent: Any) -> int:
+    """Estimated bytes held by a session: result frame, chart bytes and conversation text"""
+    artefacts = agent.artefacts
+    total = 0
+    data = getattr(artefacts, "data", None)
+    if isinstance(data, pd.DataFrame):
+        total += int(data.memory_usage(index=True, deep=True).sum())
+    for name in ("image", "code", "answer"):
+        value = getattr(artefacts, name, None)
+        if isinstance(value, (bytes, str)):
+            total += len(value)
+    history = getattr(agent, "history", None)
+    if isinstance(history, (list, deque)):
+        total += sum(len(str(m.get("content", ""))) for m in history)
+    return total
+
+
+def encode(agent: Any) -> bytes:
+    return snapshot.dumps(agent.snapshot())
+
+
+def decode(payload: bytes) -> Dict[str, Any]:
+    return snapshot.loads(payload)
+
+
+@dataclass
+class SessionEntry:
+    agent: Any
+    created_at: float = field(default_factory=time.time)
+    last_access: float = field(default_factory=time.time)
+    bytes: int = 0
+    active: int = 0  # requests currently using the session
+    version: int = 0  # backend version the agent was loaded from or saved as
+    dirty: bool = True  # changed since it was last saved
+
+
+@dataclass
+class TurnQueue:
+    """Requests holding or waiting for one session's turn"""
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    requests: int = 0
+
+
+class SessionStore:
+    """In-memory sessions in LRU order, with idle TTL, memory accounting and a backend for the rest"""
+
+    def __init__(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        backend: Optional[SessionBackend] = None,
+        max_sessions: int = SESSION_MAX,
+        max_bytes: int = SESSION_MAX_BYTES,
+        idle_ttl: float = SESSION_IDLE_TTL,
+        spill_ttl: float = SESSION_SPILL_TTL,
+        lease_ttl: float = SESSION_LEASE_TTL,
+        lock_timeout: float = SESSION_LOCK_TIMEOUT,
+        busy_policy: str = SESSION_BUSY_POLICY,
+    ):
+        if busy_policy not in ("queue", "reject"):
+            raise ValueError(f"Unknown session busy policy '{busy_policy}'")
+        self._factory = factory
+        self.backend = backend or FileSessionBackend()
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.spill_ttl = spill_ttl
+        self.lease_ttl = lease_ttl
+        self.lock_timeout = lock_timeout
+        self.busy_policy = busy_policy
+        self._entries: "OrderedDict[str, SessionEntry]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}  # spills and rehydrations in flight
+        self._background: set = set()  # saves waiting for a chart or summary to finish
+        self._turns: Dict[str, TurnQueue] = {}  # only sessions with a request in flight
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    async def _io(self, fn: Callable, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(fn, *args))
+
+    def _touch(self, session_id: str, entry: SessionEntry) -> None:
+        entry.last_access = time.time()
+        self._entries.move_to_end(session_id)
+
+    # ── access ──
+
+    def put(self, session_id: str, agent: Any, version: int = 0, dirty: bool = True) -> None:
+        self._entries[session_id] = SessionEntry(agent, bytes=footprint(agent), version=version, dirty=dirty)
+        self._entries.move_to_end(session_id)
+
+    async def get(self, session_id: str) -> Optional[Any]:
+        """The session's agent, rehydrated from the backend if needed; None when unknown"""
+        while True:
+            pending = self._pending.get(session_id)
+            if pending is not None:
+                # Shielded: a cancelled request must not abort the spill or load
+                await asyncio.shield(pending)
+                continue
+            entry = self._entries.get(session_id)
+            if entry is not None and not await self._stale(session_id, entry):
+                self._touch(session_id, entry)
+                return entry.agent
+            if session_id in self._pending:
+                continue
+            if not valid_session_id(session_id):
+                return None
+            task = self._pending[session_id] = asyncio.create_task(self._load(session_id))
+            if not await asyncio.shield(task):
+                return None
+
+    async def _stale(self, session_id: str, entry: SessionEntry) -> bool:
+        """Whether another worker saved (or deleted) a newer version of an idle in-memory session"""
+        if not self.backend.shared or entry.active or entry.dirty:
+            return False
+        stored = await self._io(self.backend.version, session_id)
+        if stored == entry.version or entry.active or entry.dirty:
+            return False
+        if self._entries.get(session_id) is entry:
+            del self._entries[session_id]
+        runtime_stats.incr(STATS_GROUP, "reloaded" if stored is not None else "deleted_elsewhere")
+        return True
+
+    async def _load(self, session_id: str) -> bool:
+        start = time.time()
+        try:
+            stored = await self._io(self.backend.load, session_id)
+            if stored is None:
+                return False
+            version, payload = stored
+            agent = await self._factory()
+            agent.restore(await self._io(decode, payload), live=self.backend.shared)
+            # The stored copy stays until the session is spilled again or deleted,
+            # so a turn that fails and is discarded falls back to it
+            self.put(session_id, agent, version=version, dirty=not self.backend.shared)
+            runtime_stats.observe(STATS_GROUP, "rehydrated", time.time() - start)
+            return True
+        except Exception as e:
+            logger.warning("Session %s could not be rehydrated: %s", session_id, e)
+            runtime_stats.incr(STATS_GROUP, "rehydrate_failed")
+            if not self.backend.shared:
+                await self._io(self.backend.delete, session_id)
+            return False
+        finally:
+            self._pending.pop(session_id, None)
+
+    async def create(self) -> Tuple[str, Any]:
+        session_id = str(uuid4())
+        agent = await self._factory()
+        self.put(session_id, agent)
+        runtime_stats.incr(STATS_GROUP, "created")
+        return session_id, agent
+
+    async def get_or_create(self, session_id: Optional[str] = None) -> Tuple[str, Any]:
+        agent = await self.get(session_id) if session_id else None
+        if agent is not None:
+            return session_id, agent
+        return await self.create()
+
+    @asynccontextmanager
+    async def use(self, session_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Session for one request. The request has the session to itself: it
+        stays in memory, and with a shared backend leased, until it is done.
+        """
+        async with self._turn(session_id):
+            async with self._use(session_id) as used:
+                yield used
+
+    @asynccontextmanager
+    async def _turn(self, session_id: Optional[str]) -> AsyncIterator[None]:
+        """Wait for the session's earlier requests in this worker; new sessions never wait"""
+        if session_id is None:
+            yield
+            return
+        queue = self._turns.get(session_id)
+        if queue is None:
+            queue = self._turns[session_id] = TurnQueue()
+        if queue.requests and self.busy_policy == "reject":
+            runtime_stats.incr(STATS_GROUP, "busy_rejected")
+            raise SessionBusy(f"Session {session_id} is already serving a request")
+
+        if queue.requests:
+            runtime_stats.incr(STATS_GROUP, "queued")
+        queue.requests += 1
+        start = time.monotonic()
+        try:
+            if not await acquire_within(queue.lock, self.lock_timeout):
+                runtime_stats.incr(STATS_GROUP, "queue_timeout")
+                raise SessionBusy(f"Session {session_id} is still busy after {self.lock_timeout:g}s")
+            waited = time.monotonic() - start
+            runtime_stats.observe(STATS_GROUP, "queue_wait", waited)
+            runtime_stats.histogram(STATS_GROUP, "queue_wait", waited)
+            try:
+                yield
+            finally:
+                queue.lock.release()
+        finally:
+            queue.requests -= 1
+            if not queue.requests and self._turns.get(session_id) is queue:
+                del self._turns[session_id]
+
+    @asynccontextmanager
+    async def _use(self, session_id: Optional[str]) -> AsyncIterator[Tuple[str, Any]]:
+        session_id, agent = await self.get_or_create(session_id)
+        owner = None
+        if self.backend.shared:
+            owner = f"{WORKER_ID}:{uuid4().hex[:8]}"
+            await self._acquire(session_id, owner)
+            # Another worker may have finished a turn of this session while we waited
+            agent = await self.get(session_id)
+            if agent is None:
+                await self._io(self.backend.release, session_id, owner)
+                (session_id, agent), owner = await self.create(), None
+
+        entry = self._entries[session_id]
+        entry.active += 1
+        try:
+            yield session_id, agent
+        finally:
+            entry.active -= 1
+            entry.bytes = footprint(agent)
+            entry.last_access = time.time()
+            entry.dirty = True
+            try:
+                if self.backend.shared:
+                    await self._save(session_id, entry)
+                    if getattr(agent, "busy", False):
+                        self._save_after_background(session_id, entry)
+            finally:
+                if owner is not None:
+                    await self._io(self.backend.release, session_id, owner)
+            await self.enforce()
+
+    async def _acquire(self, session_id: str, owner: str) -> None:
+        start = time.monotonic()
+        while not await self._io(self.backend.acquire, session_id, owner, self.lease_ttl):
+            if time.monotonic() - start >= self.lock_timeout:
+                runtime_stats.incr(STATS_GROUP, "lease_timeout")
+                raise SessionBusy(f"Session {session_id} is busy on another worker")
+            await asyncio.sleep(0.05)
+        runtime_stats.observe(STATS_GROUP, "lease_wait", time.monotonic() - start)
+
+    async def _save(self, session_id: str, entry: SessionEntry) -> None:
+        try:
+            payload = await self._io(encode, entry.agent)
+            expected = entry.version if self.backend.shared else None
+            entry.version = await self._io(self.backend.save, session_id, payload, expected)
+            entry.dirty = False
+            runtime_stats.incr(STATS_GROUP, "saved")
+        except SessionConflict as e:
+            # Another worker saved first; this copy is outdated and reloaded on next use
+            logger.warning("Session %s not saved: %s", session_id, e)
+            runtime_stats.incr(STATS_GROUP, "conflict")
+            if self._entries.get(session_id) is entry and not entry.active:
+                del self._entries[session_id]
+        except Exception as e:
+            logger.warning("Session %s could not be saved: %s", session_id, e)
+            runtime_stats.incr(STATS_GROUP, "save_failed")
+
+    def _save_after_background(self, session_id: str, entry: SessionEntry) -> None:
+        """
+        Save again once the chart / summary started by the turn has finished.
+        Runs under the session's lease; if another worker saved a newer turn
+        meanwhile, only the finished chart is merged into that version.
+        """
+        async def wait_and_save():
+            tasks = [t for t in (entry.agent.image_task, entry.agent.context_task) if t is not None]
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if entry.active:
+                return  # the turn now running here saves the chart with it
+            owner = f"{WORKER_ID}:{uuid4().hex[:8]}"
+            for attempt in range(3):
+                try:
+                    await self._acquire(session_id, owner)
+                    break
+                except SessionBusy:
+                    continue  # a turn elsewhere holds it; the chart is merged after it
+            else:
+                logger.warning("Session %s: finished chart not saved, the session stayed busy", session_id)
+                runtime_stats.incr(STATS_GROUP, "background_save_failed")
+                return
+            try:
+                stored = await self._io(self.backend.version, session_id)
+                if stored == entry.version and not entry.active:
+                    entry.dirty = True
+                    await self._save(session_id, entry)
+                elif stored is not None:
+                    await self._merge_background(session_id, entry)
+            finally:
+                await self._io(self.backend.release, session_id, owner)
+
+        task = asyncio.create_task(wait_and_save())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _merge_background(self, session_id: str, entry: SessionEntry) -> None:
+        """Put the finished chart into the newer stored version (the caller holds the lease)"""
+        try:
+            version, payload = await self._io(self.backend.load, session_id)
+            newer = await self._io(decode, payload)
+            if not entry.agent.merge_chart(newer):
+                runtime_stats.incr(STATS_GROUP, "background_superseded")
+                return
+            merged = await self._io(snapshot.dumps, newer)
+            await self._io(self.backend.save, session_id, merged, version)
+            runtime_stats.incr(STATS_GROUP, "background_merged")
+        except Exception as e:
+            logger.warning("Session %s: finished chart could not be merged: %s", session_id, e)
+            runtime_stats.incr(STATS_GROUP, "background_save_failed")
+        # This copy lacks the other worker's turn; the next use reloads the merged version
+        if self._entries.get(session_id) is entry and not entry.active:
+            del self._entries[session_id]
+
+    def discard(self, session_id: str) -> bool:
+        """Drop the in-memory session without saving it; the backend keeps its last saved version"""
+        return self._entries.pop(session_id, None) is not None
+
+    async def delete(self, session_id: str) -> bool:
+        """Remove the session from memory and the backend; False when it did not exist"""
+        pending = self._pending.get(session_id)
+        if pending is not None:
+            await asyncio.shield(pending)
+        found = self.discard(session_id)
+        if valid_session_id(session_id):
+            found = await self._io(self.backend.delete, session_id) or found
+        return found
+
+    # ── eviction ──
+
+    @staticmethod
+    def _evictable(entry: SessionEntry) -> bool:
+        return entry.active == 0 and not getattr(entry.agent, "busy", False)
+
+    async def enforce(self) -> None:
+        """Spill idle sessions, then least recently used ones until the count and memory limits hold"""
+        now = time.time()
+        victims: Dict[str, str] = {}
+        for session_id, entry in self._entries.items():
+            if now - entry.last_access > self.idle_ttl and self._evictable(entry):
+                victims[session_id] = "idle"
+
+        count = len(self._entries) - len(victims)
+        total = sum(e.bytes for sid, e in self._entries.items() if sid not in victims)
+        for session_id, entry in self._entries.items():  # least recently used first
+            if count <= self.max_sessions and total <= self.max_bytes:
+                break
+            if session_id in victims or not self._evictable(entry):
+                continue
+            victims[session_id] = "count" if count > self.max_sessions else "memory"
+            count -= 1
+            total -= entry.bytes
+
+        spills = [self._evict(session_id, reason) for session_id, reason in victims.items()]
+        spills = [task for task in spills if task is not None]
+        if spills:
+            await asyncio.gather(*spills)
+
+    def _evict(self, session_id: str, reason: str) -> Optional[asyncio.Task]:
+        entry = self._entries.pop(session_id)
+        runtime_stats.incr(STATS_GROUP, f"evicted.{reason}")
+        if not entry.dirty:
+            return None  # the backend already has this version
+
+        async def spill():
+            try:
+                if not valid_session_id(session_id):
+                    raise ValueError(f"session id {session_id!r} cannot be stored")
+                await self._save(session_id, entry)
+                if entry.dirty:
+                    runtime_stats.incr(STATS_GROUP, "spill_failed")
+                else:
+                    runtime_stats.incr(STATS_GROUP, "spilled")
+            except Exception as e:
+                logger.warning("Session %s could not be spilled and is dropped: %s", session_id, e)
+                runtime_stats.incr(STATS_GROUP, "spill_failed")
+            finally:
+                self._pending.pop(session_id, None)
+
+        task = self._pending[session_id] = asyncio.create_task(spill())
+        return task
+
+    async def sweep(self) -> None:
+        """Apply the limits and delete stored sessions older than the spill TTL"""
+        await self.enforce()
+        # A resident session's stored copy is what a failed turn falls back to
+        expired = await self._io(self.backend.purge, time.time() - self.spill_ttl, set(self._entries))
+        if expired:
+            runtime_stats.incr(STATS_GROUP, "expired", expired)
+
+    async def run_sweeper(self, interval: float = SESSION_SWEEP_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("Session sweep failed: %s", e)
+
+    async def spill_all(self) -> None:
+        """Write every unsaved session, e.g. at shutdown, so they survive a restart"""
+        await asyncio.gather(*self._background, return_exceptions=True)
+        spills = [self._evict(session_id, "shutdown") for session_id in list(self._entries)]
+        spills = [task for task in spills if task is not None]
+        if spills:
+            await asyncio.gather(*spills)
+
+    # ── reporting ──
+
+    def describe(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "session_id": session_id,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(e.created_at)),
+                "last_activity": time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(e.last_access)),
+                "bytes": e.bytes,
+                "active": e.active,
+            }
+            for session_id, e in reversed(self._entries.items())
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "backend": self.backend.name,
+            "worker": WORKER_ID,
+            "in_memory": len(self._entries),
+            "stored": self.backend.count(),
+            "bytes": sum(e.bytes for e in self._entries.values()),
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "idle_ttl": self.idle_ttl,
+            "oldest_idle_seconds": round(max((now - e.last_access for e in self._entries.values()), default=0.0), 1),
+            "active_requests": sum(e.active for e in self._entries.values()),
+            "queued_requests": sum(q.requests - 1 for q in self._turns.values()),
+            "busy_policy": self.busy_policy,
+            "queue_wait": runtime_stats.histograms(STATS_GROUP).get("queue_wait", {}),
+            "counters": runtime_stats.get(STATS_GROUP),
+        }
@@ -0,0 +1,221 @@
+"""
+Compact, versioned binary format for session snapshots.
+
+`ImprovedAgentChat.snapshot()` returns plain JSON-able state (history,
+conversation state, artefact paths, metrics, cache) plus the current result
+frame under "data". `dumps` packs it as:
+
+    header   "<4sHBBII": magic b"MSNP", format version, frame codec, flags,
+             metadata length, frame length
+    metadata JSON (zlib-compressed when FLAG_ZLIB is set)
+    frame    encoded by the codec
+
+Frame codecs:
+- arrow:  Arrow IPC stream (needs pyarrow), typed and fast to load
+- pickle: pandas pickle, the fallback when pyarrow is missing
+- file:   no bytes, only a reference to the artefact CSV (`data_file`); the
+          smallest snapshot, but the CSV round trip re-infers dtypes
+
+Chart bytes are never stored; the snapshot keeps the image file path.
+`python snapshot.py --rows 50000` benchmarks each available codec.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import pickle
+import struct
+import time
+import zlib
+from dataclasses import asdict, fields, is_dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar
+
+import pandas as pd
+
+from config import SNAPSHOT_FRAME_CODEC
+
+T = TypeVar("T")
+
+MAGIC = b"MSNP"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sHBBII")
+FLAG_ZLIB = 1
+ZLIB_MIN_BYTES = 4096  # smaller metadata is stored as is
+
+CODECS = {"none": 0, "arrow": 1, "pickle": 2, "file": 3}
+_CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+
+class SnapshotError(ValueError):
+    """The payload is not a snapshot this code can read"""
+
+
+def arrow_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def to_record(obj: Any) -> Dict[str, Any]:
+    """Dataclass as a JSON-able dict; paths become strings"""
+    return {k: str(v) if isinstance(v, Path) else v for k, v in asdict(obj).items()}
+
+
+def from_record(cls: Type[T], record: Dict[str, Any], **overrides: Any) -> T:
+    """Rebuild a dataclass, ignoring fields written by another version of the code"""
+    known = {f.name for f in fields(cls)}
+    return cls(**{**{k: v for k, v in record.items() if k in known}, **overrides})
+
+
+def _json_default(value: Any) -> Any:
+    if is_dataclass(value):
+        return to_record(value)
+    if isinstance(value, Path):
+        return str(value)
+    if hasattr(value, "item"):  # numpy scalars
+        return value.item()
+    return str(value)
+
+
+# ── frame codecs ──
+
+def _arrow_encode(df: pd.DataFrame) -> bytes:
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    try:
+        options = pa.ipc.IpcWriteOptions(compression="lz4")
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        options = pa.ipc.IpcWriteOptions()
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _arrow_decode(payload: bytes) -> pd.DataFrame:
+    import pyarrow as pa
+    return pa.ipc.open_stream(pa.py_buffer(payload)).read_all().to_pandas()
+
+
+def resolve_codec(codec: str = SNAPSHOT_FRAME_CODEC) -> str:
+    if codec == "auto":
+        return "arrow" if arrow_available() else "pickle"
+    if codec not in CODECS or codec == "none":
+        raise ValueError(f"Unknown snapshot frame codec '{codec}'")
+    if codec == "arrow" and not arrow_available():
+        raise ValueError("The arrow snapshot codec needs pyarrow")
+    return codec
+
+
+def _encode_frame(df: Optional[pd.DataFrame], data_file: Optional[str], codec: str) -> Tuple[str, bytes]:
+    if df is None:
+        return "none", b""
+    if codec == "file":
+        if data_file and Path(data_file).exists():
+            return "file", b""
+        codec = resolve_codec("auto")  # nothing to reference
+    if codec == "arrow":
+        return "arrow", _arrow_encode(df)
+    return "pickle", pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _decode_frame(codec: str, payload: bytes, data_file: Optional[str]) -> Optional[pd.DataFrame]:
+    if codec == "none":
+        return None
+    if codec == "arrow":
+        return _arrow_decode(payload)
+    if codec == "pickle":
+        return pickle.loads(payload)  # snapshots are only written by the service itself
+    return pd.read_csv(data_file)
+
+
+# ── container ──
+
+def dumps(snapshot: Dict[str, Any], codec: str = SNAPSHOT_FRAME_CODEC) -> bytes:
+    """Pack a snapshot; its "data" entry is the frame, everything else must be JSON-able"""
+    meta = {k: v for k, v in snapshot.items() if k != "data"}
+    data_file = (meta.get("artefacts") or {}).get("data_file")
+    frame_codec, frame = _encode_frame(snapshot.get("data"), data_file, resolve_codec(codec))
+
+    flags = 0
+    raw = json.dumps(meta, default=_json_default, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= ZLIB_MIN_BYTES:
+        raw, flags = zlib.compress(raw, 1), flags | FLAG_ZLIB
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, CODECS[frame_codec], flags, len(raw), len(frame))
+    return b"".join((header, raw, frame))
+
+
+def loads(payload: bytes) -> Dict[str, Any]:
+    """Unpack a snapshot written by `dumps`"""
+    if len(payload) < _HEADER.size:
+        raise SnapshotError("Truncated snapshot")
+    magic, version, codec_id, flags, meta_len, frame_len = _HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise SnapshotError("Not a session snapshot")
+    if version > FORMAT_VERSION:
+        raise SnapshotError(f"Snapshot format {version} is newer than {FORMAT_VERSION}")
+    if codec_id not in _CODEC_NAMES or len(payload) != _HEADER.size + meta_len + frame_len:
+        raise SnapshotError("Corrupt snapshot")
+
+    start = _HEADER.size
+    raw = payload[start:start + meta_len]
+    meta = json.loads(zlib.decompress(raw) if flags & FLAG_ZLIB else raw)
+    frame = payload[start + meta_len:]
+    data_file = (meta.get("artefacts") or {}).get("data_file")
+    meta["data"] = _decode_frame(_CODEC_NAMES[codec_id], frame, data_file)
+    return meta
+
+
+def benchmark(rows: int = 50_000, repeat: int = 5, codecs: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    """Size and median dump / load time per codec for a maintenance-like frame of `rows` rows"""
+    import tempfile
+
+    df = pd.DataFrame({
+        "UnitId": [f"T_{i % 60:02d}" for i in range(rows)],
+        "Component": pd.Categorical(["Motor", "Transmision", "Frenos", "Hidraulico"] * (rows // 4) + ["Motor"] * (rows % 4)),
+        "Date": pd.date_range("2024-01-01", periods=rows, freq="h").strftime("%Y-%m-%d %H:%M:%S"),
+        "Downtime": [(i * 37 % 1000) / 10 for i in range(rows)],
+        "Jobs": [i % 17 for i in range(rows)],
+    })
+    codecs = codecs or [c for c in ("arrow", "pickle", "file") if c != "arrow" or arrow_available()]
+    report: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = Path(tmp) / "data_0.csv"
+        df.to_csv(data_file, index=False)
+        snapshot = {
+            "history": [{"role": "user", "content": "Trabajos por equipo"}] * 20,
+            "artefacts": {"data_file": str(data_file), "image_file": None},
+            "data": df,
+        }
+        for codec in codecs:
+            dump_times, load_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                payload = dumps(snapshot, codec)
+                dump_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                loads(payload)
+                load_times.append(time.perf_counter() - start)
+            report[codec] = {
+                "bytes": len(payload),
+                "dump_ms": round(sorted(dump_times)[repeat // 2] * 1000, 2),
+                "load_ms": round(sorted(load_times)[repeat // 2] * 1000, 2),
+            }
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the session snapshot codecs")
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    for codec, result in benchmark(args.rows, args.repeat).items():
+        print(f"{codec:>7}: {result['bytes']:>10,} bytes  dump {result['dump_ms']:>8} ms  load {result['load_ms']:>8} ms")
+
+
+if __name__ == "__main__":
+    main()
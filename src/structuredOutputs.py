@@ -22,4 +22,68 @@ class actionsRequired(BaseModel):
     
     """
     is_new_sql_query_needed: bool
-    is_new_image_needed: bool
\ No newline at end of file
+    is_new_image_needed: bool
+
+class dataframeOperation(BaseModel):
+    """
+    One step of a local operation plan over the previous query result.
+
+    Attributes:
+        op (str): "filter", "sort", "top_k", "group", "pivot" or "select".
+        column (Optional[str]): Column to filter, sort or rank by, or the values to aggregate.
+        operator (Optional[str]): Filter operator: ==, !=, >, >=, <, <=, in, contains.
+        value (Optional[str]): Filter value; comma separated for "in".
+        by (Optional[List[str]]): Group / pivot row keys, or the columns kept by "select".
+        pivot_column (Optional[str]): Column whose values become the pivot's columns.
+        agg (Optional[str]): sum, mean, median, count, min or max.
+        ascending (Optional[bool]): Sort / top_k direction.
+        n (Optional[int]): Rows kept by top_k.
+    """
+    op: str
+    column: Optional[str]
+    operator: Optional[str]
+    value: Optional[str]
+    by: Optional[List[str]]
+    pivot_column: Optional[str]
+    agg: Optional[str]
+    ascending: Optional[bool]
+    n: Optional[int]
+
+class operationPlan(BaseModel):
+    """
+    Plan answering a follow-up from the previous result instead of a new SQL query.
+
+    Attributes:
+        uses_current_data_only (bool): True if the request can be answered from the current data alone.
+        operations (List[dataframeOperation]): Steps applied in order; empty when a new query is needed.
+    """
+    uses_current_data_only: bool
+    operations: List[dataframeOperation]
+
+class questionDecomposition(BaseModel):
+    """
+    Split of a multi-part data request into independent sub-questions.
+
+    Attributes:
+        is_multi_part (bool): True if the request combines independent measures or comparisons.
+        sub_questions (List[str]): Self-contained questions, each answerable with one simple SQL query.
+        join_keys (List[str]): Column names every sub-result should share to be merged (e.g. UnitId, month).
+    """
+    is_multi_part: bool
+    sub_questions: List[str]
+    join_keys: List[str]
+
+class answerJudgement(BaseModel):
+    """
+    Pairwise judgement of two answers to the same question (evaluation harness).
+
+    Attributes:
+        score_a (int): Quality of answer A, from 1 to 5.
+        score_b (int): Quality of answer B, from 1 to 5.
+        preferred (str): "A", "B" or "tie".
+        rationale (str): One or two sentences justifying the scores.
+    """
+    score_a: int
+    score_b: int
+    preferred: str
+    rationale: str
@@ -0,0 +1,270 @@
+"""
+Translation memory in front of the `_translate` LLM call.
+
+Lookups are answered locally, in order:
+- same language: the text is already in the target language
+- passthrough: only numbers / identifiers (e.g. "T_01", "2024")
+- glossary: the whole text is a domain term ("gráfico de barras")
+- exact / normalised: a short phrase translated before, stored in SQLite
+
+Normalised entries are templates: case, accents and punctuation are ignored,
+and numbers / identifiers become placeholders filled back in on a hit, so
+"¿y para T_02?" reuses the translation of "¿y para T_01?". Misses go to the
+LLM with a glossary hint, and the result is stored for next time.
+
+The SQLite file is opened on first use and may be shared by several workers.
+Writing to it is best effort: a failed write (e.g. "database is locked") is
+logged and the phrase stays in this process's memory only.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from config import TRANSLATION_MEMORY_MAX_CHARS, TRANSLATION_MEMORY_PATH
+from observability import runtime_stats
+
+logger = logging.getLogger(__name__)
+
+WRITE_TIMEOUT = 1.0  # seconds to wait for another worker's write lock
+
+# Numbers, dates and unit ids are never translated
+_IDENTIFIER = re.compile(r"\bT_\d+\b|\b\d{4}-\d{2}-\d{2}\b|\b\d+(?:[.,]\d+)?\b", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"<(\d+)>")
+_WORD = re.compile(r"[a-zñ]+")
+
+_SPANISH_HINTS = set(
+    "de la que el en y los del se las por un para con una su al lo como mas pero sus le ya o este si porque "
+    "esta entre cuando muy sin sobre tambien me hasta hay donde desde todo nos durante todos les ni eso esto "
+    "ese esa estos esas cual cuales cuantos cuantas cuanto que quien hazme dame muestrame grafico equipos "
+    "equipo sistema sistemas mantenimiento trabajos ciclo ciclos promedio".split()
+)
+_ENGLISH_HINTS = set(
+    "the of and to in is it that for on with as was be by this are or from at an which have has not but "
+    "what how many show me give list all each per there their were can did does do make chart plot "
+    "units unit system systems maintenance jobs cycle cycles average".split()
+)
+
+# Domain terms (normalised Spanish -> English)
+GLOSSARY: Dict[str, str] = {
+    "grafico de barras": "bar chart",
+    "grafico de lineas": "line chart",
+    "grafico de torta": "pie chart",
+    "grafico circular": "pie chart",
+    "ciclo de mantenimiento": "maintenance cycle",
+    "ciclos de mantenimiento": "maintenance cycles",
+    "mantenimiento programado": "scheduled maintenance",
+    "mantenimiento no programado": "unscheduled maintenance",
+    "cambio critico": "critical change",
+    "tiempo de detencion": "downtime",
+    "subsistema": "subsystem",
+    "componente": "component",
+    "sistema": "system",
+    "trabajo": "job",
+    "equipo": "unit",
+}
+
+LANGUAGES = ("spanish", "english")
+
+
+def _strip_accents(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def normalise(text: str) -> Tuple[str, List[str]]:
+    """Lookup key with identifiers replaced by <n> placeholders, plus the identifiers"""
+    identifiers: List[str] = []
+
+    def placeholder(match: re.Match) -> str:
+        identifiers.append(match.group(0))
+        return f"<{len(identifiers) - 1}>"
+
+    key = _IDENTIFIER.sub(placeholder, text)
+    key = _strip_accents(key.lower())
+    key = re.sub(r"[^\w<>\s]", " ", key)
+    return " ".join(key.split()), identifiers
+
+
+def detect_language(text: str) -> Optional[str]:
+    """'spanish', 'english' or None when there is no clear signal"""
+    if re.search(r"[¿¡ñÑ]", text):
+        return "spanish"
+    words = _WORD.findall(_strip_accents(_IDENTIFIER.sub(" ", text.lower())))
+    if not words:
+        return None
+    es = sum(w in _SPANISH_HINTS for w in words) + 2 * bool(re.search(r"[áéíóúÁÉÍÓÚ]", text))
+    en = sum(w in _ENGLISH_HINTS for w in words)
+    if es == en:
+        return None
+    return "spanish" if es > en else "english"
+
+
+class TranslationMemory:
+    """Persistent exact / normalised phrase store with a domain glossary"""
+
+    def __init__(self, path: Optional[Path] = TRANSLATION_MEMORY_PATH, max_chars: int = TRANSLATION_MEMORY_MAX_CHARS):
+        self.max_chars = max_chars
+        self._lock = Lock()
+        self._exact: Dict[Tuple[str, str, str], str] = {}
+        self._normalised: Dict[Tuple[str, str, str], str] = {}
+        self._keep: Dict[str, str] = {}  # normalised name -> name, kept verbatim
+        self._avg_latency = 0.0
+        self._llm_calls = 0
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._opened = False
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """The phrase store, opened and loaded on first use; None when it cannot be opened"""
+        with self._lock:
+            if self._opened:
+                return self._conn
+            self._opened = True
+            try:
+                if self._path is not None:
+                    Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(
+                    ":memory:" if self._path is None else str(self._path),
+                    timeout=WRITE_TIMEOUT, check_same_thread=False,
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS phrases ("
+                    " src TEXT, tgt TEXT, kind TEXT, key TEXT, translation TEXT, created REAL,"
+                    " PRIMARY KEY (src, tgt, kind, key))"
+                )
+                for src, tgt, kind, key, translation in conn.execute(
+                    "SELECT src, tgt, kind, key, translation FROM phrases"
+                ):
+                    (self._exact if kind == "exact" else self._normalised).setdefault((src, tgt, key), translation)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning("Translation memory %s unavailable, keeping phrases in memory: %s", self._path, e)
+                runtime_stats.incr("translation_memory", "open_failed")
+                return None
+            self._conn = conn
+            return conn
+
+    def add_names_from_db(self, conn: sqlite3.Connection) -> int:
+        """System / subsystem / component names from the maintenance DB are kept verbatim"""
+        try:
+            rows = conn.execute(
+                "SELECT system FROM system UNION SELECT subsystem FROM subsystem "
+                "UNION SELECT component FROM component"
+            ).fetchall()
+        except sqlite3.Error:
+            return 0
+        with self._lock:
+            for (name,) in rows:
+                if name:
+                    self._keep[normalise(name)[0]] = name
+        return len(rows)
+
+    # ---------- lookup ---------- #
+
+    def lookup(self, text: str, src: str, tgt: str) -> Optional[str]:
+        """Local translation of `text`, or None when the LLM is needed"""
+        translation, kind = self._lookup(text, src, tgt)
+        runtime_stats.incr("translation_memory", kind)
+        if translation is not None:
+            runtime_stats.incr("translation_memory", "saved_ms", int(self._avg_latency * 1000))
+        return translation
+
+    def _lookup(self, text: str, src: str, tgt: str) -> Tuple[Optional[str], str]:
+        self._db()
+        stripped = text.strip()
+        if not _WORD.search(_strip_accents(_IDENTIFIER.sub(" ", stripped.lower()))):
+            return text, "passthrough"
+        if detect_language(stripped) == tgt:
+            return text, "same_language"
+
+        key, identifiers = normalise(stripped)
+        if key in self._keep:
+            return stripped, "glossary"
+        glossary = self._glossary(src, tgt)
+        if key in glossary:
+            return glossary[key], "glossary"
+
+        if len(stripped) > self.max_chars:
+            return None, "miss"
+        if (src, tgt, stripped) in self._exact:
+            return self._exact[(src, tgt, stripped)], "exact"
+        template = self._normalised.get((src, tgt, key))
+        if template is not None:
+            return _PLACEHOLDER.sub(lambda m: identifiers[int(m.group(1))], template), "normalised"
+        return None, "miss"
+
+    @staticmethod
+    def _glossary(src: str, tgt: str) -> Dict[str, str]:
+        if (src, tgt) == ("spanish", "english"):
+            return GLOSSARY
+        if (src, tgt) == ("english", "spanish"):
+            return {en: es for es, en in GLOSSARY.items()}
+        return {}
+
+    def glossary_hint(self, text: str, src: str, tgt: str) -> str:
+        """Prompt line pinning the translation of domain terms found in `text`"""
+        key = f" {normalise(text)[0]} "
+        pairs = [f"'{a}' -> '{b}'" for a, b in self._glossary(src, tgt).items() if f" {a} " in key]
+        keep = [name for norm, name in self._keep.items() if f" {norm} " in key]
+        hint = []
+        if pairs:
+            hint.append("Use these translations: " + "; ".join(pairs) + ".")
+        if keep or _IDENTIFIER.search(text):
+            hint.append("Keep names, numbers and identifiers (e.g. T_01) unchanged" +
+                        (": " + ", ".join(keep) if keep else "") + ".")
+        return " ".join(hint)
+
+    # ---------- store ---------- #
+
+    def store(self, text: str, src: str, tgt: str, translation: str, latency: float) -> None:
+        """Remember an LLM translation of a short phrase; a failed write is logged, never raised"""
+        self._llm_calls += 1
+        self._avg_latency += (latency - self._avg_latency) / self._llm_calls
+        stripped = text.strip()
+        if len(stripped) > self.max_chars or not translation:
+            return
+
+        key, identifiers = normalise(stripped)
+        rows = [(src, tgt, "exact", stripped, translation, time.time())]
+        # Template only if every identifier survives translation exactly once
+        if all(translation.count(i) == 1 for i in identifiers) and len(set(identifiers)) == len(identifiers):
+            template = translation
+            for n, identifier in enumerate(identifiers):
+                template = template.replace(identifier, f"<{n}>")
+            rows.append((src, tgt, "normalised", key, template, time.time()))
+
+        conn = self._db()
+        with self._lock:
+            for src_, tgt_, kind, k, value, _ in rows:
+                (self._exact if kind == "exact" else self._normalised)[(src_, tgt_, k)] = value
+            if conn is None:
+                return
+            try:
+                conn.executemany("INSERT OR REPLACE INTO phrases VALUES (?, ?, ?, ?, ?, ?)", rows)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.warning("Translation memory write failed: %s", e)
+                runtime_stats.incr("translation_memory", "store_failed")
+
+    def stats(self) -> Dict[str, object]:
+        counters = runtime_stats.get("translation_memory")
+        lookups = sum(v for k, v in counters.items() if k not in ("saved_ms", "open_failed", "store_failed"))
+        hits = lookups - counters.get("miss", 0)
+        return {
+            "entries": len(self._exact) + len(self._normalised),
+            "lookups": lookups,
+            "hit_rate": round(hits / lookups, 4) if lookups else None,
+            "saved_seconds": round(counters.get("saved_ms", 0) / 1000, 3),
+            "avg_llm_latency": round(self._avg_latency, 3),
+        }
+
+
+translation_memory = TranslationMemory()
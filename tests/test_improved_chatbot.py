@@ -4,19 +4,50 @@ Includes unit tests, integration tests, and performance tests
 """
 
 import asyncio
+import json
+import random
 import pytest
 import sqlite3
 import tempfile
 import time
 from pathlib import Path
+from types import SimpleNamespace
 from unittest.mock import Mock, patch, AsyncMock
 
 import pandas as pd
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
 
-from src.improved_agent import ImprovedAgentChat, CacheManager
+from src.improved_agent import ImprovedAgentChat, CacheManager, runtime_stats, intent_classifier
 from src.fastapi_microservice import app
+from src.code_extraction import code_from_run_steps, code_from_fenced_blocks
+from src.chart_data import chart_columns, infer_chart_columns, downcast_frame, prepare_chart_data
+from src import chart_data as chart_data_module
+from src.image_variants import generate_variants, load_manifest, variant_path
+from src import fastapi_microservice
+from src.pipeline import Pipeline, Stage, PipelineError
+from src.conversation_state import ConversationState, sql_filters, extract_entities, EMPTY_CONTEXT
+from src.eval_modes import judge, summarise
+from src.translation_memory import TranslationMemory, detect_language
+from src import translation_memory as translation_memory_module
+from src.result_digest import digest, profile_column, sample_rows
+from src.dataframe_ops import PlanError, apply_plan
+from src.structuredOutputs import actionsRequired, dataframeOperation, operationPlan, questionDecomposition
+from src.decomposition import looks_multi_part, merge_frames
+from src.db_pool import SQLiteConnectionPool
+from src.improved_agent import make_deadline, set_deadline, reset_deadline
+from src.model_routing import RoutingTable, StageRoute
+from src.observability import RuntimeStats
+from src.llm_resilience import CircuitBreaker, hedged, hedge_stats
+from src import openai_pool
+from src.session_store import SessionBusy, SessionStore, footprint
+from src.session_backend import FileSessionBackend, SQLiteSessionBackend, SessionConflict
+from src import snapshot
+from src.jobs import JobManager, JobQueueFull
+from src.locks import acquire_within
+from src.admission import AdmissionController, Overloaded
+from src import improved_agent
+from src.intent_classifier import keyword_rules, LocalIntentClassifier, NaiveBayesIntentModel, main as intent_cli
 
 # ─────────────────────────── FIXTURES ─────────────────────────── #
 
@@ -76,6 +107,13 @@ def mock_llm():
         mock.return_value = llm_instance
         yield llm_instance
 
+@pytest.fixture(autouse=True)
+def translation_memory(monkeypatch):
+    """Fresh in-memory translation memory per test"""
+    tm = TranslationMemory(path=None)
+    monkeypatch.setattr(improved_agent, "translation_memory", tm)
+    return tm
+
 @pytest.fixture
 def agent(temp_db, mock_llm):
     """Create agent instance for testing"""
@@ -179,8 +217,1518 @@ class TestImprovedAgent:
         assert success
         assert agent.artefacts.metrics.sql_attempts == 2
 
+class TestBackgroundImages:
+    """Test that chart generation is decoupled from the chat answer"""
+
+    @pytest.mark.asyncio
+    async def test_answer_returned_while_image_pending(self, agent, mock_llm, monkeypatch):
+        # A two-row result would otherwise be answered from a template
+        monkeypatch.setattr(improved_agent, "result_reply", lambda df: None)
+        df = pd.DataFrame({"type": ["Pump", "Motor"], "count": [2, 1]})
+        data_path = await agent.fs.save_dataframe(df)
+        agent._supervised_sql_async = AsyncMock(return_value=("SELECT 1", df, data_path, True))
+
+        async def slow_image(*args, **kwargs):
+            await asyncio.sleep(0.5)
+            return b"png", "print('chart')", Path("image_0.png"), Path("code_0.py")
+
+        agent._run_python_image_async = slow_image
+
+        start = time.time()
+        answer, _ = await agent._data_refresh_branch_async("chart of counts", also_image=True)
+
+        assert time.time() - start < 0.4
+        assert answer == "Mocked LLM response"
+        assert agent.artefacts.image_status == "pending"
+
+        assert await agent.wait_for_image(timeout=2) == "ready"
+        assert agent.artefacts.image_file == Path("image_0.png")
+        assert agent.artefacts.metrics.image_time is not None
+
+    @pytest.mark.asyncio
+    async def test_failed_image_is_reported(self, agent, mock_llm):
+        df = pd.DataFrame({"count": [1]})
+        agent._run_python_image_async = AsyncMock(side_effect=RuntimeError("boom"))
+
+        agent._start_image_job("chart", df, Path("data_0.csv"))
+
+        assert await agent.wait_for_image(timeout=1) == "failed"
+        assert "boom" in agent.artefacts.image_error
+
+class TestCodeExtraction:
+    """Test local extraction of chart code"""
+
+    @staticmethod
+    def _code_step(code):
+        call = SimpleNamespace(type="code_interpreter", code_interpreter=SimpleNamespace(input=code))
+        return SimpleNamespace(step_details=SimpleNamespace(type="tool_calls", tool_calls=[call]))
+
+    def test_run_steps_in_order(self):
+        steps = [
+            SimpleNamespace(step_details=SimpleNamespace(type="message_creation")),
+            self._code_step("import pandas as pd"),
+            self._code_step("df.plot()"),
+        ]
+        assert code_from_run_steps(steps) == "import pandas as pd\n\ndf.plot()"
+        assert code_from_run_steps([]) is None
+
+    def test_fenced_blocks_skip_invalid_python(self):
+        text = "Here it is:\n```python\nimport matplotlib\n```\nand\n```\nnot python (\n```"
+        assert code_from_fenced_blocks(text) == "import matplotlib"
+        assert code_from_fenced_blocks("no code here") is None
+
+    @pytest.mark.asyncio
+    async def test_llm_used_only_as_last_resort(self, agent, mock_llm):
+        mock_llm.chat.return_value = "print('from llm')"
+
+        code = await agent._extract_code([self._code_step("x = 1")], "```python\ny = 2\n```")
+        assert code == "x = 1"
+        assert agent.artefacts.metrics.code_extraction == "run_steps"
+        mock_llm.chat.assert_not_called()
+
+        code = await agent._extract_code([], "plain text")
+        assert code == "print('from llm')"
+        assert agent.artefacts.metrics.code_extraction == "llm"
+
+class TestChartData:
+    """Test column projection and compact encoding of chart data"""
+
+    def test_infer_columns_from_instructions(self):
+        columns = ["UnitId", "job_count", "avg_downtime", "comment"]
+        instructions = "Bar chart with UnitId on the x axis and job count on the y axis"
+        assert infer_chart_columns(columns, instructions) == ["UnitId", "job_count"]
+
+    def test_downcast_types(self):
+        df = pd.DataFrame({
+            "n": [1, 2, 3, 4],
+            "x": [0.5, 1.5, 2.5, 3.5],
+            "system": ["Motor", "Motor", "Motor", "Engine"],
+        })
+        out = downcast_frame(df)
+        assert out["n"].dtype == "int8"
+        assert out["x"].dtype == "float32"
+        assert str(out["system"].dtype) == "category"
+
+    def test_prepared_upload_is_smaller(self, tmp_path, monkeypatch):
+        df = pd.DataFrame({
+            "UnitId": [f"T_{i % 20:02d}" for i in range(5000)],
+            "job_count": range(5000),
+            "comment": ["a long free text comment that the chart never uses"] * 5000,
+        })
+        source = tmp_path / "data_0.csv"
+        df.to_csv(source, index=False)
+
+        downcasts = []
+        monkeypatch.setattr(chart_data_module, "downcast_frame", lambda frame: downcasts.append(1) or frame)
+        prepared = prepare_chart_data(df, source, "Plot job_count per UnitId", fmt="zip")
+
+        assert not downcasts  # dtypes do not change the size of CSV text
+        assert prepared.columns == ["UnitId", "job_count"]
+        assert prepared.path.exists()
+        assert prepared.upload_bytes < prepared.original_bytes / 5
+
+    def test_partial_references_keep_the_needed_columns(self):
+        columns = ["UnitId", "downtime_hours", "comment"]
+        assert chart_columns(columns, "Bar chart of downtime per UnitId") == ["UnitId", "downtime_hours"]
+        # An identifier that is not a column: keep everything
+        assert chart_columns(columns, "Plot `downtime_total` per UnitId") == columns
+        assert chart_columns(columns, "Make it pretty") == columns
+
+    def test_upload_keeps_float_precision(self, tmp_path):
+        df = pd.DataFrame({"UnitId": ["T_01", "T_02"], "downtime_hours": [1234.56789012, 0.1]})
+        source = tmp_path / "data_0.csv"
+        df.to_csv(source, index=False)
+
+        prepared = prepare_chart_data(df, source, "downtime per UnitId", fmt="csv")
+
+        uploaded = pd.read_csv(prepared.path)
+        assert uploaded["downtime_hours"].tolist() == df["downtime_hours"].tolist()
+        assert downcast_frame(df)["downtime_hours"].dtype == "float64"
+
+class TestImageVariants:
+    """Test chart post-processing and variant downloads"""
+
+    @pytest.fixture
+    def chart(self, tmp_path):
+        from PIL import Image
+        path = tmp_path / "image_0.png"
+        Image.new("RGB", (1200, 800), "white").save(path)
+        return path
+
+    def test_variants_written_alongside_original(self, chart):
+        manifest = generate_variants(chart)
+
+        assert set(manifest) == {"original", "thumb", "optimized", "webp"}
+        assert variant_path(chart, "thumb").exists()
+        assert variant_path(chart, "webp").exists()
+        assert manifest["thumb"]["size"] < manifest["original"]["size"]
+        assert load_manifest(chart) == manifest
+
+    def test_variant_download_with_etag(self, chart, client):
+        generate_variants(chart)
+        agent = Mock()
+        agent.artefacts.image_file = chart
+        agent.artefacts.image_status = "ready"
+        fastapi_microservice.session_store.put("variant-session", agent)
+        try:
+            response = client.get("/v1/download/image/variant-session?variant=webp")
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "image/webp"
+            etag = response.headers["etag"]
+
+            response = client.get(
+                "/v1/download/image/variant-session?variant=webp",
+                headers={"If-None-Match": etag}
+            )
+            assert response.status_code == 304
+
+            response = client.get("/v1/download/image/variant-session?variant=huge")
+            assert response.status_code == 400
+        finally:
+            fastapi_microservice.session_store.discard("variant-session")
+
+class TestPipeline:
+    """Test the DAG stage scheduler"""
+
+    @pytest.mark.asyncio
+    async def test_independent_stages_run_concurrently(self):
+        async def slow(value):
+            await asyncio.sleep(0.2)
+            return value
+
+        pipeline = Pipeline([
+            Stage("a", slow, inputs=("x",), outputs=("a",)),
+            Stage("b", slow, inputs=("x",), outputs=("b",)),
+            Stage("join", lambda a, b: a + b, inputs=("a", "b"), outputs=("out",)),
+        ])
+        run = await pipeline.run({"x": 1})
+
+        assert run.state["out"] == 2
+        assert run.total_time < 0.35
+        assert run.results["join"].status == "ok"
+
+    @pytest.mark.asyncio
+    async def test_branch_skipping(self):
+        pipeline = Pipeline([
+            Stage("left", lambda x: "L", inputs=("x",), outputs=("reply",), when=lambda st: st["x"] > 0),
+            Stage("right", lambda x: "R", inputs=("x",), outputs=("reply",), when=lambda st: st["x"] <= 0),
+            Stage("left_only", lambda x: "extra", inputs=("x",), outputs=("extra",), when=lambda st: st["x"] > 0),
+            Stage("uses_extra", lambda e: e, inputs=("extra",), outputs=("used",)),
+            Stage("final", lambda r: r.lower(), inputs=("reply",), outputs=("final",)),
+        ])
+        run = await pipeline.run({"x": -1})
+
+        assert run.state["final"] == "r"
+        assert run.results["left"].status == "skipped"
+        assert run.results["uses_extra"].status == "skipped"
+
+    @pytest.mark.asyncio
+    async def test_retries_and_timeouts(self):
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 2:
+                raise ValueError("transient")
+            return "ok"
+
+        run = await Pipeline([Stage("flaky", flaky, outputs=("v",), retries=1)]).run({})
+        assert run.state["v"] == "ok"
+        assert run.results["flaky"].attempts == 2
+
+        async def hang():
+            await asyncio.sleep(1)
+
+        with pytest.raises(PipelineError):
+            await Pipeline([Stage("hang", hang, timeout=0.05)]).run({})
+
+    @pytest.mark.asyncio
+    async def test_agent_runs_on_pipeline(self, agent, mock_llm):
+        agent._good_flow_async = AsyncMock(return_value=("answer", ["data"]))
+        agent.pipeline = agent._build_pipeline()
+
+        response, metrics = await agent.execute("¿Cuántos equipos hay?")
+
+        assert response == "Mocked LLM response"
+        assert metrics["flow"] == "good"
+        assert {"classify", "get_actions", "context", "translate_out"} <= set(metrics["stages"])
+        assert metrics["stages"]["bad_flow"]["status"] == "skipped"
+
+    @pytest.mark.asyncio
+    async def test_metrics_are_per_turn(self, agent, mock_llm):
+        async def first_turn(request, actions=None):
+            agent.artefacts.metrics.result_tokens = 120
+            agent.artefacts.metrics.speculative_overlap_time = 0.4
+            return "answer", ["data"]
+
+        agent._good_flow_async = AsyncMock(side_effect=first_turn)
+        agent.pipeline = agent._build_pipeline()
+        _, metrics = await agent.execute("¿Cuántos equipos hay?")
+        assert metrics["result_tokens"] == 120
+        cached = next(iter(agent.cache.cache.values()))["metrics"]
+        assert cached is not agent.artefacts.metrics
+
+        agent._good_flow_async = AsyncMock(return_value=("answer", ["data"]))
+        agent.pipeline = agent._build_pipeline()
+        _, metrics = await agent.execute("¿Y cuántos trabajos?")
+        assert metrics["result_tokens"] is None and metrics["speculative_overlap_time"] is None
+        assert cached.result_tokens == 120
+
+class TestConversationState:
+    """Structured context kept between turns"""
+
+    SQL = (
+        "SELECT s.system, COUNT(*) AS jobs FROM maintenance_cycle mc JOIN system s USING (system_id) "
+        "WHERE mc.UnitId = 'T_01' AND mc.start_time BETWEEN '2024-01-01' AND '2024-03-31' "
+        "GROUP BY s.system"
+    )
+
+    def test_filters_and_entities_from_sql(self):
+        assert sql_filters(self.SQL) == [
+            "mc.UnitId = 'T_01'",
+            "mc.start_time BETWEEN '2024-01-01' AND '2024-03-31'",
+        ]
+        assert extract_entities("jobs on t_01 and T_12", self.SQL) == ["T_01", "T_12", "2024-01-01", "2024-03-31"]
+
+    def test_update_and_render(self):
+        state = ConversationState()
+        assert state.render() == EMPTY_CONTEXT
+
+        artefacts = SimpleNamespace(
+            sql_query=self.SQL,
+            data=pd.DataFrame({"system": ["Engine"], "jobs": [4]}),
+            data_file=Path("chat_docs/x/data_0.csv"),
+            image_file=None,
+            code_file=None,
+        )
+        state.update("jobs per system for T_01", artefacts, ["sql_query", "data", "data_file", "image (pending)"])
+
+        rendered = state.render()
+        assert "Result columns: system, jobs (1 rows)" in rendered
+        assert "Filters: mc.UnitId = 'T_01'" in rendered
+        assert "Artifacts: data=data_0.csv, image=pending" in rendered
+        assert state.entities[0] == "T_01"
+
+    def test_summary_cadence(self):
+        state = ConversationState()
+        artefacts = SimpleNamespace(sql_query=None, data=None, data_file=None, image_file=None, code_file=None)
+        for _ in range(2):
+            state.update("question", artefacts)
+        assert not state.needs_summary("short", every=3, token_budget=100)
+        assert state.needs_summary("x" * 1000, every=3, token_budget=100)
+
+        state.update("question", artefacts)
+        assert state.needs_summary("short", every=3, token_budget=100)
+        state.apply_summary("summary", 3)
+        assert state.turns_since_summary == 0
+        assert not state.needs_summary("x" * 1000, every=3, token_budget=100)
+
+    def test_history_is_bounded(self, agent):
+        for i in range(agent.history.maxlen + 5):
+            agent.history.append({"role": "user", "content": str(i)})
+        assert len(agent.history) == agent.history.maxlen
+
+class TestIntentClassifier:
+    """Local fast path ahead of the structured LLM calls"""
+
+    @staticmethod
+    def _records(n=60):
+        records = []
+        for i in range(n):
+            records.append((f"How many jobs did unit T_{i:02d} have in 2024?",
+                            {"is_on_topic": True, "is_new_sql_query_needed": True}))
+            records.append((f"Tell me a joke about football number {i}",
+                            {"is_on_topic": False, "is_new_sql_query_needed": False}))
+        return records
+
+    def test_keyword_rules(self):
+        assert keyword_rules("Hazme un gráfico de eso", has_data=True) == {
+            "is_on_topic": True,
+            "is_new_image_needed": True,
+            "is_new_sql_query_needed": False,
+            "is_context_sufficient": True,
+        }
+        assert keyword_rules("Plot the jobs of T_03 in 2024")["is_new_sql_query_needed"] is True
+        assert keyword_rules("Tell me a joke") == {}
+
+    @pytest.mark.parametrize("text", [
+        "The user wants a bar chart of this month's downtime per system",
+        "Plot it: maintenance jobs per component",
+    ])
+    def test_charts_without_data_need_a_query(self, text):
+        labels = keyword_rules(text, has_data=False)
+        assert labels["is_new_image_needed"] and labels["is_new_sql_query_needed"]
+
+        # With data, a pronoun alone is a hint below the threshold, not a decision
+        guess, _ = LocalIntentClassifier(None).guess("actions", text, has_data=True)
+        assert guess is None
+
+    @pytest.mark.asyncio
+    async def test_image_only_without_data_takes_the_query_path(self, agent):
+        agent._image_only_branch_async = AsyncMock()
+        agent._data_refresh_branch_async = AsyncMock(return_value=("answer", ["data"]))
+        actions = actionsRequired(is_new_sql_query_needed=False, is_new_image_needed=True)
+
+        await agent._good_flow_async("Plot it: maintenance jobs per component", actions)
+
+        agent._image_only_branch_async.assert_not_called()
+        agent._data_refresh_branch_async.assert_awaited_once()
+        assert agent._data_refresh_branch_async.call_args.kwargs["also_image"] is True
+
+    def test_model_training_and_roundtrip(self, tmp_path):
+        model = NaiveBayesIntentModel().fit(self._records())
+        assert model.predict_proba("How many jobs did T_99 have?")["is_on_topic"] > 0.9
+        assert model.predict_proba("a joke about football please")["is_on_topic"] < 0.1
+
+        model.save(tmp_path / "nb.npz")
+        loaded = NaiveBayesIntentModel.load(tmp_path / "nb.npz")
+        assert loaded.samples == model.samples
+        assert loaded.predict_proba("joke") == pytest.approx(model.predict_proba("joke"))
+
+    def test_train_and_eval_cli(self, tmp_path, capsys):
+        log = tmp_path / "log.jsonl"
+        log.write_text("\n".join(
+            json.dumps({"text": text, "kind": "classification", "labels": labels})
+            for text, labels in self._records()
+        ))
+        intent_cli(["train", "--log", str(log), "--out", str(tmp_path / "nb.npz")])
+        capsys.readouterr()
+        intent_cli(["eval", "--log", str(log), "--model", str(tmp_path / "nb.npz")])
+        report = json.loads(capsys.readouterr().out)
+        assert report["is_on_topic"]["accuracy"] == 1.0
+        assert report["is_on_topic"]["coverage"] > 0.9
+
+    @pytest.mark.asyncio
+    async def test_agent_answers_locally_when_confident(self, agent, mock_llm, tmp_path, monkeypatch):
+        monkeypatch.setattr(intent_classifier, "log_path", tmp_path / "log.jsonl")
+        monkeypatch.setattr(intent_classifier, "shadow_rate", 0.0)
+        agent.artefacts.data = pd.DataFrame({"UnitId": ["T_01"], "jobs": [3]})
+
+        actions = await agent._get_actions("Make a chart of the previous result")
+        assert actions.is_new_image_needed and not actions.is_new_sql_query_needed
+        mock_llm.struct.assert_not_called()
+
+        # Not confident: defer to the LLM and log its labels for training
+        await agent._get_actions("What about the previous answer?")
+        assert mock_llm.struct.call_count == 1
+        logged = json.loads((tmp_path / "log.jsonl").read_text())
+        assert logged["kind"] == "actions" and logged["labels"]["is_new_sql_query_needed"] is True
+
+class TestPromptModes:
+    """Direct Spanish mode vs translating around the English prompts"""
+
+    @pytest.mark.asyncio
+    async def test_spanish_mode_skips_translation(self, agent, mock_llm):
+        agent._good_flow_async = AsyncMock(return_value=("Hay 3 equipos.", ["data"]))
+
+        response, metrics = await agent.execute("¿Cuántos equipos hay?", mode="spanish")
+
+        assert response == "Hay 3 equipos."
+        assert metrics["mode"] == "spanish"
+        assert not {"translate_in", "translate_out"} & set(metrics["stages"])
+        # Only _to_request called the chat model
+        assert mock_llm.chat.call_count == 1
+
+        _, metrics = await agent.execute("¿Cuántos equipos hay?")
+        assert metrics["mode"] == "translate"
+        assert {"translate_in", "translate_out"} <= set(metrics["stages"])
+
+    @pytest.mark.asyncio
+    async def test_spanish_prompts_and_fixed_replies(self, temp_db, mock_llm):
+        agent = ImprovedAgentChat(temp_db, mode="spanish")
+        agent.artefacts.data = pd.DataFrame({"UnitId": ["T_01"], "jobs": [3]})
+        agent._start_image_job = Mock()
+
+        reply, keys = await agent._image_only_branch_async("chart")
+        assert reply.startswith("La nueva imagen")
+        assert "Spanish" in agent.prompts["final_answer"][0]["content"]
+
+        with pytest.raises(ValueError):
+            ImprovedAgentChat(temp_db, mode="klingon")
+
+    @pytest.mark.asyncio
+    async def test_judge_maps_blind_order_back_to_modes(self):
+        llm = AsyncMock()
+        llm.struct.return_value = SimpleNamespace(score_a=2, score_b=5, preferred="B", rationale="B is correct")
+        rng = random.Random(1)
+
+        verdict = await judge(llm, "q", {"translate": "t", "spanish": "s"}, rng)
+        prompt = llm.struct.call_args[0][0][-1]["content"]
+        first = "translate" if "Answer A: t" in prompt else "spanish"
+        second = "spanish" if first == "translate" else "translate"
+
+        assert verdict["scores"] == {first: 2, second: 5}
+        assert verdict["preferred"] == second
+
+        summary = summarise(
+            {"translate": [{"total_time": 3.0}], "spanish": [{"total_time": 1.5}]},
+            [verdict],
+        )
+        assert summary["spanish"]["mean_time"] == 1.5
+        assert summary[second]["preferred"] == 1
+
+class TestTranslationMemory:
+    """Local answers for recurring phrases ahead of the translation LLM call"""
+
+    def test_language_detection(self):
+        assert detect_language("¿y por sistema?") == "spanish"
+        assert detect_language("cuantos trabajos tiene el equipo") == "spanish"
+        assert detect_language("How many jobs per unit") == "english"
+        assert detect_language("T_01 2024") is None
+
+    def test_local_answers(self):
+        tm = TranslationMemory(path=None)
+        assert tm.lookup("T_01, 2024", "spanish", "english") == "T_01, 2024"
+        assert tm.lookup("Show me the jobs of the unit", "spanish", "english") == "Show me the jobs of the unit"
+        assert tm.lookup("Gráfico de barras", "spanish", "english") == "bar chart"
+        assert tm.lookup("¿y para T_01?", "spanish", "english") is None
+
+        tm.store("¿y para T_01?", "spanish", "english", "And for T_01?", latency=0.8)
+        assert tm.lookup("¿y para T_01?", "spanish", "english") == "And for T_01?"
+        # Normalised template: case, accents, punctuation and identifiers ignored
+        assert tm.lookup("Y PARA T_07", "spanish", "english") == "And for T_07?"
+        assert tm.lookup("And for T_01?", "english", "spanish") is None
+
+    def test_persistence_and_glossary_hint(self, tmp_path):
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(
+            "CREATE TABLE system (system TEXT); INSERT INTO system VALUES ('Transmision');"
+            "CREATE TABLE subsystem (subsystem TEXT); CREATE TABLE component (component TEXT);"
+        )
+        tm = TranslationMemory(path=tmp_path / "tm.db")
+        tm.add_names_from_db(conn)
+        tm.store("¿y por sistema?", "spanish", "english", "And by system?", latency=0.5)
+
+        assert TranslationMemory(path=tmp_path / "tm.db").lookup("y por sistema", "spanish", "english") == "And by system?"
+        hint = tm.glossary_hint("trabajos por sistema en la Transmision", "spanish", "english")
+        assert "'sistema' -> 'system'" in hint and "Transmision" in hint
+
+    def test_locked_database_never_fails_the_turn(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(translation_memory_module, "WRITE_TIMEOUT", 0.05)
+        path = tmp_path / "shared" / "tm.db"
+        tm = TranslationMemory(path=path)
+        assert not path.parent.exists()  # opened on first use, not at import
+
+        assert tm.lookup("¿y para T_01?", "spanish", "english") is None
+        other = sqlite3.connect(str(path))
+        other.execute("BEGIN EXCLUSIVE")  # another worker writing
+        failed = runtime_stats.get("translation_memory").get("store_failed", 0)
+        tm.store("¿y para T_01?", "spanish", "english", "And for T_01?", latency=0.8)
+        other.rollback()
+
+        assert runtime_stats.get("translation_memory")["store_failed"] == failed + 1
+        assert tm.lookup("¿y para T_01?", "spanish", "english") == "And for T_01?"
+
+    @pytest.mark.asyncio
+    async def test_agent_reuses_translations(self, agent, mock_llm, translation_memory):
+        mock_llm.chat.return_value = "And by system?"
+        for _ in range(3):
+            assert await agent._translate("¿y por sistema?", src="spanish", tgt="english") == "And by system?"
+
+        mock_llm.chat.assert_called_once()
+        stats = translation_memory.stats()
+        assert stats["lookups"] >= 3 and stats["hit_rate"] > 0
+
 # ─────────────────────────── INTEGRATION TESTS ─────────────────────────── #
 
+class TestResponseTemplates:
+    """Local Spanish replies for bad flows and trivial results"""
+
+    def test_result_templates(self):
+        from src.response_templates import result_reply, format_value
+
+        assert format_value(1234567) == "1.234.567"
+        assert format_value(2.5) == "2,50"
+        assert "**12**" in result_reply(pd.DataFrame({"n": [12]}))
+        assert "no devolvió resultados" in result_reply(pd.DataFrame({"n": []}))
+        table = result_reply(pd.DataFrame({"UnitId": ["T_01", "T_02"], "jobs": [3, 4]}))
+        assert "| T_02 | 4 |" in table and table.lang == "spanish"
+        # Too large: the LLM explains it
+        assert result_reply(pd.DataFrame({"n": range(50)})) is None
+
+    @pytest.mark.asyncio
+    async def test_bad_flow_skips_llm_and_translation(self, agent, mock_llm):
+        mock_llm.struct.return_value = SimpleNamespace(
+            is_on_topic=False, is_context_sufficient=True,
+            is_new_sql_query_needed=False, is_new_image_needed=False,
+        )
+
+        response, metrics = await agent.execute("What is the weather like?")
+
+        assert response.startswith("Lo siento")
+        assert metrics["branch_source"] == "template"
+        assert metrics["stages"]["translate_out"]["status"] == "skipped"
+        counters = runtime_stats.get("branch_latency")
+        assert counters["not_on_topic.template.count"] >= 1
+
+    @pytest.mark.asyncio
+    async def test_scalar_result_answered_locally(self, agent, mock_llm):
+        df = pd.DataFrame({"total_jobs": [42]})
+        agent._supervised_sql_async = AsyncMock(return_value=("SELECT 42", df, Path("data_0.csv"), True))
+        calls = mock_llm.chat.call_count
+
+        answer, keys = await agent._data_refresh_branch_async("How many jobs?", also_image=False)
+
+        assert "**42**" in answer and answer.source == "template"
+        assert mock_llm.chat.call_count == calls
+
+class TestResultDigest:
+    """Token-budgeted result summaries for the final-answer prompt"""
+
+    @pytest.fixture
+    def large_frame(self):
+        n = 20000
+        return pd.DataFrame({
+            "UnitId": [f"T_{i % 12:02d}" for i in range(n)],
+            "date": pd.date_range("2023-01-01", periods=n, freq="h"),
+            "hours": [float(i % 97) / 3 for i in range(n)],
+        })
+
+    def test_small_results_are_sent_whole(self):
+        df = pd.DataFrame({"UnitId": ["T_01", "T_02"], "jobs": [3, 4]})
+        result = digest(df)
+        assert result.full and result.text == df.to_string(index=False)
+
+    def test_large_results_fit_the_budget(self, large_frame):
+        result = digest(large_frame, token_budget=800, source=Path("chat_docs/run/data_3.csv"))
+
+        assert not result.full
+        assert result.tokens <= 800
+        assert "20000 rows x 3 columns (full table saved as data_3.csv)" in result.text
+        assert "from 2023-01-01 to 2025-04-13 07:00:00" in result.text
+        assert "12 distinct" in result.text
+        assert f"sample of {result.sample_rows} rows" in result.text
+
+    def test_profiles_and_sample(self, large_frame):
+        assert "min 0, max 32, mean" in profile_column(large_frame["hours"])
+        sample = sample_rows(large_frame, 10)
+        # Starts with the first rows and reaches the end of the table
+        assert list(sample.index[:3]) == [0, 1, 2]
+        assert sample.index[-1] == len(large_frame) - 1
+
+    @pytest.mark.asyncio
+    async def test_final_answer_prompt_uses_digest(self, agent, mock_llm, large_frame):
+        await agent._create_final_answer("Hours per unit?", large_frame, source=Path("data_0.csv"))
+
+        prompt = mock_llm.chat.call_args[0][0][-1]["content"]
+        assert "Column profile:" in prompt
+        assert len(prompt) < len(large_frame.to_string(index=False)) / 20
+        assert agent.artefacts.metrics.result_tokens is not None
+
+def _op(op, **fields):
+    base = dict(column=None, operator=None, value=None, by=None, pivot_column=None, agg=None, ascending=None, n=None)
+    return dataframeOperation(op=op, **{**base, **fields})
+
+class TestDataframeOps:
+    """Local operation plans over the previous result"""
+
+    @pytest.fixture
+    def jobs(self):
+        return pd.DataFrame({
+            "UnitId": ["T_01", "T_01", "T_02", "T_03", "T_03"],
+            "system": ["Motor", "Frenos", "Motor", "Motor", "Frenos"],
+            "downtime": [5.0, 2.0, 9.0, 1.0, 4.0],
+        })
+
+    def test_filter_sort_top_k(self, jobs):
+        plan = operationPlan(uses_current_data_only=True, operations=[
+            _op("filter", column="system", operator="==", value="motor"),
+            _op("top_k", column="downtime", n=2, ascending=False),
+        ])
+        out = apply_plan(jobs, plan)
+        assert out["UnitId"].tolist() == ["T_02", "T_01"]
+        assert len(jobs) == 5  # input untouched
+
+    def test_group_and_pivot(self, jobs):
+        grouped = apply_plan(jobs, operationPlan(uses_current_data_only=True, operations=[
+            _op("group", by=["UnitId"], column="downtime", agg="sum"),
+            _op("sort", column="downtime", ascending=True),
+        ]))
+        assert grouped.to_dict("list") == {"UnitId": ["T_03", "T_01", "T_02"], "downtime": [5.0, 7.0, 9.0]}
+
+        pivot = apply_plan(jobs, operationPlan(uses_current_data_only=True, operations=[
+            _op("pivot", by=["UnitId"], pivot_column="system", column="downtime", agg="max"),
+        ]))
+        assert list(pivot.columns) == ["UnitId", "Frenos", "Motor"]
+
+    def test_invalid_plans_raise(self, jobs):
+        with pytest.raises(PlanError):
+            apply_plan(jobs, operationPlan(uses_current_data_only=False, operations=[]))
+        with pytest.raises(PlanError):
+            apply_plan(jobs, operationPlan(uses_current_data_only=True, operations=[_op("sort", column="cost")]))
+        with pytest.raises(PlanError):
+            apply_plan(jobs, operationPlan(uses_current_data_only=True, operations=[_op("drop_table")]))
+
+    @pytest.mark.asyncio
+    async def test_follow_up_runs_locally(self, agent, mock_llm, jobs):
+        agent.artefacts.data, agent.artefacts.sql_query = jobs, "SELECT ..."
+        agent._supervised_sql_async = AsyncMock()
+        mock_llm.struct.return_value = operationPlan(uses_current_data_only=True, operations=[
+            _op("filter", column="UnitId", operator="in", value="T_01,T_03"),
+            _op("sort", column="downtime", ascending=False),
+        ])
+        actions = actionsRequired(is_new_sql_query_needed=True, is_new_image_needed=False)
+
+        answer, keys = await agent._good_flow_async("Solo T_01 y T_03, ordenado por downtime", actions)
+
+        agent._supervised_sql_async.assert_not_called()
+        assert agent.artefacts.data["downtime"].tolist() == [5.0, 4.0, 2.0, 1.0]
+        assert agent.artefacts.data_file.exists()
+        assert agent.artefacts.metrics.branch == "dataframe_ops"
+        assert set(keys) == {"data", "data_file"}
+
+    @pytest.mark.asyncio
+    async def test_new_data_falls_back_to_sql(self, agent, mock_llm, jobs):
+        agent.artefacts.data = jobs
+        df = pd.DataFrame({"UnitId": ["T_09"], "downtime": [3.0]})
+        agent._supervised_sql_async = AsyncMock(return_value=("SELECT 9", df, Path("data_0.csv"), True))
+        mock_llm.struct.return_value = operationPlan(uses_current_data_only=False, operations=[])
+        actions = actionsRequired(is_new_sql_query_needed=True, is_new_image_needed=False)
+
+        await agent._good_flow_async("And for T_09?", actions)
+
+        agent._supervised_sql_async.assert_awaited_once()
+        mock_llm.struct.assert_not_called()  # not a reshaping request: no planning call
+        assert agent.artefacts.metrics.branch == "data_refresh"
+
+    @pytest.mark.asyncio
+    async def test_failed_plan_call_falls_back_to_sql(self, agent, mock_llm, jobs):
+        agent.artefacts.data = jobs
+        df = pd.DataFrame({"UnitId": ["T_01"], "downtime": [5.0]})
+        agent._supervised_sql_async = AsyncMock(return_value=("SELECT 1", df, Path("data_0.csv"), True))
+        mock_llm.struct.side_effect = improved_agent.CircuitOpenError("Circuit open for gpt-4o-mini")
+        actions = actionsRequired(is_new_sql_query_needed=True, is_new_image_needed=False)
+
+        await agent._good_flow_async("Only T_01, sorted by downtime", actions)
+
+        mock_llm.struct.assert_awaited_once()
+        agent._supervised_sql_async.assert_awaited_once()
+        assert agent.artefacts.metrics.branch == "data_refresh"
+
+    def test_plan_stage_uses_the_chat_model(self):
+        table = RoutingTable.load(env={}, path=None)
+        assert table.route("dataframe_ops", structured=True).model == table.chat_default.model
+
+class TestDecomposition:
+    """Multi-part requests split into concurrent sub-queries"""
+
+    def test_gate_and_merge(self):
+        assert looks_multi_part("Compare downtime and job counts between Motor and Transmision per month")
+        assert looks_multi_part("Downtime and jobs per unit")
+        assert not looks_multi_part("How many maintenance cycles per unit?")
+
+        downtime = pd.DataFrame({"month": ["2024-01", "2024-02"], "system": ["Motor", "Motor"], "downtime": [5, 7]})
+        jobs = pd.DataFrame({"month": ["2024-02", "2024-03"], "system": ["Motor", "Motor"], "jobs": [3, 1]})
+        merged = merge_frames([downtime, jobs], ["month", "system"])
+        assert merged["month"].tolist() == ["2024-01", "2024-02", "2024-03"]
+        assert merged.loc[1, "jobs"] == 3
+        # Nothing to merge on
+        assert merge_frames([pd.DataFrame({"a": [1]}), pd.DataFrame({"b": [2]})]) is None
+
+    def test_pool_uses_read_only_connections(self, temp_db):
+        pool = SQLiteConnectionPool(temp_db.execute("PRAGMA database_list").fetchone()[2], size=2)
+        assert len(pool.read_sql("SELECT * FROM equipment")) == 3
+        with pytest.raises(Exception):
+            pool.read_sql("DELETE FROM equipment")
+        assert pool.stats()["queries"] == 2
+        pool.close()
+
+    @pytest.mark.asyncio
+    async def test_sub_queries_run_concurrently(self, agent, mock_llm):
+        mock_llm.struct.return_value = questionDecomposition(
+            is_multi_part=True, sub_questions=["Downtime per month", "Jobs per month"], join_keys=["month"]
+        )
+        frames = {
+            "Downtime per month": pd.DataFrame({"month": ["2024-01"], "downtime": [5]}),
+            "Jobs per month": pd.DataFrame({"month": ["2024-01"], "jobs": [2]}),
+        }
+
+        async def sql_round(question, previous):
+            await asyncio.sleep(0.2)
+            return f"SELECT /* {question} */", frames[question]
+
+        agent._single_sql_round_async = sql_round
+        start = time.time()
+        sql_query, df, data_path, ok = await agent._decomposed_sql_async("Compare downtime and jobs per month")
+
+        assert time.time() - start < 0.35
+        assert ok and df.to_dict("list") == {"month": ["2024-01"], "downtime": [5], "jobs": [2]}
+        assert sql_query.count("SELECT") == 2
+        assert [q["rows"] for q in agent.artefacts.metrics.sub_queries] == [1, 1]
+
+    @pytest.mark.asyncio
+    async def test_single_question_is_not_decomposed(self, agent, mock_llm):
+        mock_llm.struct.return_value = questionDecomposition(is_multi_part=False, sub_questions=[], join_keys=[])
+        assert await agent._decomposed_sql_async("Compare T_01 with itself") is None
+
+    @pytest.mark.asyncio
+    async def test_failed_decomposition_uses_a_single_query(self, agent, mock_llm):
+        mock_llm.struct.side_effect = TimeoutError("decomposition timed out")
+        assert await agent._decomposed_sql_async("Compare downtime and jobs per month") is None
+
+        mock_llm.struct.side_effect = None
+        mock_llm.struct.return_value = questionDecomposition(
+            is_multi_part=True, sub_questions=["Downtime per month", "Jobs per month"], join_keys=["month"]
+        )
+        agent._single_sql_round_async = AsyncMock(side_effect=RuntimeError("LLM unavailable"))
+        assert await agent._decomposed_sql_async("Compare downtime and jobs per month") is None
+
+class TestLatencyBudget:
+    """Request profiles and graceful degradation under a deadline"""
+
+    def test_profile_selection(self):
+        assert make_deadline(latency_budget_ms=3000).profile.name == "fast"
+        assert make_deadline(latency_budget_ms=15000).profile.name == "balanced"
+        assert make_deadline("balanced").budget == 20.0
+        assert make_deadline("thorough").remaining() == float("inf")
+        with pytest.raises(ValueError):
+            make_deadline("instant")
+
+    @pytest.mark.asyncio
+    async def test_fast_profile_drops_image(self, agent, mock_llm):
+        mock_llm.struct.return_value = Mock(
+            is_on_topic=True, is_context_sufficient=True, is_new_sql_query_needed=True, is_new_image_needed=True
+        )
+        df = pd.DataFrame({"UnitId": [f"T_{i:02d}" for i in range(8)], "jobs": range(8)})
+        agent._supervised_sql_async = AsyncMock(return_value=("SELECT 1", df, Path("data_0.csv"), True))
+        agent._start_image_job = Mock()
+
+        response, metrics = await agent.execute("Gráfico de trabajos por equipo", profile="fast")
+
+        agent._start_image_job.assert_not_called()
+        assert metrics["profile"] == "fast" and metrics["latency_budget_ms"] == 5000
+        assert "image" in metrics["degraded"]
+
+    @pytest.mark.asyncio
+    async def test_partial_answer_when_budget_is_spent(self, agent, mock_llm):
+        df = pd.DataFrame({"UnitId": [f"T_{i:02d}" for i in range(8)], "jobs": range(8)})
+        deadline = make_deadline("fast", latency_budget_ms=500)
+        token = set_deadline(deadline)
+        try:
+            answer = await agent._create_final_answer("Jobs per unit", df)
+        finally:
+            reset_deadline(token)
+
+        assert answer.startswith("Respuesta parcial") and "de 8 filas" in answer
+        assert deadline.degraded == ["final_answer"]
+        mock_llm.chat.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_fast_profile_skips_sql_retries(self, agent):
+        agent._single_sql_round_async = AsyncMock(return_value=("SELECT 0", pd.DataFrame()))
+        deadline = make_deadline("fast")
+        token = set_deadline(deadline)
+        try:
+            *_, ok = await agent._supervised_sql_async("Jobs for T_99")
+        finally:
+            reset_deadline(token)
+
+        assert not ok
+        assert agent._single_sql_round_async.await_count == 1
+        assert "sql_retries" in deadline.degraded
+
+class TestModelRouting:
+    """Per-stage model routes, latency histograms and SLO recommendations"""
+
+    def test_routes_are_layered(self, tmp_path):
+        routes_file = tmp_path / "routes.json"
+        routes_file.write_text(json.dumps({"sql_query": {"model": "gpt-4o", "slo_ms": 6000, "max_tokens": 400}}))
+        env = {"MODEL_ROUTE_SQL_QUERY_TIMEOUT": "12", "MODEL_ROUTE_TRANSLATION_FAST_MODEL": "tiny"}
+
+        table = RoutingTable.load(env=env, path=str(routes_file))
+        sql = table.route("sql_query")
+        assert (sql.model, sql.slo_ms, sql.max_tokens, sql.timeout) == ("gpt-4o", 6000, 400, 12.0)
+        assert table.route("translation").fast_model == "tiny"
+        assert table.route("classification").model == table.struct_default.model
+        assert table.route("unlisted", structured=True) is table.struct_default
+
+    def test_unknown_route_field_is_rejected(self, tmp_path):
+        routes_file = tmp_path / "routes.json"
+        routes_file.write_text(json.dumps({"sql_query": {"temperature": 0}}))
+        with pytest.raises(ValueError):
+            RoutingTable.load(env={}, path=str(routes_file))
+
+    def test_histogram_quantiles(self):
+        stats = RuntimeStats()
+        for ms in [80] * 90 + [3000] * 10:
+            stats.histogram("llm_latency", "sql_query:gpt-4o", ms / 1000)
+        hist = stats.histograms("llm_latency")["sql_query:gpt-4o"]
+        assert hist["count"] == 100
+        assert hist["p50_ms"] == 100 and hist["p95_ms"] == 4000
+        assert hist["buckets"]["<=100"] == 90
+
+    def test_recommends_cheapest_model_meeting_slo(self):
+        table = RoutingTable({"routing_probe": StageRoute("gpt-4o", "gpt-4o-mini", slo_ms=1000)})
+        for _ in range(20):
+            table.record("routing_probe", "gpt-4o", 0.4)
+            table.record("routing_probe", "gpt-4o-mini", 0.2)
+            table.record("routing_probe", "o3-mini", 3.0)
+
+        report = table.recommend()["routing_probe"]
+        assert report["recommended"] == "gpt-4o-mini"
+        assert report["p95_ms"]["o3-mini"] > report["slo_ms"]
+        assert table.recommend(min_samples=50)["routing_probe"]["recommended"] is None
+
+    @pytest.mark.asyncio
+    async def test_llm_call_uses_stage_route(self, monkeypatch):
+        table = RoutingTable({"sql_query": StageRoute("gpt-4o", "gpt-4o-mini", timeout=7.0, max_tokens=300)})
+        monkeypatch.setattr(improved_agent, "model_routes", table)
+        create = AsyncMock(return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=" SELECT 1 "))]
+        ))
+        llm = improved_agent.AsyncLLM(api_key="sk-test")
+        llm._client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+        token = set_deadline(make_deadline("fast"))
+        try:
+            assert await llm.chat([{"role": "user", "content": "q"}], stage="sql_query") == "SELECT 1"
+        finally:
+            reset_deadline(token)
+
+        kwargs = create.await_args.kwargs
+        assert (kwargs["model"], kwargs["timeout"], kwargs["max_completion_tokens"]) == ("gpt-4o-mini", 7.0, 300)
+
+class TestLLMResilience:
+    """Hedged LLM calls and per-model circuit breakers"""
+
+    @staticmethod
+    def _sender(*delays):
+        calls = []
+
+        async def send():
+            n = len(calls)
+            calls.append(n)
+            await asyncio.sleep(delays[n])
+            return SimpleNamespace(answer=n, usage=SimpleNamespace(total_tokens=40))
+        return send, calls
+
+    @pytest.mark.asyncio
+    async def test_hedge_answers_for_slow_call(self):
+        send, calls = self._sender(2.0, 0.01)
+        won = hedge_stats().get("won", 0)
+        start = time.time()
+        resp = await hedged(send, CircuitBreaker("hedge-test"), delay=0.05)
+
+        assert resp.answer == 1 and len(calls) == 2
+        assert time.time() - start < 1.0
+        assert hedge_stats()["won"] == won + 1 and hedge_stats()["wasted_tokens"] >= 40
+
+    @pytest.mark.asyncio
+    async def test_no_hedge_before_delay(self):
+        send, calls = self._sender(0.01, 0.01)
+        resp = await hedged(send, CircuitBreaker("hedge-test"), delay=0.5)
+        assert resp.answer == 0 and len(calls) == 1
+
+    def test_breaker_opens_and_closes_on_probe(self):
+        breaker = CircuitBreaker("breaker-test", window=4, min_calls=4, failure_rate=0.5, cooldown=0.05)
+        for ok in (True, False, True, False):
+            breaker.record(ok)
+        assert breaker.state == "open" and not breaker.allow()
+
+        time.sleep(0.06)
+        assert breaker.allow()  # the probe
+        assert not breaker.allow()
+        breaker.record(True)
+        assert breaker.state == "closed" and breaker.allow()
+
+    @pytest.mark.asyncio
+    async def test_cancelled_probe_frees_the_breaker(self):
+        breaker = CircuitBreaker("probe-test", window=2, min_calls=2, failure_rate=0.5, cooldown=0.01)
+        breaker.record(False)
+        breaker.record(False)
+        await asyncio.sleep(0.02)
+
+        assert breaker.allow()  # the probe
+        probe = asyncio.create_task(hedged(self._sender(1.0)[0], breaker, delay=None))
+        await asyncio.sleep(0.01)
+        probe.cancel()  # e.g. a newer chart superseded it
+        await asyncio.gather(probe, return_exceptions=True)
+
+        assert breaker.state == "half_open" and breaker.allow()
+        breaker.record(True)
+        assert breaker.state == "closed"
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_falls_back_then_fails_fast(self, monkeypatch):
+        table = RoutingTable({"sql_query": StageRoute("cb-big", "cb-small")})
+        monkeypatch.setattr(improved_agent, "model_routes", table)
+        create = AsyncMock(return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="SELECT 1"))]
+        ))
+        llm = improved_agent.AsyncLLM(api_key="sk-test")
+        llm._client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        improved_agent.breaker_for("cb-big")._opened_at = time.monotonic()
+
+        deadline = make_deadline("thorough")
+        token = set_deadline(deadline)
+        try:
+            assert await llm.chat([], stage="sql_query") == "SELECT 1"
+            assert create.await_args.kwargs["model"] == "cb-small"
+            assert "llm_fallback_model" in deadline.degraded
+
+            improved_agent.breaker_for("cb-small")._opened_at = time.monotonic()
+            with pytest.raises(improved_agent.CircuitOpenError):
+                await llm.chat([], stage="sql_query")
+        finally:
+            reset_deadline(token)
+        assert create.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_route_without_retries_still_calls_once(self, monkeypatch):
+        table = RoutingTable({"sql_query": StageRoute("r0-big", "r0-small", retries=0)})
+        monkeypatch.setattr(improved_agent, "model_routes", table)
+        create = AsyncMock(return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="SELECT 1"))]
+        ))
+        llm = improved_agent.AsyncLLM(api_key="sk-test")
+        llm._client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+        assert await llm.chat([], stage="sql_query") == "SELECT 1"
+        assert create.await_count == 1
+
+        create.side_effect = RuntimeError("upstream down")
+        with pytest.raises(RuntimeError):
+            await llm.chat([], stage="sql_query")
+        assert create.await_count == 2  # no retry
+
+class TestOpenAIPool:
+    """One pre-warmed OpenAI client shared by every session"""
+
+    def test_agents_share_injected_client(self, temp_db):
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key="sk-test")
+        first, second = ImprovedAgentChat(temp_db, client=client), ImprovedAgentChat(temp_db, client=client)
+        assert first.llm._client is client and second.llm._client is client
+
+    @pytest.mark.asyncio
+    async def test_warm_up_opens_connections(self):
+        import httpx
+        from openai import AsyncOpenAI
+        seen = []
+
+        def handler(request):
+            seen.append(request.url.path)
+            return httpx.Response(401, json={"error": {"message": "bad key"}})
+
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client = AsyncOpenAI(api_key="sk-test", http_client=http)
+        try:
+            assert await openai_pool.warm_up(client, connections=2) == 2
+        finally:
+            await client.close()
+        assert seen == ["/v1/models", "/v1/models"]
+
+    @pytest.mark.asyncio
+    async def test_shared_client_lifecycle(self):
+        await openai_pool.close_client()
+        assert openai_pool.client_stats() == {}
+
+        client = openai_pool.open_client(api_key="sk-test")
+        assert openai_pool.open_client() is client is openai_pool.shared_client()
+        stats = openai_pool.client_stats()
+        assert stats["connections"] == 0 and stats["max_connections"] == openai_pool.OPENAI_MAX_CONNECTIONS
+
+        await openai_pool.close_client()
+        assert openai_pool.shared_client() is None
+
+class TestSessionStore:
+    """Bounded sessions with idle TTL, memory-based LRU eviction and spill to disk"""
+
+    @pytest.fixture
+    def store(self, temp_db, tmp_path):
+        async def factory():
+            return ImprovedAgentChat(temp_db)
+        return SessionStore(factory, backend=FileSessionBackend(tmp_path / "sessions"), max_sessions=2)
+
+    @staticmethod
+    def _fill(agent, rows):
+        agent.artefacts.data = pd.DataFrame({"UnitId": [f"T_{i:03d}" for i in range(rows)], "jobs": range(rows)})
+        agent.history.append({"role": "user", "content": "Trabajos por equipo"})
+
+    def test_footprint_counts_frame_image_and_history(self, agent):
+        empty = footprint(agent)
+        self._fill(agent, 200)
+        agent.artefacts.image = b"x" * 5000
+        assert footprint(agent) > empty + 5000 + agent.artefacts.data.memory_usage(deep=True).sum() - 1
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction_spills_and_rehydrates(self, store):
+        ids = []
+        for rows in (10, 20, 30):
+            async with store.use() as (session_id, agent):
+                self._fill(agent, rows)
+                ids.append(session_id)
+
+        assert len(store) == 2 and ids[0] not in store
+        assert store.stats()["stored"] == 1
+
+        agent = await store.get(ids[0])
+        assert len(agent.artefacts.data) == 10
+        assert agent.history[-1]["content"] == "Trabajos por equipo"
+        assert store.stats()["stored"] == 1  # kept until the session is spilled again
+
+    @pytest.mark.asyncio
+    async def test_discarded_session_falls_back_to_its_saved_copy(self, store):
+        async with store.use() as (session_id, agent):
+            self._fill(agent, 10)
+        await store.spill_all()
+        async with store.use(session_id) as (_, agent):
+            agent.history.append({"role": "user", "content": "half-done turn"})
+        store.discard(session_id)  # what the API does when a turn fails
+
+        agent = await store.get(session_id)
+        assert agent is not None and len(agent.artefacts.data) == 10
+        assert agent.history[-1]["content"] == "Trabajos por equipo"
+
+    @pytest.mark.asyncio
+    async def test_sweep_keeps_the_copy_of_a_resident_session(self, store):
+        async with store.use() as (session_id, agent):
+            self._fill(agent, 10)
+        await store.spill_all()
+        await store.get(session_id)  # resident again, its spill file kept
+
+        store.spill_ttl = 0.0
+        await store.sweep()
+        store.discard(session_id)
+        agent = await store.get(session_id)
+        assert agent is not None and len(agent.artefacts.data) == 10
+
+    @pytest.mark.asyncio
+    async def test_memory_limit_and_idle_ttl(self, store):
+        store.max_sessions = 10
+        async with store.use() as (first, agent):
+            self._fill(agent, 500)
+        store.max_bytes = store.stats()["bytes"] + 100
+        async with store.use() as (second, agent):
+            self._fill(agent, 500)
+        assert first not in store and second in store
+
+        store.idle_ttl = 0.0
+        await store.enforce()
+        assert len(store) == 0 and store.stats()["stored"] == 2
+
+    @pytest.mark.asyncio
+    async def test_active_session_is_not_evicted(self, store):
+        store.max_sessions = 0
+        async with store.use() as (session_id, agent):
+            await store.enforce()
+            assert session_id in store
+        assert session_id not in store
+
+    @pytest.mark.asyncio
+    async def test_delete_and_unknown_ids(self, store):
+        async with store.use() as (session_id, _):
+            pass
+        assert await store.get("../../etc/passwd") is None
+        assert await store.delete(session_id)
+        assert await store.get(session_id) is None
+        assert not await store.delete(session_id)
+
+class TestSessionTurns:
+    """Turns of one session run one at a time, different sessions in parallel"""
+
+    @pytest.fixture
+    def store(self, temp_db, tmp_path):
+        async def factory():
+            return ImprovedAgentChat(temp_db)
+        return SessionStore(factory, backend=FileSessionBackend(tmp_path / "sessions"), lock_timeout=1.0)
+
+    @staticmethod
+    async def _turn(store, session_id, log, label, delay=0.05):
+        async with store.use(session_id) as (_, agent):
+            log.append(f"{label}:start")
+            agent.history.append({"role": "user", "content": label})
+            await asyncio.sleep(delay)
+            log.append(f"{label}:end")
+
+    @pytest.mark.asyncio
+    async def test_same_session_turns_run_in_order(self, store):
+        async with store.use() as (session_id, _):
+            pass
+        log = []
+        await asyncio.gather(*(self._turn(store, session_id, log, label) for label in "abc"))
+        assert log == ["a:start", "a:end", "b:start", "b:end", "c:start", "c:end"]
+        agent = await store.get(session_id)
+        assert [m["content"] for m in agent.history] == ["a", "b", "c"]
+        stats = store.stats()
+        assert stats["queued_requests"] == 0 and stats["counters"]["queued"] >= 2
+        assert stats["queue_wait"]["count"] >= 3
+
+    @pytest.mark.asyncio
+    async def test_different_sessions_run_in_parallel(self, store):
+        ids = []
+        for _ in range(3):
+            async with store.use() as (session_id, _):
+                ids.append(session_id)
+        log = []
+        start = time.perf_counter()
+        await asyncio.gather(*(self._turn(store, sid, log, str(i), delay=0.2) for i, sid in enumerate(ids)))
+        assert time.perf_counter() - start < 0.5
+        assert log[:3] == ["0:start", "1:start", "2:start"]
+
+    @pytest.mark.asyncio
+    async def test_reject_policy_and_queue_timeout(self, store):
+        async with store.use() as (session_id, _):
+            pass
+        store.busy_policy = "reject"
+        async with store.use(session_id):
+            with pytest.raises(SessionBusy):
+                async with store.use(session_id):
+                    pass
+
+        store.busy_policy, store.lock_timeout = "queue", 0.05
+        async with store.use(session_id):
+            with pytest.raises(SessionBusy):
+                async with store.use(session_id):
+                    pass
+        async with store.use(session_id) as (same_id, _):
+            assert same_id == session_id
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_never_keeps_the_lock(self):
+        lock = asyncio.Lock()
+        await lock.acquire()
+        waiter = asyncio.create_task(acquire_within(lock, 10))
+        await asyncio.sleep(0.01)
+        # The lock is handed over and the waiter cancelled in the same tick
+        lock.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not lock.locked()
+
+        await lock.acquire()
+        assert not await acquire_within(lock, 0.01)
+        lock.release()
+        assert not lock.locked()
+
+    @pytest.mark.asyncio
+    async def test_overlapping_saves_get_distinct_files(self, agent):
+        frame = pd.DataFrame({"UnitId": ["T_01"], "jobs": [1]})
+        paths = await asyncio.gather(*(agent.fs.save_dataframe(frame) for _ in range(5)))
+        assert len(set(paths)) == 5 and agent.fs.counter["data"] == 5
+
+
+class TestSharedSessionBackend:
+    """Sessions shared by several workers through one SQLite file"""
+
+    @pytest.fixture
+    def workers(self, temp_db, tmp_path):
+        async def factory():
+            return ImprovedAgentChat(temp_db)
+        db = tmp_path / "sessions.db"
+        return [
+            SessionStore(factory, backend=SQLiteSessionBackend(db), lock_timeout=0.2)
+            for _ in range(2)
+        ]
+
+    def test_versions_and_leases(self, tmp_path):
+        backend = SQLiteSessionBackend(tmp_path / "sessions.db")
+        assert backend.save("s1", b"one", expected_version=0) == 1
+        with pytest.raises(SessionConflict):
+            backend.save("s1", b"stale", expected_version=0)
+        assert backend.load("s1") == (1, b"one")
+
+        assert backend.acquire("s1", "worker-a", ttl=60)
+        assert not backend.acquire("s1", "worker-b", ttl=60)
+        backend.release("s1", "worker-a")
+        assert backend.acquire("s1", "worker-b", ttl=-1)  # already expired
+        assert backend.acquire("s1", "worker-a", ttl=60)
+        assert backend.delete("s1") and backend.load("s1") is None
+
+    @pytest.mark.asyncio
+    async def test_any_worker_serves_the_session(self, workers):
+        first, second = workers
+        async with first.use() as (session_id, agent):
+            agent.artefacts.data = pd.DataFrame({"UnitId": ["T_01", "T_02"], "jobs": [3, 4]})
+            agent.history.append({"role": "user", "content": "Trabajos por equipo"})
+
+        async with second.use(session_id) as (same_id, agent):
+            assert same_id == session_id
+            assert agent.artefacts.data["jobs"].tolist() == [3, 4]
+            agent.history.append({"role": "assistant", "content": "Listo"})
+
+        agent = await first.get(session_id)  # reloads the newer version
+        assert [m["content"] for m in agent.history] == ["Trabajos por equipo", "Listo"]
+
+    @pytest.mark.asyncio
+    async def test_background_chart_survives_a_newer_turn_elsewhere(self, workers, tmp_path):
+        first, second = workers
+        chart = asyncio.get_running_loop().create_future()
+        async with first.use() as (session_id, agent):
+            agent.artefacts.image_status, agent.artefacts.image_job = "pending", "job-1"
+            agent.image_task = chart
+
+        # The next turn is served by the other worker before the chart is done
+        async with second.use(session_id) as (_, other):
+            assert other.artefacts.image_status == "pending"
+            other.history.append({"role": "user", "content": "Y el downtime?"})
+
+        agent.artefacts.image_file = tmp_path / "image_0.png"
+        agent.artefacts.image_status = "ready"
+        merged_before = first.stats()["counters"].get("background_merged", 0)
+        chart.set_result(agent.artefacts.image_file)
+        await asyncio.gather(*first._background)
+        assert first.stats()["counters"]["background_merged"] == merged_before + 1
+
+        for worker in workers:
+            merged = await worker.get(session_id)
+            assert merged.artefacts.image_status == "ready"
+            assert merged.artefacts.image_file == tmp_path / "image_0.png"
+            assert merged.history[-1]["content"] == "Y el downtime?"
+
+    @pytest.mark.asyncio
+    async def test_long_poll_sees_a_chart_rendered_elsewhere(self, workers, tmp_path, monkeypatch):
+        first, second = workers
+        chart = asyncio.get_running_loop().create_future()
+        async with first.use() as (session_id, agent):
+            agent.artefacts.image_status, agent.artefacts.image_job = "pending", "job-1"
+            agent.image_task = chart
+
+        monkeypatch.setattr(fastapi_microservice, "session_store", second)
+        elsewhere = await second.get(session_id)
+        waiting = asyncio.create_task(fastapi_microservice._wait_for_image(session_id, elsewhere, timeout=5))
+
+        agent.artefacts.image_file = tmp_path / "image_0.png"
+        agent.artefacts.image_status = "ready"
+        chart.set_result(agent.artefacts.image_file)
+        start = time.time()
+        seen = await waiting
+        assert seen.artefacts.image_status == "ready" and time.time() - start < 3
+
+    @pytest.mark.asyncio
+    async def test_lease_makes_turns_exclusive(self, workers):
+        first, second = workers
+        async with first.use() as (session_id, _):
+            pass
+        async with first.use(session_id):
+            with pytest.raises(SessionBusy):
+                async with second.use(session_id):
+                    pass
+        async with second.use(session_id) as (same_id, _):
+            assert same_id == session_id
+
+class TestSessionSnapshot:
+    """Versioned binary snapshots: JSON metadata plus the result frame"""
+
+    @staticmethod
+    def _session(agent, tmp_path, rows=100):
+        agent.artefacts.data = pd.DataFrame({
+            "UnitId": [f"T_{i % 60:02d}" for i in range(rows)],
+            "Downtime": [i / 10 for i in range(rows)],
+            "Jobs": range(rows),
+        })
+        agent.artefacts.data_file = tmp_path / "data_0.csv"
+        agent.artefacts.data.to_csv(agent.artefacts.data_file, index=False)
+        agent.artefacts.image_file = tmp_path / "image_0.png"
+        agent.artefacts.image_file.write_bytes(b"\x89PNG" + b"x" * 200_000)
+        agent.artefacts.image_status = "ready"
+        agent.artefacts.metrics.sql_attempts = 2
+        agent.history.append({"role": "user", "content": "Trabajos por equipo"})
+        agent.state.update("Trabajos por equipo", agent.artefacts, ["sql_query"])
+        agent.cache.set("q", {"response": "Listo", "metrics": agent.artefacts.metrics})
+        return agent
+
+    @pytest.mark.parametrize("codec", ["auto", "pickle", "file"])
+    def test_roundtrip(self, agent, temp_db, tmp_path, codec):
+        self._session(agent, tmp_path)
+        payload = snapshot.dumps(agent.snapshot(), codec)
+        assert payload[:4] == snapshot.MAGIC
+        assert len(payload) < 200_000  # the chart is kept by path
+
+        restored = ImprovedAgentChat(temp_db)
+        restored.restore(snapshot.loads(payload))
+        pd.testing.assert_frame_equal(restored.artefacts.data, agent.artefacts.data, check_dtype=codec != "file")
+        assert restored.artefacts.image_file == agent.artefacts.image_file
+        assert restored.artefacts.metrics.sql_attempts == 2
+        assert restored.state == agent.state
+        assert list(restored.history) == list(agent.history)
+        assert restored.cache.get("q")["metrics"].sql_attempts == 2
+
+    def test_unknown_fields_are_ignored(self, agent, temp_db, tmp_path):
+        snap = self._session(agent, tmp_path).snapshot()
+        snap["state"]["added_later"] = 1
+        snap["artefacts"]["metrics"]["added_later"] = 1
+        restored = ImprovedAgentChat(temp_db)
+        restored.restore(snapshot.loads(snapshot.dumps(snap)))
+        assert restored.state.turns == 1
+
+    def test_rejects_foreign_and_newer_payloads(self, agent):
+        payload = snapshot.dumps(agent.snapshot())
+        with pytest.raises(snapshot.SnapshotError):
+            snapshot.loads(b"not a snapshot at all")
+        newer = payload[:4] + (snapshot.FORMAT_VERSION + 1).to_bytes(2, "little") + payload[6:]
+        with pytest.raises(snapshot.SnapshotError, match="newer"):
+            snapshot.loads(newer)
+        with pytest.raises(snapshot.SnapshotError):
+            snapshot.loads(payload[:-1])
+
+    def test_restore_takes_milliseconds(self, agent, temp_db, tmp_path):
+        payload = snapshot.dumps(self._session(agent, tmp_path, rows=20_000).snapshot())
+        start = time.perf_counter()
+        ImprovedAgentChat(temp_db).restore(snapshot.loads(payload))
+        assert time.perf_counter() - start < 0.25
+
+
+class TestJobManager:
+    """Queued chat turns run by a bounded worker pool, long-polled by id"""
+
+    @staticmethod
+    def _manager(delay=0.05, **kwargs):
+        running = {"now": 0, "peak": 0}
+
+        async def handler(request):
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            try:
+                await asyncio.sleep(delay)
+                if request == "boom":
+                    raise ValueError("turn failed")
+                return f"answer to {request}"
+            finally:
+                running["now"] -= 1
+
+        return JobManager(handler, **kwargs), running
+
+    @pytest.mark.asyncio
+    async def test_submit_returns_at_once_and_long_poll_gets_result(self):
+        manager, _ = self._manager(delay=0.1)
+        job = manager.submit("q1")
+        assert job.status == "queued"
+
+        polled = await manager.wait(job.id, timeout=0.01)
+        assert not polled.finished
+        polled = await manager.wait(job.id, timeout=2)
+        assert polled.status == "done" and polled.result == "answer to q1"
+        assert polled.timing()["run_time"] >= 0.1
+        await manager.stop()
+
+    @pytest.mark.asyncio
+    async def test_workers_bound_concurrency_and_queue_is_bounded(self):
+        manager, running = self._manager(workers=2, max_queued=3)
+        jobs = [manager.submit(f"q{i}") for i in range(3)]
+        with pytest.raises(JobQueueFull):
+            manager.submit("one too many")
+        for job in jobs:
+            await manager.wait(job.id, timeout=2)
+        assert all(job.status == "done" for job in jobs)
+        assert running["peak"] == 2
+        await manager.stop()
+
+    @pytest.mark.asyncio
+    async def test_failures_and_result_ttl(self):
+        manager, _ = self._manager(result_ttl=60)
+        job = await manager.wait(manager.submit("boom").id, timeout=2)
+        assert job.status == "failed" and job.error == "turn failed"
+
+        manager.purge(now=time.time() + 61)
+        assert manager.get(job.id) is None
+        await manager.stop()
+
+    @pytest.mark.asyncio
+    async def test_stop_fails_unfinished_jobs(self):
+        manager, _ = self._manager(delay=5, workers=1)
+        running, queued = manager.submit("q1"), manager.submit("q2")
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        assert running.status == queued.status == "failed"
+        assert queued.status_code == 503
+
+    def test_unknown_job_is_404(self, client):
+        assert client.get("/v1/jobs/not-a-job").status_code == 404
+        assert client.get("/v1/jobs/not-a-job", params={"wait": 600}).status_code == 422
+
+
+class TestAdmissionControl:
+    """Bounded in-flight turns, a bounded wait queue and load shedding"""
+
+    @staticmethod
+    async def _turn(controller, log, delay=0.05, **kwargs):
+        async with controller.admit(**kwargs):
+            log.append(controller.in_flight)
+            await asyncio.sleep(delay)
+
+    @pytest.mark.asyncio
+    async def test_in_flight_is_bounded(self):
+        controller, log = AdmissionController(max_in_flight=2, max_queue=10, queue_timeout=2), []
+        await asyncio.gather(*(self._turn(controller, log) for _ in range(6)))
+        assert max(log) == 2 and len(log) == 6
+        stats = controller.stats()
+        assert stats["in_flight"] == stats["queued"] == 0
+        assert stats["queue_wait"]["count"] >= 6
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_429_and_long_wait_is_503(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+        admitted = controller.stats()["counters"].get("admitted", 0)
+        running = asyncio.create_task(self._turn(controller, [], delay=0.3))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(self._turn(controller, []))
+        await asyncio.sleep(0.01)
+        assert controller.stats()["queued"] == 1
+
+        with pytest.raises(Overloaded) as full:
+            async with controller.admit():
+                pass
+        assert full.value.status_code == 429 and full.value.retry_after >= 1
+
+        with pytest.raises(Overloaded) as slow:
+            await waiting
+        assert slow.value.status_code == 503
+
+        # Patient callers (job workers) wait for the slot however long it takes
+        await asyncio.gather(running, self._turn(controller, [], patient=True))
+        assert controller.stats()["counters"]["admitted"] == admitted + 2
+
+    @pytest.mark.asyncio
+    async def test_waiting_jobs_never_shed_chat(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=1)
+        running = asyncio.create_task(self._turn(controller, [], delay=0.1))
+        await asyncio.sleep(0.01)
+        jobs = [asyncio.create_task(self._turn(controller, [], patient=True)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        assert controller.stats()["queued"] == 0 and controller.stats()["patient_queued"] == 3
+
+        # The chat queue is still empty, so a chat turn waits instead of getting a 429
+        await asyncio.gather(running, self._turn(controller, []), *jobs)
+        assert controller.stats()["patient_queued"] == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_never_leaks_a_slot(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10, queue_timeout=10)
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.admit():
+                await release.wait()
+
+        running = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(self._turn(controller, []))
+        await asyncio.sleep(0.01)
+        # The slot is handed over and the waiter (a disconnected client) cancelled in the same tick
+        release.set()
+        await running
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.in_flight == controller.queued == 0
+
+        log = []
+        await asyncio.wait_for(self._turn(controller, log), 1)
+        assert log == [1]
+
+    def test_saturated_chat_gets_retry_after(self, client, monkeypatch):
+        saturated = fastapi_microservice.AdmissionController(max_in_flight=1, max_queue=0)
+        saturated.in_flight = 1
+        monkeypatch.setattr(fastapi_microservice, "admission", saturated)
+        response = client.post("/v1/chat", json={"message": "Trabajos por equipo"})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+        load = client.get("/v1/metrics/load").json()
+        assert load["in_flight"] == 1 and load["utilisation"] == 1.0
+
+
 class TestAPIIntegration:
     """Test the FastAPI integration"""
     
@@ -216,6 +1764,7 @@ class TestAPIIntegration:
         mock_agent.artefacts.data_file = None
         mock_agent.artefacts.image_file = None
         mock_agent.artefacts.code_file = None
+        mock_agent.artefacts.image_status = "none"
         
         mock_agent_class.return_value = mock_agent
         mock_db.return_value = Mock()
@@ -284,6 +1833,82 @@ class TestPerformance:
             # Should complete reasonably quickly
             assert end_time - start_time < 30.0
     
+    @pytest.mark.asyncio
+    async def test_speculative_chart_overlap(self, agent, mock_llm):
+        """Benchmark: chart instructions drafted while SQL runs"""
+        df = pd.DataFrame({"UnitId": ["T_01", "T_02"], "job_count": [3, 5]})
+        agent.artefacts.data = df  # previous turn -> predicted columns
+        data_path = await agent.fs.save_dataframe(df)
+
+        async def slow_sql(request):
+            await asyncio.sleep(0.3)
+            return "SELECT ...", df, data_path, True
+
+        async def slow_instr(request, sample):
+            await asyncio.sleep(0.2)
+            return "Bar chart of job_count per UnitId"
+
+        captured = {}
+
+        async def fake_image(request, frame, path, instructions=None):
+            captured["instructions"] = instructions
+            return b"png", "code", Path("image_0.png"), Path("code_0.py")
+
+        agent._supervised_sql_async = slow_sql
+        agent._request_to_image_instr = AsyncMock(side_effect=slow_instr)
+        agent._run_python_image_async = fake_image
+
+        spec = agent._start_speculative_instructions("chart of jobs per unit")
+        await agent._data_refresh_branch_async("chart of jobs per unit", also_image=True, speculative=spec)
+        assert await agent.wait_for_image(timeout=2) == "ready"
+
+        # SQL (0.3s) and the drafted instructions (0.2s) ran side by side
+        assert agent.artefacts.metrics.speculative_overlap_time >= 0.15
+        assert agent.artefacts.metrics.speculative_hit is True
+        assert captured["instructions"] == "Bar chart of job_count per UnitId"
+        assert agent._request_to_image_instr.call_count == 1  # no regeneration
+
+    @pytest.mark.asyncio
+    async def test_speculative_mismatch_regenerates(self, agent, mock_llm):
+        df = pd.DataFrame({"system": ["Motor"], "cycles": [4]})
+        agent._request_to_image_instr = AsyncMock(side_effect=["Plot job_count per UnitId", "Plot cycles per system"])
+
+        spec = agent._start_speculative_instructions("chart")
+        instructions = await agent._reconcile_instructions(spec, "chart", df)
+
+        assert instructions == "Plot cycles per system"
+        assert agent.artefacts.metrics.speculative_hit is False
+
+    @pytest.mark.asyncio
+    async def test_context_update_off_critical_path(self, agent, mock_llm):
+        """The reply is returned before the context summary finishes"""
+        agent._good_flow_async = AsyncMock(return_value=("answer", ["data"]))
+        agent.pipeline = agent._build_pipeline()
+        agent.state.needs_summary = Mock(return_value=True)
+        runtime_stats.reset()
+
+        async def slow_summary():
+            await asyncio.sleep(0.3)
+            agent.state.apply_summary("summary", 1)
+
+        agent._summarise_context = slow_summary
+
+        start = time.time()
+        _, metrics = await agent.execute("Primera pregunta")
+        assert time.time() - start < 0.3
+        assert agent._context_pending()
+        assert metrics["context_wait_time"] == 0.0
+
+        # The next turn arrives while the update is still running and waits for it
+        _, metrics = await agent.execute("Segunda pregunta")
+        assert metrics["context_wait_time"] > 0
+        assert "Summary: summary" in agent.context
+
+        await agent.context_task
+        stats = runtime_stats.get("context_update")
+        assert stats["scheduled"] == 2
+        assert stats["waited"] == 1
+
     def test_response_times(self, client):
         """Test response time requirements"""
         start_time = time.time()